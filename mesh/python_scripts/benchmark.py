@@ -0,0 +1,286 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import numpy as np
+import scipy
+from typing import Callable, List, Tuple
+
+from tube import FiberCollection
+from create_fine_mesh import min_neighbor_distance, create_CNTs
+import util
+import mesh_io
+
+"""
+# Benchmarks of the stages of the mesh post-processing on synthetic meshes of increasing size
+"""
+
+# version of the layout of the results file
+RESULTS_VERSION = 2
+
+# stages in the order of the pipeline
+# the tangent vectors are calculated together with the fine mesh by FiberCollection.calculate_r_fine, so they are part of the spline stage
+STAGES = ['parse', 'spline', 'hcp', 'cnt', 'neighbor', 'write']
+
+class PeakMemory:
+  '''
+  Track the peak resident set size of this process while a block runs, by sampling it from a background thread.
+  The memory of worker processes is not included. Where /proc/self/statm is not available only the peak of the
+  whole run (ru_maxrss) is known, and both the peak and its increase over the start of the block are reported as None.
+  '''
+  _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+  def __init__(self, interval=0.005):
+    self._interval = interval
+    self._stop = threading.Event()
+    self._thread = None
+    self.start = None
+    self.peak = None
+
+  @classmethod
+  def rss(cls):
+    '''
+    Current resident set size [bytes], or None if it is not available
+    '''
+    try:
+      with open('/proc/self/statm') as file:
+        return int(file.read().split()[1])*cls._PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+      return None
+
+  def _sample(self):
+    while not self._stop.wait(self._interval):
+      self.peak = max(self.peak, self.rss())
+
+  def __enter__(self):
+    self.start = self.peak = self.rss()
+    if self.start is not None:
+      self._thread = threading.Thread(target=self._sample, daemon=True)
+      self._thread.start()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if self._thread is not None:
+      self._stop.set()
+      self._thread.join()
+      self.peak = max(self.peak, self.rss())
+
+def max_rss():
+  '''
+  Peak resident set size of this process since it started [bytes]
+  '''
+  # ru_maxrss is in kilobytes on linux and in bytes on macOS
+  scale = 1 if sys.platform == 'darwin' else 1024
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale
+
+def synthetic_box(num_fiber: int, density: float, height: float) -> Tuple[float, float, float]:
+  '''
+  Box of a synthetic mesh with a fixed fiber density, so the number of neighbors of a fiber does not grow with the mesh size
+
+  Parameters:
+    num_fiber (int): number of fibers
+    density (float): number of fibers per volume [nm^-3]
+    height (float): height of the box along y [nm]
+
+  Returns:
+    tuple of the box size along x, y and z [nm]
+  '''
+  width = np.sqrt(num_fiber/(density*height))
+  return (width, height, width)
+
+def run_stage(name: str, setup: Callable, run: Callable, points: Callable, repeat=1) -> Tuple[dict, object]:
+  '''
+  Time one stage: setup() prepares a fresh input that is not timed, run(input) is timed and points(output) counts
+  the points that the stage processed. The stage is run `repeat` times and the fastest run is reported.
+
+  Returns:
+    tuple of (record, output) where record holds the timings and output is the output of the last run
+  '''
+  times, peaks, increases = [], [], []
+  for _ in range(repeat):
+    stage_input = setup()
+    with PeakMemory() as memory:
+      start = time.perf_counter()
+      output = run(stage_input)
+      times.append(time.perf_counter()-start)
+    if memory.peak is not None:
+      peaks.append(memory.peak)
+      increases.append(memory.peak-memory.start)
+    del stage_input
+
+  best = min(times)
+  n_point = int(points(output))
+  record = {'stage': name, 'points': n_point, 'time [s]': best, 'times [s]': times,
+            'throughput [points/s]': n_point/best if best > 0 else None,
+            'peak rss [MB]': max(peaks)/2**20 if peaks else None,
+            'peak rss increase [MB]': max(increases)/2**20 if increases else None}
+  return record, output
+
+def benchmark_mesh(directory: str, output_directory: str, workers=1, repeat=1, stages=STAGES, cutoff=50., distance_mode='fine') -> List[dict]:
+  '''
+  Run the stages of the mesh post-processing on the tube files of a directory, in the order of create_fine_mesh.py --create_cnts.
+  The stages that a selected stage depends on are always run, but only the selected ones are reported.
+
+  Parameters:
+    directory (str): mesh directory with tube{i}.pos.dat / tube{i}.chiral.dat files
+    output_directory (str): scratch directory for the output writing stage
+    workers (int): number of worker processes used to parse and interpolate the tube files
+    repeat (int): number of runs of each stage, the fastest is reported
+    stages (list(str)): stages to report
+    cutoff (float): largest distance between two fibers recorded by the neighbor distance stage [nm]
+    distance_mode (str): mode of min_neighbor_distance
+
+  Returns:
+    list(dict): one record per reported stage
+  '''
+  records = []
+
+  def stage(name, setup, run, points):
+    record, output = run_stage(name, setup, run, points, repeat=repeat)
+    if name in stages:
+      print(f'  {name:<10s} {record["points"]:>12.3e} points {record["time [s]"]:>10.3f} s {record["throughput [points/s]"] or 0:>12.3e} points/s')
+      records.append(record)
+    return output
+
+  files = mesh_io.tube_files(directory)
+  r, offsets, chiral = stage('parse', lambda: files, lambda f: mesh_io.read_tube_files(f, workers=workers), lambda out: out[1][-1])
+
+  # the fine mesh and its tangent vectors, interpolated in chunks of fibers by the pool of workers as in --create_cnts
+  fibers = stage('spline', lambda: FiberCollection(r, offsets, chiral), lambda f: (f.calculate_r_fine(workers=workers), f)[1],
+                 lambda f: f.offsets('fine')[-1])
+  if 'spline' in stages:
+    print('  (the spline stage includes the tangent vectors)')
+
+  # the lattice of the CNTs in the cross section of a fiber, as in --create_cnts; its size does not depend on the mesh,
+  # and the stored lattices are cleared before every run so the calculation is timed
+  fiber_diameter, cnt_diameter = 5, 100
+  coor = stage('hcp', lambda: util.HCP_coordinates.cache_clear(), lambda _: util.HCP_coordinates(fiber_diameter, cnt_diameter), len)
+  cnts = stage('cnt', lambda: fibers, lambda f: create_CNTs(f, coor), lambda out: out[0].size//3)
+
+  if 'neighbor' in stages:
+    stage('neighbor', lambda: fibers, lambda f: min_neighbor_distance(f, mode=distance_mode, cutoff=cutoff), lambda out: fibers.offsets('fine')[-1])
+
+  if 'write' in stages:
+    pos, orient, chiral_cnt = (c.reshape((-1,)+c.shape[2:]) for c in cnts)
+
+    def write(cnts):
+      writer = mesh_io.SingleCNTWriter(output_directory, pos.shape[0], pos.shape[1], n_fiber=len(fibers))
+      writer.write(*cnts)
+      writer.close()
+      return cnts[0]
+    stage('write', lambda: (pos, orient, chiral_cnt), write, lambda out: out.size//3)
+
+  return records
+
+def scaling_exponents(results: List[dict], threshold=1.5, min_time=0.01) -> dict:
+  '''
+  Fit time = c*points^exponent to the runs of each stage by least squares in log-log scale.
+  Runs shorter than min_time are left out of the fit, as their time is dominated by fixed overheads.
+
+  Parameters:
+    results (list(dict)): records of `benchmark_mesh` of all the mesh sizes
+    threshold (float): stages whose exponent is above the threshold are flagged
+    min_time (float): shortest time of a run that is used in the fit [s]
+
+  Returns:
+    dict with one entry per stage with the exponent (None if less than two sizes are usable) and whether it is flagged
+  '''
+  fits = {}
+  for name in STAGES:
+    runs = [r for r in results if r['stage'] == name and r['time [s]'] >= min_time and r['points'] > 0]
+    sizes = sorted(set(r['points'] for r in runs))
+    if len(sizes) < 2:
+      if any(r['stage'] == name for r in results):
+        fits[name] = {'exponent': None, 'flagged': False, 'sizes': len(sizes)}
+      continue
+    exponent = np.polyfit(np.log([r['points'] for r in runs]), np.log([r['time [s]'] for r in runs]), 1)[0]
+    fits[name] = {'exponent': float(exponent), 'flagged': bool(exponent > threshold), 'sizes': len(sizes)}
+  return fits
+
+def compare(results: List[dict], reference: List[dict]):
+  '''
+  Print the speedup of each stage and mesh size against the results of an earlier run
+  '''
+  old = {(r['stage'], r['number of fibers']): r['time [s]'] for r in reference}
+  matches = [r for r in results if (r['stage'], r['number of fibers']) in old and r['time [s]'] > 0]
+  if not matches:
+    print('the reference run has none of the stages and mesh sizes of this run')
+    return
+  print('speedup against the reference run (reference time / time):')
+  for r in matches:
+    print(f'  {r["stage"]:<10s} {r["number of fibers"]:>10d} fibers {old[(r["stage"], r["number of fibers"])]/r["time [s]"]:>8.2f}x')
+
+def machine_info() -> dict:
+  '''
+  Describe the machine and library versions, so results of different runs can be told apart
+  '''
+  return {'platform': platform.platform(), 'processor': platform.processor(), 'cpu count': os.cpu_count(),
+          'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__}
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark the stages of the mesh post-processing on synthetic meshes of increasing size')
+  parser.add_argument('--num_fibers', help='number of fibers of each synthetic mesh', type=int, nargs='+', default=[500, 1000, 2000, 4000])
+  parser.add_argument('--sections', help='min and max number of sections per fiber', type=int, nargs=2, default=[8, 14])
+  parser.add_argument('--density', help='number of fibers per volume, the box grows with the number of fibers [nm^-3]', type=float, default=2.5e-5)
+  parser.add_argument('--height', help='height of the box along y [nm]', type=float, default=100.)
+  parser.add_argument('--stages', help='stages to report', choices=STAGES, nargs='+', default=STAGES)
+  parser.add_argument('--neighbor_cutoff', help='largest distance between two fibers recorded by the neighbor distance stage [nm]', type=float, default=50.)
+  parser.add_argument('--distance_mode', help='points used by the neighbor distance stage, as in create_fine_mesh.py --distance_mode', choices=['fine', 'rough', 'segment'], default='fine')
+  parser.add_argument('--repeat', help='number of runs of each stage, the fastest is reported', type=int, default=1)
+  parser.add_argument('--workers', help='number of worker processes used to parse and interpolate the tube files', type=int, default=1)
+  parser.add_argument('--seed', help='seed of the synthetic meshes', type=int, default=0)
+  parser.add_argument('--threshold', help='scaling exponents above this value are flagged', type=float, default=1.5)
+  parser.add_argument('--min_time', help='runs shorter than this are left out of the scaling fit [s]', type=float, default=0.01)
+  parser.add_argument('--output', help='results file in json format', type=str, default='benchmark.json')
+  parser.add_argument('--compare', help='results file of an earlier run to compare with', type=str, default=None)
+  parser.add_argument('--scratch', help='directory for the synthetic meshes and the written cnts (default: a temporary directory)', type=str, default=None)
+  args = parser.parse_args()
+
+  scratch = args.scratch or tempfile.mkdtemp(prefix='mesh_benchmark_')
+  results = []
+  try:
+    for num_fiber in args.num_fibers:
+      directory = os.path.join(scratch, f'mesh_{num_fiber}')
+      output_directory = os.path.join(directory, 'cnts')
+      os.makedirs(output_directory, exist_ok=True)
+      box = synthetic_box(num_fiber, args.density, args.height)
+      mesh_io.write_synthetic_mesh(directory, num_fiber, args.sections, box, seed=args.seed, workers=args.workers)
+
+      print(f'{num_fiber} fibers in a box of {box[0]:.0f} x {box[1]:.0f} x {box[2]:.0f} nm:')
+      for record in benchmark_mesh(directory, output_directory, workers=args.workers, repeat=args.repeat, stages=args.stages,
+                                   cutoff=args.neighbor_cutoff, distance_mode=args.distance_mode):
+        record['number of fibers'] = num_fiber
+        results.append(record)
+      shutil.rmtree(directory)
+  finally:
+    if args.scratch is None:
+      shutil.rmtree(scratch, ignore_errors=True)
+
+  fits = scaling_exponents(results, threshold=args.threshold, min_time=args.min_time)
+  print('scaling exponents of time against points:')
+  for name, fit in fits.items():
+    exponent = 'n/a' if fit['exponent'] is None else f'{fit["exponent"]:.2f}'
+    print(f'  {name:<10s} {exponent:>6s}' + ('  <-- above the threshold' if fit['flagged'] else ''))
+
+  report = {'version': RESULTS_VERSION, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'machine': machine_info(),
+            'parameters': vars(args), 'max rss [MB]': max_rss()/2**20, 'results': results, 'scaling': fits}
+  with open(args.output, 'w') as file:
+    json.dump(report, file, indent=2)
+  print(f'results written to: {args.output}')
+
+  if args.compare:
+    with open(args.compare) as file:
+      compare(results, json.load(file)['results'])
+
+  # a non-zero exit status lets automated runs catch a stage whose scaling got worse
+  if any(fit['flagged'] for fit in fits.values()):
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
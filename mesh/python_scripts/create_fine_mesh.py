@@ -9,13 +9,13 @@ import argparse
 from typing import List, Tuple
 import shutil
 import pandas as pd
-
 import plotly.offline as plo
 import plotly.graph_objs as go
 
-from tube import fiber
+from tube import fiber, FiberCollection
 import util
-
+import mesh_io
+import spatial
 #IMPORTANT: do not move this line (it is overwritten by the mesh main program).
 DIR = '../cnt_mesh_fiber_test_1x_rougher'
 
@@ -30,72 +30,103 @@ DIR = '../cnt_mesh_fiber_test_1x_rougher'
 # mpl.rc('legend', fontsize=20)  # default fontsize for legends
 # mpl.rc('figure', titlesize=35)  # default title size for figures with subplot
 
-def load_fibers(directory: str):
+def load_fibers(directory: str, workers=None, rebuild_cache=False):
   '''
   Load all the fiber mesh points in the a directory
   Parameters:
     directory (str): input directory
+    workers (int): number of processes used to parse the tube files (None uses all the cores)
+    rebuild_cache (bool): ignore the cached copy of the parsed tube files and parse them again
   Returns:
-    list(fiber): list containing all the fiber objects
+    FiberCollection: collection of all the fibers, which can be used as a list of fiber objects
   '''
-  fibers = []
-
-  for i in range(1, 100):
-    filename_pos = os.path.join(directory, f'tube{i}.pos.dat')
-    filename_chiral = os.path.join(directory, f'tube{i}.chiral.dat')
-    if (not os.path.isfile(filename_pos) or not os.path.isfile(filename_chiral)):
-      continue
-    print(f'reading file: {filename_pos}, {filename_chiral}')
-    with open(filename_pos) as file1, open(filename_chiral) as file2:
-      for line1 in file1:
-        line1 = line1.strip('\n; ')
-        line1 = line1.split(';')
-        line1 = line1[1:]
-        r = [list(map(float,n.split(','))) for n in line1]
-        line2 = file2.readline()
-        line2 = line2.strip('\n; ')
-        line2 = line2.split(';')
-        line2 = line2[1:2]
-        c = [list(map(float,n.split(','))) for n in line2]
-        fibers.append(fiber(r,c))
-  
-  return fibers
-
-def min_neighbor_distance(fibers: List[fiber], mode='fine', n=1000):
+  r, offsets, chiral = mesh_io.read_fiber_arrays(directory, workers=workers, rebuild_cache=rebuild_cache)
+
+  return FiberCollection(r, offsets, chiral)
+
+def min_neighbor_distance(fibers: FiberCollection, mode='fine', n=None, cutoff=50.):
   '''
-  Calculate the minimum distance between a list of fibers
+  Calculate the minimum distance between a list of fibers using a KD-tree of all the fiber points
   Parameters:
-    fibers (list[fiber]): list of fibers
-    mode (str): specify set of points that are going to be used for calculating the distances
-    n (int): total number of fibers to take from the begining of the fibers list.
+    fibers (FiberCollection): collection of fibers
+    mode (str): specify set of points that are going to be used for calculating the distances:
+      'rough' or 'fine' for the smallest distance between the points of the rough or fine mesh, and
+      'segment' for the exact distance between the segments that connect the points of the rough mesh
+    n (int): total number of fibers to take from the begining of the fibers list (None takes all the fibers).
+    cutoff (float): largest distance between two fibers that is recorded [nm]
   Return:
-    (min_dist_per_cnt, pair_min_dist):
-      min_dist_per_cnt: np.ndarray of shape (n,1) that specifies nearest neighbor for each fiber
-      min_dist: np.ndarray of shape (n,n) that specifies the distance between each two fiber in the list
+    (min_dist_per_cnt, pairs, pair_min_dist):
+      min_dist_per_cnt: np.ndarray of shape (n,) that specifies the distance to the nearest neighbor for each fiber (np.inf if farther than cutoff)
+      pairs: np.ndarray of shape (m,2) with the indices of each two fibers in the list that are closer than cutoff
+      pair_min_dist: np.ndarray of shape (m,) that specifies the distance between the fibers of each pair
+  '''
+  if n is not None:
+    fibers = fibers[:n]
+
+  if mode == 'segment':
+    return spatial.fiber_segment_distances(fibers.r('rough'), fibers.offsets('rough'), cutoff=cutoff)
+  return spatial.fiber_pair_distances(fibers.r(mode), fibers.offsets(mode), cutoff=cutoff)
+
+def create_CNTs(fibers: FiberCollection, coor: np.ndarray, compact=False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  '''
+  Create coordinates of single CNTs inside all the fibers of a collection.
+  The cross section frames of all points of all fibers are calculated at once with util.parallel_transport_frames.
+  Parameters:
+    fibers (FiberCollection): the fibers, which should all have the same number of points in their fine mesh
+    coor (np.ndarray): coordinates of CNT axis in the cross section plane of the fiber
+    compact (bool): if True, do not repeat the orientation for every cnt of a fiber and the chirality for every point of a cnt
+  Returns:
+    tuple of (pos, orient, chiral), where `pos` and `orient` are `np.ndarray` of shape `(n_fiber, n_cnt, n_coor_per_cnt, 3)` indicating position and orientation of points on all cnts,
+    and `chiral` is `np.ndarray` of shape `(n_fiber, n_cnt, n_coor_per_cnt, 2)`.
+    In the compact form `orient` has shape `(n_fiber, n_coor_per_cnt, 3)` and `chiral` has shape `(n_fiber, n_cnt, 2)`.
   '''
-  fibers = fibers[:n]
+  n_coor = fibers.num_nodes('fine')
+  assert np.all(n_coor == n_coor[0]), "all fibers should have the same number of points in the fine mesh"
+  shape = (len(fibers), n_coor[0], 3)
 
-  n = len(fibers)
+  norm_vecs, _ = fibers.tangent_vecs()
+  norm_vecs = norm_vecs.reshape(shape)
+  a1, a2, a3 = util.cartesian_basis_vectors(norm_vecs[:, 0, :])
+  a1, a2 = util.parallel_transport_frames(norm_vecs, a1, a2)
 
-  pair_min_dist = np.full((n, n), 1.e4)
+  r = fibers.r('fine').reshape(shape)
 
-  for i, f1 in enumerate(tqdm(fibers)):
-      for j in range(i+1, n):
-          f2 = fibers[j]
-          # temp = np.empty((f1.r(mode).shape[0], f2.r(mode).shape[0], 3))
-          temp = np.empty((f2.r(mode).shape[0], f1.r(mode).shape[0], 3))
-          for d in range(3):
-              x, y = np.meshgrid(f1.r(mode)[:, d], f2.r(mode)[:, d])
-              temp[:, :, d] = x-y
-          temp = np.linalg.norm(temp, axis=2)
-          pair_min_dist[i, j] = pair_min_dist[j, i] = temp.min()
+  # broadcast over (fiber, cnt, point, coordinate)
+  pos = r[:, np.newaxis] + coor[np.newaxis, :, np.newaxis, 0:1]*a1[:, np.newaxis] + coor[np.newaxis, :, np.newaxis, 1:2]*a2[:, np.newaxis]
+  if compact:
+    return pos, norm_vecs, np.repeat(fibers.get_chiral()[:, np.newaxis, :], coor.shape[0], axis=1)
+  orient = np.repeat(norm_vecs[:, np.newaxis], coor.shape[0], axis=1)
+  chiral = np.broadcast_to(fibers.get_chiral()[:, np.newaxis, np.newaxis, :], shape[:1]+(coor.shape[0],)+shape[1:2]+(2,)).copy()
 
-  min_dist_per_cnt = pair_min_dist.min(axis=1)
+  return pos, orient, chiral
 
-  for i in range(pair_min_dist.shape[0]):
-    pair_min_dist[i, i] = -1
+def create_CNT_chunks(fibers: FiberCollection, coor: np.ndarray, chunk_size=1000, workers=None, compact=False):
+  '''
+  Create the single CNTs of a collection of fibers in chunks of fibers, to keep the memory use proportional to the chunk size.
+  The fine mesh of each chunk is interpolated (unless the collection already has one) and dropped after the CNTs are created,
+  and the chunks are created in the order of the fibers, so the output is the same as `create_CNTs` for the whole collection.
 
-  return min_dist_per_cnt, pair_min_dist
+  Parameters:
+    fibers (FiberCollection): the fibers
+    coor (np.ndarray): coordinates of CNT axis in the cross section plane of the fiber
+    chunk_size (int): number of fibers per chunk
+    workers (int): number of worker processes used to interpolate each chunk
+    compact (bool): yield the compact form of the orientation and chirality (see `create_CNTs`)
+
+  Yields:
+    tuple of (pos, orient, chiral) for each chunk, with shape (n_fiber*n_cnt, n_coor_per_cnt, 3) for `pos` and `orient`
+    and (n_fiber*n_cnt, n_coor_per_cnt, 2) for `chiral`, or (n_fiber, n_coor_per_cnt, 3) for `orient`
+    and (n_fiber*n_cnt, 2) for `chiral` in the compact form
+  '''
+  for chunk in fibers.chunks(chunk_size):
+    if not chunk.is_interpolated():
+      chunk.calculate_r_fine(workers=workers)
+    pos, orient, chiral = create_CNTs(chunk, coor, compact=compact)
+    coor_per_cnt = pos.shape[2]
+    if compact:
+      yield pos.reshape((-1, coor_per_cnt, 3)), orient, chiral.reshape((-1, 2))
+    else:
+      yield pos.reshape((-1, coor_per_cnt, 3)), orient.reshape((-1, coor_per_cnt, 3)), chiral.reshape((-1, coor_per_cnt, 2))
 
 def create_single_CNTs(fib: fiber, coor: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
   '''
@@ -112,27 +143,11 @@ def create_single_CNTs(fib: fiber, coor: np.ndarray) -> Tuple[np.ndarray, np.nda
 
   r = fib.r('fine')
 
-  pos = []
-  orient = []
-  chiral = []
-
-  for i, vec in enumerate(norm_vecs):
-    axis = np.cross(a3, vec)
-    alpha = np.arcsin(np.linalg.norm(axis))
-    qt = util.get_quaternion(axis, alpha)
-    Rot = util.rotation_from_quaternion(qt)
+  a1, a2 = util.parallel_transport_frames(norm_vecs[np.newaxis], a1, a2)
 
-    a1 = np.matmul(Rot, a1.T).T
-    a2 = np.matmul(Rot, a2.T).T
-    a3 = vec
-
-    pos.append(r[i] + np.matmul(coor, np.vstack((a1, a2))))
-    orient.append([a3 for i in range(coor.shape[0])])
-    chiral.append([chirality for i in range(coor.shape[0])])
-  
-  pos = np.array(pos).swapaxes(0, 1)
-  orient = np.array(orient).swapaxes(0, 1)
-  chiral = np.array(chiral).swapaxes(0, 1)
+  pos = r + coor[:, np.newaxis, 0:1]*a1 + coor[:, np.newaxis, 1:2]*a2
+  orient = np.repeat(norm_vecs[np.newaxis], coor.shape[0], axis=0)
+  chiral = np.array([[chirality for i in range(r.shape[0])] for j in range(coor.shape[0])])
 
   return pos, orient, chiral
 
@@ -145,11 +160,46 @@ def main():
   parser.add_argument('--plot_cnts', help='Create and plot position of individual CNTs for a limited number of fibers', action='store_true')
   parser.add_argument('--create_cnts', help='Create the position of individual CNTs within the fibers', action='store_true')
   parser.add_argument('--check_npy_files', help='Load cnt coordinates written into npy file format to check for errors (run after cnts generated)', action='store_true')
-  parser.add_argument('--trim', help='trim created mesh in the low density regions (use together with --plot_cnts)', action='store_true')
+  parser.add_argument('--trim', help='trim the single cnt mesh in the low density regions and write the result to --trim_output (use after or together with --create_cnts)', action='store_true')
+  parser.add_argument('--mc_input', help='monte carlo input file; write a copy of the single cnt mesh without the cnts outside of its "trim limits" plus a halo of the max hopping radius', type=str, default=None)
+  parser.add_argument('--mc_output', help='output directory of --mc_input (default: the mc_trimmed subdirectory of the mesh directory)', type=str, default=None)
+  parser.add_argument('--tile', help='write a spatially tiled copy of the single cnt mesh with an index, to read sub-volumes with mesh_io.TiledMesh', action='store_true')
+  parser.add_argument('--tile_size', help='edge length of the tiles written by --tile [nm]', type=float, default=200.)
+  parser.add_argument('--neighbor_list', help='find the neighbors of every point of the single cnt mesh within the max hopping radius and save them next to the mesh, for the hopping geometry and the python monte carlo', action='store_true')
+  parser.add_argument('--same_cnt_pairs', help='keep the pairs of points of the same cnt in --neighbor_list, as the python monte carlo (kubo.py) requires', action='store_true')
+  parser.add_argument('--hopping_radius', help='max hopping radius of --neighbor_list [nm] (default: the "max hopping radius [m]" of --mc_input, or 20 nm)', type=float, default=None)
+  parser.add_argument('--hopping_geometry', help='monte carlo input file; calculate the geometry of every pair of the neighbor list and locate it on the axes of its scatter table (run after or together with --neighbor_list)', type=str, default=None)
   parser.add_argument('--random_mesh', help='create a randomly oriented mesh of molecules, this option is independent of BulletPhysics related options', action='store_true')
+  parser.add_argument('--synthetic_mesh', help='create a fiber mesh of random walk fibers in the format of BulletPhysics (tube*.pos.dat files), to run the mesh tools on meshes of any size', action='store_true')
   parser.add_argument('--histogram', help='Create a check point for the histogram generated by cpp_analyze code', action='store_true')
+  parser.add_argument('--workers', help='number of worker processes used to read and interpolate the mesh (default: all cores)', type=int, default=None)
+  parser.add_argument('--neighbor_cutoff', help='largest distance between two fibers recorded by --nearest_neighbor [nm]', type=float, default=50.)
+  parser.add_argument('--distance_mode', help='points used by --nearest_neighbor: fine or rough mesh points, or exact distance between rough mesh segments', choices=['fine', 'rough', 'segment'], default='fine')
+  parser.add_argument('--chunk_size', help='number of fibers interpolated and written at a time by --create_cnts (or cnts read at a time by --trim, --tile and --compute_histogram)', type=int, default=1000)
+  parser.add_argument('--voxel_size', help='edge length of the voxels used by --trim to find the low density regions [nm]', type=float, default=50.)
+  parser.add_argument('--trim_threshold', help='slabs of voxels with a density below this fraction of the median density are trimmed from the boundary', type=float, default=0.5)
+  parser.add_argument('--trim_output', help='output directory of --trim (default: the trimmed subdirectory of the mesh directory)', type=str, default=None)
+  parser.add_argument('--cnt_format', help='format of the single_cnt.*.dat files written by --create_cnts: Armadillo text or Armadillo binary (full precision)', choices=['text', 'binary'], default='text')
+  parser.add_argument('--compact', help='write the single cnt mesh in the compact format with one orientation per fiber point and one chirality per cnt', action='store_true')
+  parser.add_argument('--full_precision', help='write the single_cnt.*.dat text files with full double precision instead of 5 significant digits', action='store_true')
+  parser.add_argument('--box', help='size of the box of --random_mesh and --synthetic_mesh along x, y and z [nm]', type=float, nargs=3, default=[2000, 100, 2000])
+  parser.add_argument('--num_points', help='number of molecules in --random_mesh', type=float, default=1.e7)
+  parser.add_argument('--density', help='density of molecules in --random_mesh [nm^-3]; overrides --num_points', type=float, default=None)
+  parser.add_argument('--seed', help='seed of the random numbers of --random_mesh and --synthetic_mesh (default: a fresh seed that is printed)', type=int, default=None)
+  parser.add_argument('--points_per_chunk', help='number of molecules drawn and written at a time by --random_mesh', type=int, default=1000000)
+  parser.add_argument('--num_fibers', help='number of fibers in --synthetic_mesh', type=float, default=1.e4)
+  parser.add_argument('--sections', help='min and max number of sections per fiber in --synthetic_mesh', type=int, nargs=2, default=[8, 14])
+  parser.add_argument('--section_length', help='min and max distance between the sections of a fiber in --synthetic_mesh [nm]', type=float, nargs=2, default=[7, 12])
+  parser.add_argument('--bending', help='standard deviation of the random change of the fiber direction between two sections in --synthetic_mesh', type=float, default=0.2)
+  parser.add_argument('--chirality', help='chirality of the fibers in --synthetic_mesh; repeat the option for a mix of chiralities (default: 4 2)', type=int, nargs=2, action='append', default=None)
+  parser.add_argument('--chirality_probability', help='relative probability of each --chirality (default: equal probabilities)', type=float, nargs='+', default=None)
+  parser.add_argument('--compute_histogram', help='Calculate histogram.dat from the single CNT mesh with the built-in pair distance engine instead of the cpp_analyze code (run after cnts generated)', action='store_true')
+  parser.add_argument('--histogram_bins', help='number of bins between 0 and 50 nm used by --compute_histogram', type=int, default=1000)
+  parser.add_argument('--rebuild_cache', help='parse the tube*.pos.dat files again instead of using the cached copy in the mesh directory', action='store_true')
 
   args = parser.parse_args()
+  if not 0 <= args.trim_threshold <= 1:
+    parser.error(f'--trim_threshold must be between 0 and 1, got {args.trim_threshold}')
 
   directory = DIR
   if not os.path.exists(directory):
@@ -157,20 +207,22 @@ def main():
     quit()
 
   if args.drop or args.plot or args.check_interpolation or args.nearest_neighbor or args.create_cnts or args.plot_cnts:
-    fibers = load_fibers(directory)
+    fibers = load_fibers(directory, workers=args.workers, rebuild_cache=args.rebuild_cache)
 
     print(f'Total number of fibers: {len(fibers)}')
     
-    num_mesh = 0
-    for f in fibers:
-      num_mesh += f.num_nodes('rough')
+    num_mesh = fibers.num_nodes('rough').sum()
     print(f'Total number of rough mesh points: {num_mesh}')
 
-    avg_number_of_sections = np.mean([f.num_nodes('rough') for f in fibers])
+    avg_number_of_sections = np.mean(fibers.num_nodes('rough'))
     print(f'average number of sections per fiber: {avg_number_of_sections:.2f}')
 
+  if args.check_interpolation or (args.nearest_neighbor and args.distance_mode == 'fine') or args.plot_cnts:
+    fibers.calculate_r_fine(workers=args.workers)
+    print(f'Total number of fine mesh points: {fibers.num_nodes("fine").sum()}')
+
   if args.drop:
-    avg_y = np.array([f.avg_y() for f in fibers])
+    avg_y = fibers.avg_y()
 
     fig = plt.figure()
     ax = fig.add_subplot(1, 1, 1)
@@ -194,9 +246,10 @@ def main():
     for f in fibers[begin:begin+n_fibers]:
       ax.plot(f.z(mode), f.x(mode), f.y(mode))
 
-    xlim = (np.min([f.x(mode).min() for f in fibers]), np.max([f.x(mode).max() for f in fibers]))
-    ylim = (np.min([f.y(mode).min() for f in fibers]), np.max([f.y(mode).max() for f in fibers]))
-    zlim = (np.min([f.z(mode).min() for f in fibers]), np.max([f.z(mode).max() for f in fibers]))
+    r_min, r_max = fibers.min(mode), fibers.max(mode)
+    xlim = (r_min[0], r_max[0])
+    ylim = (r_min[1], r_max[1])
+    zlim = (r_min[2], r_max[2])
 
     # print(f'x limits: {xlim}')
     # print(f'y limits: {ylim}')
@@ -257,7 +310,8 @@ def main():
     plt.show()
 
   if args.nearest_neighbor:
-    min_dist_per_cnt, pair_min_dist = min_neighbor_distance(fibers, mode='fine', n=1000)
+    min_dist_per_cnt, pairs, pair_min_dist = min_neighbor_distance(fibers, mode=args.distance_mode, cutoff=args.neighbor_cutoff)
+    print(f'number of fiber pairs closer than {args.neighbor_cutoff} nm: {pairs.shape[0]}')
 
     fig = plt.figure()
     ax = fig.add_subplot(1, 1, 1)
@@ -300,16 +354,7 @@ def main():
     y = fiber_diameter*np.sin(theta)
     ax.plot(x, y)
     
-    cnt_pos = []
-    cnt_orient = []
-
-    for fib in tqdm(fibers):
-      p, o, c = create_single_CNTs(fib, coor)
-      cnt_pos.append(p)
-      cnt_orient.append(o)
-
-    cnt_pos = np.array(cnt_pos)
-    cnt_orient = np.array(cnt_orient)
+    cnt_pos, cnt_orient, _ = create_CNTs(fibers, coor)
 
     # fig = plt.figure()
     # ax = fig.add_subplot(1, 1, 1, projection='3d')
@@ -376,75 +421,23 @@ def main():
     coor = util.HCP_coordinates(fiber_diameter, cnt_diameter)
     print(f'number of cnts per fiber: {coor.shape[0]}')
 
-    cnt_pos = []
-    cnt_orient = []
-    cnt_chiral = []
-
-    for fib in tqdm(fibers):
-      p, o, c = create_single_CNTs(fib, coor)
-      cnt_pos.append(p)
-      cnt_orient.append(o)
-      cnt_chiral.append(c)
-
-    cnt_pos = np.array(cnt_pos)
-    cnt_orient = np.array(cnt_orient)
-    cnt_chiral = np.array(cnt_chiral)
-    
-    coor_per_cnt = cnt_pos.shape[2]
-    cnt_pos = cnt_pos.reshape((-1, coor_per_cnt, 3))
-    cnt_orient = cnt_orient.reshape((-1, coor_per_cnt, 3))
-    cnt_chiral = cnt_chiral.reshape((-1, coor_per_cnt, 2))
-
-    
-    header = 'ARMA_MAT_TXT_FN008\n'
-    # header += f'{cnt_pos.shape[0]} {cnt_pos.shape[1]}\n'
-    header += f'{cnt_pos.shape[0]} {cnt_pos.shape[1]}'
-    # header += f'fiber diameter: {fiber_diameter}, cnt diameter: {cnt_diameter}'
-    fmt = "%+.4e"
-    cmts = ""
-
-    filename = os.path.join(directory, "single_cnt.pos.x.dat")
-    np.savetxt(filename, cnt_pos[:, :, 0], header=header, fmt=fmt, comments=cmts)
-    
-    filename = os.path.join(directory, "single_cnt.pos.y.dat")
-    np.savetxt(filename, cnt_pos[:, :, 1], header=header, fmt=fmt, comments=cmts)
-
-    filename = os.path.join(directory, "single_cnt.pos.z.dat")
-    np.savetxt(filename, cnt_pos[:, :, 2], header=header, fmt=fmt, comments=cmts)
-
-    filename = os.path.join(directory, "single_cnt.chiral.1.dat")
-    np.savetxt(filename, cnt_chiral[:, :, 0], header=header, fmt=fmt, comments=cmts)
-    
-    filename = os.path.join(directory, "single_cnt.chiral.2.dat")
-    np.savetxt(filename, cnt_chiral[:, :, 1], header=header, fmt=fmt, comments=cmts)
-
-    filename = os.path.join(directory, "single_cnt.pos.x")
-    np.save(filename, cnt_pos[:, :, 0])
-
-    filename = os.path.join(directory, "single_cnt.pos.y")
-    np.save(filename, cnt_pos[:, :, 1])
+    fmt = mesh_io.ARMA_FULL_PRECISION_FORMAT if args.full_precision else mesh_io.ARMA_TEXT_FORMAT
+    binary = args.cnt_format == 'binary'
 
-    filename = os.path.join(directory, "single_cnt.pos.z")
-    np.save(filename, cnt_pos[:, :, 2])
-
-    filename = os.path.join(directory, "single_cnt.orient.x.dat")
-    np.savetxt(filename, cnt_orient[:, :, 0], header=header, fmt=fmt, comments=cmts)
-
-    filename = os.path.join(directory, "single_cnt.orient.y.dat")
-    np.savetxt(filename, cnt_orient[:, :, 1], header=header, fmt=fmt, comments=cmts)
-
-    filename = os.path.join(directory, "single_cnt.orient.z.dat")
-    np.savetxt(filename, cnt_orient[:, :, 2], header=header, fmt=fmt, comments=cmts)
+    writer = None
+    for cnt_pos, cnt_orient, cnt_chiral in tqdm(create_CNT_chunks(fibers, coor, args.chunk_size, args.workers, args.compact), total=-(-len(fibers)//args.chunk_size)):
+      if writer is None:
+        writer = mesh_io.SingleCNTWriter(directory, len(fibers)*coor.shape[0], cnt_pos.shape[1], binary=binary, fmt=fmt, compact=args.compact, n_fiber=len(fibers))
+      writer.write(cnt_pos, cnt_orient, cnt_chiral)
+    if writer is not None:
+      writer.close()
+      print(f'number of cnts written: {len(fibers)*coor.shape[0]}')
 
   if args.check_npy_files:
 
-    filename = os.path.join(directory, "single_cnt.pos.x.npy")
-    if os.path.exists(filename):
-      x = np.load(filename)
-      filename = os.path.join(directory, "single_cnt.pos.y.npy")
-      y = np.load(filename)
-      filename = os.path.join(directory, "single_cnt.pos.z.npy")
-      z = np.load(filename)
+    cnt_pos = mesh_io.open_single_cnt_arrays(directory, 'pos')
+    if cnt_pos is not None:
+      x, y, z = cnt_pos
 
       for i in range(x.shape[1]):
         print(x[0,i], y[0,i], z[0,i])
@@ -452,109 +445,124 @@ def main():
       print('--check_npy_files can only be used after the interpolated CNTS are generated.')
 
   if args.trim:
-    if args.create_cnts:
-      xlim = [[f.x('fine').min() for f in fibers],
-              [f.x('fine').max() for f in fibers]]
-      xlim = np.array(xlim)
-      xlim = (xlim[0,:].min(), xlim[1,:].max())
-      
-      ylim = [[f.y('fine').min() for f in fibers],
-              [f.y('fine').max() for f in fibers]]
-      ylim = np.array(ylim)
-      ylim = (ylim[0, :].min(), ylim[1, :].max())
-
-      zlim = [[f.z('fine').min() for f in fibers],
-              [f.z('fine').max() for f in fibers]]
-      zlim = np.array(zlim)
-      zlim = (zlim[0, :].min(), zlim[1, :].max())
-
-      ylim = (0, ylim[1])
-
-      print(f'xlim: {xlim[0]} , {xlim[1]}')
-      print(f'ylim: {ylim[0]} , {ylim[1]}')
-      print(f'zlim: {zlim[0]} , {zlim[1]}')
-
-      nx, ny, nz = 10, 10, 10
-      dx, dy, dz = (xlim[1]-xlim[0])/nx, (ylim[1]-ylim[0])/ny, (zlim[1]-zlim[0])/nz
-
-      print(dx, dy, dz)
-
-
-
-      hist = np.zeros((nx, ny, nz), dtype=int)
-      for f in tqdm(fibers):
-        ix, iy, iz = ((f.x('fine')-xlim[0])/dx).astype(int).clip(0,nx-1), ((f.y('fine')-ylim[0])/dy).astype(int).clip(0,ny-1), ((f.z('fine')-zlim[0])/dz).astype(int).clip(0,nz-1)
-
-        # for i in range(len(ix)):
-        #   hist[ix[i], iy[i], iz[i]] += 1
-        for i in zip(ix, iy, iz):
-          hist[i] += 1
+    cnt_pos = mesh_io.open_single_cnt_arrays(directory, 'pos')
+    if cnt_pos is not None:
+      n_cnt = cnt_pos[0].shape[0]
+      r_min, r_max = np.array([c.min() for c in cnt_pos]), np.array([c.max() for c in cnt_pos])
+      shape = np.maximum(1, np.ceil((r_max-r_min)/args.voxel_size)).astype(int)
+      print(f'number of voxels: {shape[0]} x {shape[1]} x {shape[2]}')
+
+      chunks = (np.stack([c[i:i+args.chunk_size] for c in cnt_pos], axis=-1) for i in range(0, n_cnt, args.chunk_size))
+      hist = spatial.voxel_counts(tqdm(chunks, total=-(-n_cnt//args.chunk_size)), r_min, args.voxel_size, shape)
+
+      start, stop = spatial.dense_box(hist, threshold=args.trim_threshold)
+      lower, upper = r_min + start*args.voxel_size, np.minimum(r_max, r_min + stop*args.voxel_size)
+      print(f'xlim: {lower[0]} , {upper[0]}')
+      print(f'ylim: {lower[1]} , {upper[1]}')
+      print(f'zlim: {lower[2]} , {upper[2]}')
+
+      output_directory = args.trim_output or os.path.join(directory, 'trimmed')
+      fmt = mesh_io.ARMA_FULL_PRECISION_FORMAT if args.full_precision else mesh_io.ARMA_TEXT_FORMAT
+      limits = np.stack((r_min, r_max), axis=1).tolist()
+      report = {'voxel size [nm]': args.voxel_size, 'density threshold': args.trim_threshold,
+                'mesh limits': {'xlim': limits[0], 'ylim': limits[1], 'zlim': limits[2]}}
+      report = mesh_io.trim_single_cnt(directory, output_directory, lower, upper, chunk_size=args.chunk_size,
+                                       binary=args.cnt_format == 'binary', fmt=fmt, report=report)
+      print(f'number of cnts kept: {report["number of cnts"]["output"]} of {report["number of cnts"]["input"]}')
+      print(f'trimmed mesh written to: {output_directory}')
+    else:
+      print("--trim can only be used after the interpolated CNTS are generated (or together with --create_cnts)")
+
+  if args.mc_input:
+    if mesh_io.open_single_cnt_arrays(directory, 'pos') is not None:
+      lower, upper, halo = mesh_io.read_mc_trim_limits(args.mc_input)
+      print(f'trim limits of the monte carlo input: x ({lower[0]}, {upper[0]}), y ({lower[1]}, {upper[1]}), z ({lower[2]}, {upper[2]}) [nm]')
+      print(f'halo of the max hopping radius: {halo} [nm]')
+
+      output_directory = args.mc_output or os.path.join(directory, 'mc_trimmed')
+      fmt = mesh_io.ARMA_FULL_PRECISION_FORMAT if args.full_precision else mesh_io.ARMA_TEXT_FORMAT
+      report = {'monte carlo input': os.path.abspath(args.mc_input), 'halo [nm]': halo}
+      report = mesh_io.trim_single_cnt(directory, output_directory, lower-halo, upper+halo, chunk_size=args.chunk_size,
+                                       binary=args.cnt_format == 'binary', fmt=fmt, report=report)
+      print(f'number of cnts kept: {report["number of cnts"]["output"]} of {report["number of cnts"]["input"]}')
+      print(f'mesh for the monte carlo input written to: {output_directory}')
+    else:
+      print("--mc_input can only be used after the interpolated CNTS are generated (or together with --create_cnts)")
 
-      hist = hist.swapaxes(0,1)
-      print(hist)
+  if args.tile:
+    if mesh_io.open_single_cnt_arrays(directory, 'pos') is not None:
+      index = mesh_io.write_tiled_mesh(directory, tile_size=args.tile_size, chunk_size=args.chunk_size)
+      print(f'number of non-empty tiles: {len(index["tiles"]["count"])} of {np.prod(index["shape"])}')
+    else:
+      print("--tile can only be used after the interpolated CNTS are generated (or together with --create_cnts)")
+
+  if args.neighbor_list:
+    if mesh_io.open_single_cnt_arrays(directory, 'pos') is not None:
+      radius = args.hopping_radius
+      if radius is None:
+        radius = mesh_io.read_mc_trim_limits(args.mc_input)[2] if args.mc_input else 20.
+      info = mesh_io.write_neighbor_list(directory, radius=radius, same_cnt=args.same_cnt_pairs)
+      n_point = info['number of cnts']*info['number of points per cnt']
+      print(f'number of neighbor pairs within {radius} nm: {info["number of pairs"]:.2e} ({info["number of pairs"]/max(1, n_point):.1f} per point)')
+    else:
+      print("--neighbor_list can only be used after the interpolated CNTS are generated (or together with --create_cnts)")
 
-      print(np.sum(hist))
+  if args.hopping_geometry:
+    if os.path.exists(os.path.join(directory, mesh_io.NEIGHBOR_LIST)):
+      axes = mesh_io.read_mc_table_axes(args.hopping_geometry)
+      info = mesh_io.write_hopping_geometry(directory, axes)
+      print(f'hopping geometry of {info["number of pairs"]:.2e} pairs written to: {directory}')
     else:
-      print("--trim must be used together with --create_cnts")
-    
-  if args.random_mesh:
-    xlen = 2000
-    ylen = 100
-    zlen = 2000
+      print("--hopping_geometry can only be used after the neighbor list is generated (or together with --neighbor_list)")
 
-    num_point = int(1.e7)
+  if args.random_mesh:
+    xlen, ylen, zlen = args.box
 
     volume = xlen * ylen * zlen
+    num_point = int(args.density * volume) if args.density is not None else int(args.num_points)
     print(f'total volume: {volume:.2e} [nm^3]')
     print(f'number of points: {num_point:.2e}')
     print(f'density: {num_point/volume} [nm^-3]')
 
-    cnt_pos = np.random.rand(num_point, 3)
-    cnt_pos *= np.array([xlen, ylen, zlen])
-    
-    cnt_orient_polar = np.random.rand(num_point, 2)
-    cnt_orient_polar[:, 0] = np.arccos(1-2*cnt_orient_polar[:, 0])
-    cnt_orient_polar[:, 1] *= 2*np.pi
-
-    cnt_orient = np.zeros((num_point, 3))
-    cnt_orient[:, 0] = np.sin(cnt_orient_polar[:, 0]) * np.cos(cnt_orient_polar[:, 1])
-    cnt_orient[:, 1] = np.sin(cnt_orient_polar[:, 0]) * np.sin(cnt_orient_polar[:, 1])
-    cnt_orient[:, 2] = np.cos(cnt_orient_polar[:, 0])
-
     directory = os.path.expanduser('../random_mesh')
     if (not os.path.exists(directory)):
       os.makedirs(directory)
-    
-    header = 'ARMA_MAT_TXT_FN008\n'
-    # header += f'{cnt_pos.shape[0]} {cnt_pos.shape[1]}\n'
-    header += f'{cnt_pos.shape[0]} 1'
-    # header += f'density: {num_point/volume} [nm^-3]'
-    fmt = "%+.4e"
-    cmts = ""
-
-    filename = os.path.join(directory, "single_cnt.pos.x.dat")
-    np.savetxt(filename, cnt_pos[:, 0], header=header, fmt=fmt, comments=cmts)
-
-    filename = os.path.join(directory, "single_cnt.pos.y.dat")
-    np.savetxt(filename, cnt_pos[:, 1], header=header, fmt=fmt, comments=cmts)
-
-    filename = os.path.join(directory, "single_cnt.pos.z.dat")
-    np.savetxt(filename, cnt_pos[:, 2], header=header, fmt=fmt, comments=cmts)
 
-    filename = os.path.join(directory, "single_cnt.orient.x.dat")
-    np.savetxt(filename, cnt_orient[:, 0], header=header, fmt=fmt, comments=cmts)
-
-    filename = os.path.join(directory, "single_cnt.orient.y.dat")
-    np.savetxt(filename, cnt_orient[:, 1], header=header, fmt=fmt, comments=cmts)
-
-    filename = os.path.join(directory, "single_cnt.orient.z.dat")
-    np.savetxt(filename, cnt_orient[:, 2], header=header, fmt=fmt, comments=cmts)
+    fmt = mesh_io.ARMA_FULL_PRECISION_FORMAT if args.full_precision else mesh_io.ARMA_TEXT_FORMAT
+    mesh_io.write_random_mesh(directory, num_point, (xlen, ylen, zlen), seed=args.seed, workers=args.workers,
+                              chunk_size=args.points_per_chunk, binary=args.cnt_format == 'binary', fmt=fmt)
 
     # fig = plt.figure()
     # ax = fig.add_subplot('111', projection='3d')
     # ax.plot(cnt_pos[:,2], cnt_pos[:, 0], cnt_pos[:,1], linestyle='none', marker='.')
     # plt.show()
 
+  if args.synthetic_mesh:
+    chiralities = args.chirality or [[4, 2]]
+    if args.chirality_probability is not None and len(args.chirality_probability) != len(chiralities):
+      print("error: --chirality_probability needs one probability per --chirality!")
+      quit()
+
+    directory = os.path.expanduser('../synthetic_mesh')
+    if (not os.path.exists(directory)):
+      os.makedirs(directory)
+
+    info = mesh_io.write_synthetic_mesh(directory, int(args.num_fibers), args.sections, args.box, section_length=args.section_length,
+                                        bending=args.bending, chiralities=chiralities, probabilities=args.chirality_probability,
+                                        seed=args.seed, workers=args.workers)
+    print(f'number of fibers: {info["number of fibers"]:.2e}')
+    print(f'number of sections: {info["number of sections"]:.2e}')
+    print(f'synthetic mesh written to: {directory}')
+
+  if args.compute_histogram:
+    if mesh_io.open_single_cnt_arrays(directory, 'pos') is not None:
+      # each row of the single cnt mesh is one CNT; pairs of points within the same CNT are not counted
+      counts = mesh_io.single_cnt_distance_histogram(directory, r_max=50., bins=args.histogram_bins, workers=args.workers, chunk_size=args.chunk_size)
+      mesh_io.write_histogram(os.path.join(directory, 'histogram.dat'), counts)
+      print(f'number of pairs counted: {counts.sum():.2e}')
+    else:
+      print('--compute_histogram can only be used after the interpolated CNTS are generated.')
+
   if args.histogram:
     src_filename = os.path.join(directory, 'histogram.dat')
     i = 0
@@ -0,0 +1,1256 @@
+import numpy as np
+import os
+import re
+import json
+import hashlib
+import shutil
+import tempfile
+import zipfile
+import util
+import spatial
+from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Tuple
+
+"""
+# Readers and writers for the mesh files produced by BulletPhysics and the python post-processing
+"""
+
+_TUBE_FILE_PATTERN = re.compile(r'^tube(\d+)\.pos\.dat$')
+
+# removes the leading "tube number: N ;" column of every line
+_TUBE_NUMBER_COLUMN = re.compile(r'^[^;\n]*;', flags=re.MULTILINE)
+
+# captures the first section of every line after the "tube number: N ;" column
+_FIRST_SECTION = re.compile(r'^[^;\n]*;([^;\n]*)', flags=re.MULTILINE)
+
+_SEPARATORS = str.maketrans(';,', '  ')
+
+# name of the binary cache of the parsed tube files that is kept in the mesh directory
+FIBER_CACHE = 'fibers.cache.npz'
+_FIBER_CACHE_VERSION = 1
+
+def tube_files(directory: str) -> List[Tuple[str, str]]:
+  '''
+  Find all the pairs of tube{i}.pos.dat and tube{i}.chiral.dat files in a directory
+
+  Parameters:
+    directory (str): input directory
+
+  Returns:
+    list((str, str)): (position filename, chirality filename) pairs sorted by the file number i
+  '''
+  numbers = []
+  for name in os.listdir(directory):
+    match = _TUBE_FILE_PATTERN.match(name)
+    if match:
+      numbers.append(int(match.group(1)))
+
+  files = []
+  for i in sorted(numbers):
+    filename_pos = os.path.join(directory, f'tube{i}.pos.dat')
+    filename_chiral = os.path.join(directory, f'tube{i}.chiral.dat')
+    if (not os.path.isfile(filename_pos) or not os.path.isfile(filename_chiral)):
+      continue
+    files.append((filename_pos, filename_chiral))
+
+  return files
+
+def parse_tube_file(filename_pos: str, filename_chiral: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  '''
+  Parse one pair of tube{i}.pos.dat / tube{i}.chiral.dat files in a single pass.
+  Each line of the position file holds the section coordinates of one fiber as "tube number: N ; x , y , z ; x , y , z ; ..."
+  and the chirality file holds the chirality of the same sections as "tube number: N ; n , m ; n , m ; ...".
+
+  Parameters:
+    filename_pos (str): path to the tube{i}.pos.dat file
+    filename_chiral (str): path to the tube{i}.chiral.dat file
+
+  Returns:
+    tuple of (r, offsets, chiral):
+      r: np.ndarray of shape (N,3) with the section coordinates of all fibers in the file
+      offsets: np.ndarray of shape (n_fibers+1,) so that r[offsets[i]:offsets[i+1]] are the sections of fiber i
+      chiral: np.ndarray of shape (n_fibers,2) with the chirality of the first section of each fiber
+  '''
+  with open(filename_pos) as file:
+    lines = [line for line in file.read().splitlines() if line.strip('; ')]
+  text = _TUBE_NUMBER_COLUMN.sub('', '\n'.join(lines))
+
+  counts = np.fromiter((line.count(',') for line in text.splitlines()), dtype=np.int64, count=len(lines))
+  if np.any(counts % 2):
+    raise ValueError(f'malformed coordinates in {filename_pos}')
+  offsets = np.zeros(len(lines)+1, dtype=np.int64)
+  np.cumsum(counts//2, out=offsets[1:])
+
+  r = np.fromstring(text.translate(_SEPARATORS), sep=' ')
+  if r.size != 3*offsets[-1]:
+    raise ValueError(f'malformed coordinates in {filename_pos}')
+  r = r.reshape((-1, 3))
+
+  with open(filename_chiral) as file:
+    first_sections = _FIRST_SECTION.findall(file.read())
+  if len(first_sections) < len(lines):
+    raise ValueError(f'{filename_chiral} has fewer fibers than {filename_pos}')
+  chiral = np.fromstring(' '.join(first_sections[:len(lines)]).translate(_SEPARATORS), sep=' ')
+  if chiral.size != 2*len(lines):
+    raise ValueError(f'malformed chirality in {filename_chiral}')
+  chiral = chiral.reshape((-1, 2))
+
+  return r, offsets, chiral
+
+def _parse_tube_file_pair(filenames):
+  return parse_tube_file(*filenames)
+
+def read_tube_files(files: List[Tuple[str, str]], workers=None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  '''
+  Parse a list of tube{i}.pos.dat / tube{i}.chiral.dat files in parallel and concatenate the results in the order of the list
+
+  Parameters:
+    files (list((str, str))): (position filename, chirality filename) pairs, as returned by `tube_files`
+    workers (int): number of worker processes. None uses all the cores and 1 parses the files serially in this process.
+
+  Returns:
+    tuple of (r, offsets, chiral) with the same layout as `parse_tube_file` for all the fibers in all the files
+  '''
+  if workers == 1 or len(files) < 2:
+    parsed = [parse_tube_file(*f) for f in files]
+  else:
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      parsed = list(executor.map(_parse_tube_file_pair, files))
+
+  if len(parsed) == 0:
+    return np.zeros((0, 3)), np.zeros(1, dtype=np.int64), np.zeros((0, 2))
+
+  r = np.concatenate([p[0] for p in parsed])
+  chiral = np.concatenate([p[2] for p in parsed])
+  offsets = [parsed[0][1]]
+  for p in parsed[1:]:
+    offsets.append(p[1][1:] + offsets[-1][-1])
+  offsets = np.concatenate(offsets)
+
+  return r, offsets, chiral
+
+def write_tube_file(filename_pos: str, filename_chiral: str, r: np.ndarray, offsets: np.ndarray, chiral: np.ndarray, first_number=1):
+  '''
+  Write one pair of tube{i}.pos.dat / tube{i}.chiral.dat files in the format of cnt_mesh::save_one_tube, which `parse_tube_file` reads.
+  The coordinates are formatted by array operations, see `_scientific_fields`.
+
+  Parameters:
+    filename_pos (str): path to the tube{i}.pos.dat file
+    filename_chiral (str): path to the tube{i}.chiral.dat file
+    r, offsets, chiral: fibers with the same layout as the output of `parse_tube_file`
+    first_number (int): tube number of the first fiber, the tube numbers continue across the files of a mesh
+  '''
+  n_fiber = len(offsets)-1
+  numbers = _scientific_fields(np.asarray(r, dtype=float).ravel(), 6)
+  if numbers is not None:
+    # each section is "x , y , z ; " with fixed width numbers
+    width = numbers.shape[1]
+    numbers = numbers.reshape((-1, 3, width))
+    fields = np.empty((numbers.shape[0], 3, width+3), dtype=np.uint8)
+    fields[:, :, :width] = numbers
+    fields[:, :, width:] = np.frombuffer(b' , ', dtype=np.uint8)
+    fields[:, 2, width+1] = ord(';')
+    buffer, size = fields.tobytes(), 3*(width+3)
+    sections = lambda i: buffer[offsets[i]*size:offsets[i+1]*size]
+  else:
+    text = [(' , '.join('%+e' % x for x in p) + ' ; ').encode() for p in r]
+    sections = lambda i: b''.join(text[offsets[i]:offsets[i+1]])
+
+  with open(filename_pos, 'wb') as file:
+    file.write(b''.join(b'tube number: %+d ; %s\n' % (first_number+i, sections(i)) for i in range(n_fiber)))
+
+  with open(filename_chiral, 'wb') as file:
+    file.write(b''.join(b'tube number: %+d ; %s\n' % (first_number+i, b'%+d , %+d ; ' % tuple(int(c) for c in chiral[i]) * int(offsets[i+1]-offsets[i]))
+                        for i in range(n_fiber)))
+
+def file_fingerprint(filename: str, hash=True) -> dict:
+  '''
+  Get the fingerprint of a file used to decide if a cache built from it is still valid
+
+  Parameters:
+    filename (str): path to the file
+    hash (bool): if True, include the sha1 hash of the file content
+
+  Returns:
+    dict with the base name, size, modification time (ns) and optionally sha1 hash of the file
+  '''
+  stat = os.stat(filename)
+  fingerprint = {'name': os.path.basename(filename), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+  if hash:
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as file:
+      for block in iter(lambda: file.read(1 << 24), b''):
+        sha1.update(block)
+    fingerprint['sha1'] = sha1.hexdigest()
+  return fingerprint
+
+def _cache_is_valid(key: dict, files: List[Tuple[str, str]]) -> Tuple[bool, bool]:
+  '''
+  Check the fingerprints stored in a cache against the current tube files.
+  The content hash is only recomputed for files whose size matches but whose modification time changed; if the hash
+  still matches, the new modification time is stored in the key, so the file is not hashed again by the next runs.
+
+  Returns:
+    tuple of (valid, touched): whether the cache is valid and whether the modification time of any fingerprint was updated
+  '''
+  if key.get('version') != _FIBER_CACHE_VERSION:
+    return False, False
+  filenames = [name for pair in files for name in pair]
+  if [f['name'] for f in key['files']] != [os.path.basename(name) for name in filenames]:
+    return False, False
+  touched = False
+  for stored, filename in zip(key['files'], filenames):
+    current = file_fingerprint(filename, hash=False)
+    if current['size'] != stored['size']:
+      return False, False
+    if current['mtime'] != stored['mtime']:
+      if file_fingerprint(filename)['sha1'] != stored['sha1']:
+        return False, False
+      stored['mtime'] = current['mtime']
+      touched = True
+  return True, touched
+
+def _write_fiber_cache(cache_filename: str, key: dict, r: np.ndarray, offsets: np.ndarray, chiral: np.ndarray):
+  '''
+  Write the fiber cache through a temporary file, so an interrupted run does not leave a broken cache behind
+  '''
+  try:
+    temp_filename = cache_filename + '.tmp'
+    with open(temp_filename, 'wb') as file:
+      np.savez(file, key=np.array(json.dumps(key)), r=r, offsets=offsets, chiral=chiral)
+    os.replace(temp_filename, cache_filename)
+  except OSError as e:
+    print(f'warning: could not write cache {cache_filename}: {e}')
+
+def read_fiber_arrays(directory: str, workers=None, rebuild_cache=False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  '''
+  Read the rough mesh of all the fibers in a directory. The parsed arrays are stored in a binary cache (FIBER_CACHE)
+  in the same directory, which is reused as long as the size, modification time and hash of the tube files do not change.
+
+  Parameters:
+    directory (str): input directory
+    workers (int): number of processes used to parse the tube files when the cache is rebuilt
+    rebuild_cache (bool): if True, parse the tube files and rebuild the cache even if it is valid
+
+  Returns:
+    tuple of (r, offsets, chiral) with the same layout as `parse_tube_file` for all the fibers in the directory
+  '''
+  files = tube_files(directory)
+  cache_filename = os.path.join(directory, FIBER_CACHE)
+
+  if not rebuild_cache and os.path.isfile(cache_filename):
+    try:
+      with np.load(cache_filename) as cache:
+        key = json.loads(str(cache['key']))
+        valid, touched = _cache_is_valid(key, files)
+        if valid:
+          print(f'reading cache: {cache_filename}')
+          r, offsets, chiral = cache['r'], cache['offsets'], cache['chiral']
+      if valid:
+        # only the modification times changed (touch, copy, checkout): store them, so the files are not hashed again
+        if touched:
+          _write_fiber_cache(cache_filename, key, r, offsets, chiral)
+        return r, offsets, chiral
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+      print(f'warning: ignoring unreadable cache {cache_filename}: {e}')
+
+  for filename_pos, filename_chiral in files:
+    print(f'reading file: {filename_pos}, {filename_chiral}')
+  r, offsets, chiral = read_tube_files(files, workers=workers)
+
+  key = {'version': _FIBER_CACHE_VERSION, 'files': [file_fingerprint(name) for pair in files for name in pair]}
+  _write_fiber_cache(cache_filename, key, r, offsets, chiral)
+
+  return r, offsets, chiral
+
+def write_histogram(filename: str, counts: np.ndarray):
+  '''
+  Write a pair distance histogram in the format of the histogram.dat file of the cpp_analyze code:
+  a single line with the comma separated counts of each bin followed by a trailing comma
+
+  Parameters:
+    filename (str): output filename
+    counts (np.ndarray): number of pairs in each bin
+  '''
+  with open(filename, 'w') as file:
+    file.write(','.join(str(c) for c in np.asarray(counts, dtype=np.int64)) + ',\n')
+
+# formats of the single_cnt.*.dat files that arma::mat::load detects from the header
+ARMA_TEXT_FORMAT = '%+.4e'
+ARMA_FULL_PRECISION_FORMAT = '%+.16e'
+
+# number of values formatted at once by the text writer
+_TEXT_BLOCK_SIZE = 1 << 20
+
+def save_arma_matrix(filename: str, matrix: np.ndarray, binary=False, fmt=ARMA_TEXT_FORMAT):
+  '''
+  Save a 2d array in one of the Armadillo matrix formats that arma::mat::load reads without being told the format.
+  The text output is the same, byte for byte, as np.savetxt with the ARMA_MAT_TXT_FN008 header, but blocks of rows are
+  formatted with a single string operation instead of one per row.
+
+  Parameters:
+    filename (str): output filename
+    matrix (np.ndarray): 2d array, or 1d array that is written as a single column
+    binary (bool): if True, write ARMA_MAT_BIN_FN008 (the header followed by the raw doubles in column major order),
+                   which always keeps the full double precision. Otherwise write ARMA_MAT_TXT_FN008 text with the format fmt.
+    fmt (str): number format of the text output
+  '''
+  matrix = np.asarray(matrix, dtype=np.float64)
+  if matrix.ndim == 1:
+    matrix = matrix[:, np.newaxis]
+  with ArmaMatrixWriter(filename, matrix.shape, binary=binary, fmt=fmt) as writer:
+    writer.write(matrix)
+
+class ArmaMatrixWriter:
+  '''
+  Write an Armadillo matrix file (see `save_arma_matrix`) in blocks of rows, so the whole matrix never has to be in memory.
+  The shape is written in the header up front; the binary format is column major, so its blocks are written
+  into a memory map of the preallocated file.
+  '''
+  def __init__(self, filename: str, shape: Tuple[int, int], binary=False, fmt=ARMA_TEXT_FORMAT):
+    self._shape = tuple(shape)
+    self._binary = binary
+    self._fmt = fmt
+    self._row_fmt = ' '.join([fmt]*self._shape[1]) + '\n'
+    self._rows = 0
+
+    header = f'{self._shape[0]} {self._shape[1]}'
+    if binary:
+      header = f'ARMA_MAT_BIN_FN008\n{header}\n'.encode()
+      with open(filename, 'wb') as file:
+        file.write(header)
+        file.truncate(len(header) + 8*self._shape[0]*self._shape[1])
+      self._data = None
+      if self._shape[0]*self._shape[1] > 0:
+        self._data = np.memmap(filename, dtype=np.float64, mode='r+', offset=len(header), shape=self._shape, order='F')
+    else:
+      self._file = open(filename, 'wb')
+      self._file.write(f'ARMA_MAT_TXT_FN008\n{header}\n'.encode())
+
+  def write(self, rows: np.ndarray):
+    '''
+    Append a block of rows to the matrix
+
+    Parameters:
+      rows (np.ndarray): array of shape (m, number of columns)
+    '''
+    rows = np.asarray(rows, dtype=np.float64).reshape((-1, self._shape[1]))
+    if self._rows + rows.shape[0] > self._shape[0]:
+      raise ValueError(f'more than {self._shape[0]} rows written to the matrix')
+    if self._binary:
+      if rows.shape[0] > 0:
+        self._data[self._rows:self._rows+rows.shape[0]] = rows
+    else:
+      rows_per_block = max(1, _TEXT_BLOCK_SIZE // max(1, self._shape[1]))
+      for start in range(0, rows.shape[0], rows_per_block):
+        block = rows[start:start+rows_per_block]
+        text = _format_e4(block) if self._fmt == ARMA_TEXT_FORMAT else None
+        if text is None:
+          text = ((self._row_fmt*block.shape[0]) % tuple(block.ravel().tolist())).encode()
+        self._file.write(text)
+    self._rows += rows.shape[0]
+
+  def close(self):
+    if self._binary:
+      if self._data is not None:
+        self._data.flush()
+        self._data = None
+    else:
+      self._file.close()
+    if self._rows != self._shape[0]:
+      raise ValueError(f'{self._rows} rows written to a matrix with {self._shape[0]} rows')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    elif self._binary:
+      self._data = None
+    else:
+      self._file.close()
+
+def _scientific_fields(x: np.ndarray, precision: int):
+  '''
+  Format a 1d array of doubles as '%+.{precision}e' with the digits calculated by array operations, one row of characters per value.
+  Values that are within rounding error of halfway between two mantissas are formatted one by one by python, so the result is
+  the same as the C formatting. Returns None if the array has values that do not fit the fixed width of precision+7 characters
+  (inf, nan or exponents beyond +-99), in which case the caller falls back to the string formatting.
+  '''
+  magnitude = np.abs(x)
+  if not np.all(np.isfinite(x)) or np.any((magnitude >= 1e99) | ((magnitude < 1e-99) & (magnitude > 0))):
+    return None
+
+  nonzero = magnitude > 0
+  exponent = np.zeros(x.shape, dtype=np.int64)
+  exponent[nonzero] = np.floor(np.log10(magnitude[nonzero])).astype(np.int64)
+
+  def scale(exponent):
+    shift = (precision-exponent).astype(float)
+    return np.where(shift >= 0, magnitude*10.**np.abs(shift), magnitude/10.**np.abs(shift))
+
+  # log10 can be off by one next to the powers of 10
+  lower, upper = 10**precision, 10**(precision+1)
+  mantissa = scale(exponent)
+  exponent += (mantissa >= upper).astype(np.int64) - ((mantissa < lower) & nonzero).astype(np.int64)
+  mantissa = scale(exponent)
+
+  digits = np.floor(mantissa+0.5).astype(np.int64)
+  overflow = digits >= upper
+  digits[overflow] = lower
+  exponent[overflow] += 1
+  if np.any(np.abs(exponent) > 99):
+    return None
+
+  fields = np.empty((x.size, precision+7), dtype=np.uint8)
+  fields[:, 0] = np.where(np.signbit(x), ord('-'), ord('+'))
+  fields[:, 1] = ord('0') + digits//lower
+  fields[:, 2] = ord('.')
+  for i in range(precision):
+    fields[:, 3+i] = ord('0') + (digits//10**(precision-1-i)) % 10
+  fields[:, precision+3] = ord('e')
+  fields[:, precision+4] = np.where(exponent < 0, ord('-'), ord('+'))
+  fields[:, precision+5] = ord('0') + np.abs(exponent)//10
+  fields[:, precision+6] = ord('0') + np.abs(exponent) % 10
+
+  ties = np.flatnonzero(np.abs(mantissa - np.floor(mantissa) - 0.5) < 1e-6)
+  for i in ties:
+    fields[i] = np.frombuffer(('%+.*e' % (precision, x[i])).encode(), dtype=np.uint8)
+
+  return fields
+
+def _format_e4(block: np.ndarray):
+  '''
+  Format a 2d block of doubles as rows of '%+.4e' separated by spaces, see `_scientific_fields`. Returns None if the
+  block has values that do not fit the fixed width of 11 characters, in which case the caller falls back to the string formatting.
+  '''
+  numbers = _scientific_fields(block.ravel(), 4)
+  if numbers is None:
+    return None
+
+  fields = np.empty((numbers.shape[0], 12), dtype=np.uint8)
+  fields[:, :11] = numbers
+  fields[:, 11] = ord(' ')
+  fields.reshape((block.shape[0], -1))[:, -1] = ord('\n')
+  return fields.tobytes()
+
+def save_arma_matrices(outputs: List[Tuple[str, np.ndarray]], binary=False, fmt=ARMA_TEXT_FORMAT, workers=None):
+  '''
+  Save several matrices with `save_arma_matrix` concurrently from a pool of threads, so that writing one file overlaps with formatting the others
+
+  Parameters:
+    outputs (list((str, np.ndarray))): (filename, matrix) pairs
+    binary (bool): write the Armadillo binary format instead of text
+    fmt (str): number format of the text output
+    workers (int): number of threads. None uses one thread per file.
+  '''
+  with ThreadPoolExecutor(max_workers=workers or max(1, len(outputs))) as executor:
+    futures = [executor.submit(save_arma_matrix, filename, matrix, binary, fmt) for filename, matrix in outputs]
+    for future in futures:
+      future.result()
+
+def load_arma_matrix(filename: str) -> np.ndarray:
+  '''
+  Load a matrix written by `save_arma_matrix` in either the text or the binary Armadillo format
+
+  Parameters:
+    filename (str): input filename
+
+  Returns:
+    np.ndarray: 2d array of doubles
+  '''
+  with open(filename, 'rb') as file:
+    kind = file.readline().strip()
+    rows, cols = (int(n) for n in file.readline().split())
+    if kind == b'ARMA_MAT_BIN_FN008':
+      data = np.fromfile(file, dtype=np.float64, count=rows*cols)
+      return data.reshape((rows, cols), order='F')
+    if kind == b'ARMA_MAT_TXT_FN008':
+      return np.loadtxt(file, ndmin=2).reshape((rows, cols))
+  raise ValueError(f'{filename} is not an Armadillo matrix file')
+
+class SingleCNTWriter:
+  '''
+  Write the single_cnt.* files of a CNT mesh chunk by chunk, as the CNTs are created.
+  Every row of the files is one CNT and every column a point along the CNT. The monte carlo code reads the
+  single_cnt.{pos,orient}.{x,y,z}.dat and single_cnt.chiral.{1,2}.dat Armadillo matrices, and the python tools
+  read the .npy copies of the same matrices (see `open_single_cnt_arrays`). The .npy files are preallocated with
+  np.lib.format.open_memmap and filled as the chunks arrive, and the .dat files of each chunk are written concurrently by a pool of threads.
+
+  In the compact format the orientation, which is the same for all the CNTs of a fiber, is stored once per fiber point
+  in single_cnt.fiber_orient.{x,y,z} (one row per fiber) together with the fiber of each CNT in single_cnt.fiber,
+  and the chirality, which is constant along a CNT, is stored once per CNT in the two columns of single_cnt.chiral.
+  '''
+  FULL_FILES = ['single_cnt.pos.x', 'single_cnt.pos.y', 'single_cnt.pos.z',
+                'single_cnt.orient.x', 'single_cnt.orient.y', 'single_cnt.orient.z',
+                'single_cnt.chiral.1', 'single_cnt.chiral.2']
+  COMPACT_FILES = ['single_cnt.pos.x', 'single_cnt.pos.y', 'single_cnt.pos.z',
+                   'single_cnt.fiber_orient.x', 'single_cnt.fiber_orient.y', 'single_cnt.fiber_orient.z',
+                   'single_cnt.fiber', 'single_cnt.chiral']
+
+  def __init__(self, directory: str, n_cnt: int, n_coor: int, binary=False, fmt=ARMA_TEXT_FORMAT, compact=False, n_fiber=None):
+    '''
+    Parameters:
+      directory (str): output directory
+      n_cnt (int): total number of CNTs (rows)
+      n_coor (int): number of points per CNT (columns)
+      binary (bool): write the Armadillo binary format instead of text
+      fmt (str): number format of the text output
+      compact (bool): write the compact format
+      n_fiber (int): total number of fibers, needed for the compact format
+    '''
+    self._compact = compact
+    if compact:
+      names = self.COMPACT_FILES
+      shapes = 3*[(n_cnt, n_coor)] + 3*[(n_fiber, n_coor)] + [(n_cnt, 1), (n_cnt, 2)]
+      stale = set(self.FULL_FILES) - set(self.COMPACT_FILES)
+    else:
+      names = self.FULL_FILES
+      shapes = 8*[(n_cnt, n_coor)]
+      stale = set(self.COMPACT_FILES) - set(self.FULL_FILES)
+
+    # the monte carlo code picks the compact format whenever single_cnt.fiber.dat exists, so remove the files of the other format
+    for name in stale:
+      for extension in ('.dat', '.npy'):
+        if os.path.exists(os.path.join(directory, name + extension)):
+          os.remove(os.path.join(directory, name + extension))
+
+    self._arma = [ArmaMatrixWriter(os.path.join(directory, name + '.dat'), shape, binary=binary, fmt=fmt) for name, shape in zip(names, shapes)]
+    self._npy = [np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+', dtype=np.float64, shape=shape) for name, shape in zip(names, shapes)]
+    self._rows = [0]*len(names)
+    self._fibers = 0
+    self._executor = ThreadPoolExecutor(max_workers=len(self._arma))
+
+  def write(self, pos: np.ndarray, orient: np.ndarray, chiral: np.ndarray, fiber=None):
+    '''
+    Append a chunk of CNTs
+
+    Parameters:
+      pos (np.ndarray): array of shape (m, n_coor, 3) with the position of the points of m CNTs
+      orient (np.ndarray): array of shape (m, n_coor, 3) with the orientation of the points, or (f, n_coor, 3)
+                           with the orientation of the points of the f fibers of the chunk in the compact format
+      chiral (np.ndarray): array of shape (m, n_coor, 2) with the chirality of the points, or (m, 2) in the compact format
+      fiber (np.ndarray): index of the fiber of each CNT among all the fiber rows written so far, including this chunk, in the compact format.
+                          By default the m CNTs are divided evenly over the f fibers of the chunk in order.
+    '''
+    matrices = [pos[:, :, 0], pos[:, :, 1], pos[:, :, 2], orient[:, :, 0], orient[:, :, 1], orient[:, :, 2]]
+    if self._compact:
+      if fiber is None:
+        fiber = self._fibers + np.repeat(np.arange(orient.shape[0]), pos.shape[0]//orient.shape[0])
+      matrices += [np.asarray(fiber)[:, np.newaxis], chiral]
+      self._fibers += orient.shape[0]
+    else:
+      matrices += [chiral[:, :, 0], chiral[:, :, 1]]
+
+    futures = [self._executor.submit(writer.write, m) for writer, m in zip(self._arma, matrices)]
+    for k, (npy, m) in enumerate(zip(self._npy, matrices)):
+      npy[self._rows[k]:self._rows[k]+m.shape[0]] = m
+      self._rows[k] += m.shape[0]
+    for future in futures:
+      future.result()
+
+  def close(self):
+    self._executor.shutdown()
+    for npy in self._npy:
+      npy.flush()
+    self._npy = []
+    for writer in self._arma:
+      writer.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self._executor.shutdown()
+      for writer in self._arma:
+        writer.__exit__(exc_type, exc_value, traceback)
+
+def is_compact_single_cnt(directory: str) -> bool:
+  '''
+  Check if the single CNT mesh in a directory is saved in the compact format of `SingleCNTWriter`
+  '''
+  return os.path.exists(os.path.join(directory, 'single_cnt.fiber.npy'))
+
+def open_single_cnt_arrays(directory: str, quantity='pos', mmap_mode='r'):
+  '''
+  Open the .npy copies of the single CNT mesh written by `SingleCNTWriter` as memory maps, so only the parts that are used are read from disk.
+  For a mesh in the compact format the chirality is expanded to one value per point with read-only broadcasting views,
+  and the orientation is gathered from the fiber orientations into new arrays.
+
+  Parameters:
+    directory (str): mesh directory
+    quantity (str): 'pos' or 'orient' for the (x, y, z) components, 'chiral' for the (n, m) chirality
+    mmap_mode (str): mode passed to np.load; None loads the arrays into memory
+
+  Returns:
+    tuple of np.ndarray of shape (number of cnts, number of points per cnt), or None if the files do not exist
+  '''
+  if quantity not in ('pos', 'orient', 'chiral'):
+    raise ValueError(f'Unknown quantity: {quantity}')
+
+  def load(names):
+    filenames = [os.path.join(directory, name + '.npy') for name in names]
+    if not all(os.path.exists(filename) for filename in filenames):
+      return None
+    return tuple(np.load(filename, mmap_mode=mmap_mode) for filename in filenames)
+
+  if quantity == 'pos' or not is_compact_single_cnt(directory):
+    names = [name for name in SingleCNTWriter.FULL_FILES if name.startswith(f'single_cnt.{quantity}.')]
+    return load(names)
+
+  pos = load(['single_cnt.pos.x'])
+  if pos is None:
+    return None
+  shape = pos[0].shape
+  if quantity == 'chiral':
+    chiral = load(['single_cnt.chiral'])[0]
+    return tuple(np.broadcast_to(chiral[:, i:i+1], shape) for i in range(2))
+  fiber = load(['single_cnt.fiber'])[0][:, 0].astype(np.int64)
+  return tuple(orient[fiber] for orient in load(['single_cnt.fiber_orient.x', 'single_cnt.fiber_orient.y', 'single_cnt.fiber_orient.z']))
+
+def gather_single_cnt_points(directory: str, quantity: str, points: np.ndarray) -> np.ndarray:
+  '''
+  Read the position or orientation of a set of points of the single CNT mesh from the memory maps of its .npy files, so only the
+  pages of these points are read. In the compact format the orientation is read from the fiber orientations of the CNTs of the points.
+
+  Parameters:
+    directory (str): mesh directory
+    quantity (str): 'pos' or 'orient'
+    points (np.ndarray): indices of the points in row major order of the single_cnt.* matrices (cnt*points per cnt + point)
+
+  Returns:
+    np.ndarray of shape (len(points),3)
+  '''
+  if quantity not in ('pos', 'orient'):
+    raise ValueError(f'Unknown quantity: {quantity}')
+  points = np.asarray(points, dtype=np.int64)
+  load = lambda name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+  if quantity == 'orient' and is_compact_single_cnt(directory):
+    n_coor = load('single_cnt.pos.x').shape[1]
+    fiber = load('single_cnt.fiber')[points // n_coor, 0].astype(np.int64)
+    return np.stack([load(f'single_cnt.fiber_orient.{c}')[fiber, points % n_coor] for c in 'xyz'], axis=-1).astype(np.float64)
+  return np.stack([load(f'single_cnt.{quantity}.{c}').reshape(-1)[points] for c in 'xyz'], axis=-1).astype(np.float64)
+
+def _random_mesh_chunk(task):
+  '''
+  Draw one chunk of a random mesh given as (seed sequence, number of points, box); this runs inside the workers of write_random_mesh
+  '''
+  seed, num_point, box = task
+  return util.random_molecules(np.random.default_rng(seed), num_point, box)
+
+def write_random_mesh(directory: str, num_point: int, box, seed=None, workers=None, chunk_size=1000000, binary=False, fmt=ARMA_TEXT_FORMAT):
+  '''
+  Write a mesh of randomly placed and oriented molecules as single_cnt.{pos,orient}.{x,y,z}.dat files with one molecule per row.
+  The points are drawn in chunks by a pool of worker processes and written as the chunks arrive, so the memory use does not depend
+  on the number of points. Every chunk has its own generator spawned from np.random.SeedSequence(seed), so for a given seed and
+  chunk size the mesh is the same for any number of workers.
+
+  Parameters:
+    directory (str): output directory
+    num_point (int): number of molecules
+    box (tuple(float)): size of the box along x, y and z [nm]
+    seed (int): seed of the random numbers. None draws a fresh seed, which is printed so the mesh can be reproduced.
+    workers (int): number of worker processes. None uses all the cores and 1 draws the chunks in this process.
+    chunk_size (int): number of points per chunk
+    binary (bool): write the Armadillo binary format instead of text
+    fmt (str): number format of the text output
+
+  Returns:
+    int: the entropy of the seed sequence that was used
+  '''
+  seed = np.random.SeedSequence(seed)
+  print(f'random mesh seed: {seed.entropy}')
+
+  sizes = [min(chunk_size, num_point-start) for start in range(0, num_point, chunk_size)]
+  tasks = [(s, n, box) for s, n in zip(seed.spawn(len(sizes)), sizes)]
+
+  names = ['single_cnt.pos.x.dat', 'single_cnt.pos.y.dat', 'single_cnt.pos.z.dat',
+           'single_cnt.orient.x.dat', 'single_cnt.orient.y.dat', 'single_cnt.orient.z.dat']
+  writers = [ArmaMatrixWriter(os.path.join(directory, name), (num_point, 1), binary=binary, fmt=fmt) for name in names]
+
+  def write(pos, orient):
+    columns = [pos[:, 0], pos[:, 1], pos[:, 2], orient[:, 0], orient[:, 1], orient[:, 2]]
+    futures = [threads.submit(writer.write, column) for writer, column in zip(writers, columns)]
+    for future in futures:
+      future.result()
+
+  with ThreadPoolExecutor(max_workers=len(writers)) as threads:
+    if workers == 1 or len(tasks) < 2:
+      for task in tasks:
+        write(*_random_mesh_chunk(task))
+    else:
+      with ProcessPoolExecutor(max_workers=workers) as executor:
+        # keep a bounded number of chunks in flight and write them in order
+        in_flight = 2*(workers or os.cpu_count() or 1)
+        futures = [executor.submit(_random_mesh_chunk, task) for task in tasks[:in_flight]]
+        for i in range(len(tasks)):
+          if i+in_flight < len(tasks):
+            futures.append(executor.submit(_random_mesh_chunk, tasks[i+in_flight]))
+          write(*futures[i].result())
+          futures[i] = None
+
+  for writer in writers:
+    writer.close()
+  return seed.entropy
+
+def _synthetic_tube_file(task):
+  '''
+  Draw and write the fibers of one tube file of a synthetic mesh; this runs inside the workers of write_synthetic_mesh
+  '''
+  seed, filenames, first_number, num_fiber, num_section, box, section_length, bending, chiralities, probabilities = task
+  rng = np.random.default_rng(seed)
+  r, offsets = util.random_walk_fibers(rng, num_fiber, num_section, box, section_length=section_length, bending=bending)
+  chiral = np.asarray(chiralities)[rng.choice(len(chiralities), size=num_fiber, p=probabilities)]
+  write_tube_file(*filenames, r, offsets, chiral, first_number=first_number)
+  return offsets[-1]
+
+def write_synthetic_mesh(directory: str, num_fiber: int, num_section, box, section_length=(7., 12.), bending=0.2,
+                         chiralities=((4, 2),), probabilities=None, seed=None, workers=None, fibers_per_file=10000) -> dict:
+  '''
+  Write a fiber mesh of random walk fibers (see util.random_walk_fibers) as tube{i}.pos.dat / tube{i}.chiral.dat files,
+  so that the python mesh tools can be run and timed on meshes of any size without BulletPhysics. As in cnt_mesh::save_one_tube
+  each file holds fibers_per_file fibers. Every file is drawn and written by a pool of worker processes with its own generator
+  spawned from np.random.SeedSequence(seed), so for a given seed the mesh is the same for any number of workers.
+
+  Parameters:
+    directory (str): output directory
+    num_fiber (int): number of fibers
+    num_section (int or (int, int)): number of sections per fiber, or the range of the number of sections
+    box (tuple(float)): size of the box along x, y and z [nm]
+    section_length (float or (float, float)): distance between neighboring sections, or its range [nm]
+    bending (float): standard deviation of the random kick of the fiber direction between two sections
+    chiralities (list((int, int))): chiralities of the fibers
+    probabilities (list(float)): probability of each chirality (None draws them with equal probability)
+    seed (int): seed of the random numbers. None draws a fresh seed, which is printed so the mesh can be reproduced.
+    workers (int): number of worker processes. None uses all the cores and 1 writes the files in this process.
+    fibers_per_file (int): number of fibers per tube file
+
+  Returns:
+    dict: the parameters of the mesh together with the seed and the total number of sections
+  '''
+  seed = np.random.SeedSequence(seed)
+  print(f'synthetic mesh seed: {seed.entropy}')
+  if probabilities is not None:
+    probabilities = np.asarray(probabilities, dtype=float)/np.sum(probabilities)
+
+  starts = list(range(0, num_fiber, fibers_per_file))
+  tasks = []
+  for i, (s, start) in enumerate(zip(seed.spawn(len(starts)), starts)):
+    filenames = (os.path.join(directory, f'tube{i+1}.pos.dat'), os.path.join(directory, f'tube{i+1}.chiral.dat'))
+    tasks.append((s, filenames, start+1, min(fibers_per_file, num_fiber-start), num_section, box, section_length, bending,
+                  chiralities, probabilities))
+
+  if workers == 1 or len(tasks) < 2:
+    counts = [_synthetic_tube_file(task) for task in tasks]
+  else:
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      counts = list(executor.map(_synthetic_tube_file, tasks))
+
+  return {'seed': seed.entropy, 'number of fibers': num_fiber, 'number of sections': int(np.sum(counts)),
+          'number of files': len(tasks)}
+
+# name of the report of the trimming stage that the monte carlo code reads from the mesh directory
+TRIM_REPORT = 'single_cnt.trim.json'
+
+def trim_single_cnt(directory: str, output_directory: str, lower, upper, chunk_size=10000, binary=False, fmt=ARMA_TEXT_FORMAT, report=None) -> dict:
+  '''
+  Write a copy of the single CNT mesh of a directory without the CNTs that lie completely outside a box.
+  CNTs that cross the boundary are kept whole, so the points of every row stay connected; their points outside the box
+  are skipped by the monte carlo code, which reads the box from the TRIM_REPORT file written next to the mesh.
+  The mesh is read from the .npy files in chunks of CNTs and written in the same (full or compact) format.
+
+  Parameters:
+    directory (str): directory of the input mesh
+    output_directory (str): directory of the trimmed mesh, which should be different from the input directory
+    lower (np.ndarray): lower corner of the box [nm]
+    upper (np.ndarray): upper corner of the box [nm]
+    chunk_size (int): number of CNTs read at a time
+    binary (bool): write the Armadillo binary format instead of text
+    fmt (str): number format of the text output
+    report (dict): additional entries of the report
+
+  Returns:
+    dict: the report that is saved in output_directory/TRIM_REPORT
+  '''
+  lower, upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+  pos = open_single_cnt_arrays(directory, 'pos')
+  compact = is_compact_single_cnt(directory)
+  n_cnt, n_coor = pos[0].shape
+
+  def chunks():
+    for start in range(0, n_cnt, chunk_size):
+      p = np.stack([c[start:start+chunk_size] for c in pos], axis=-1)
+      inside = np.all((p >= lower) & (p <= upper), axis=-1)
+      yield start, p, inside
+
+  # first pass to find the shape of the output
+  keep = np.zeros(n_cnt, dtype=bool)
+  n_inside = 0
+  for start, p, inside in chunks():
+    keep[start:start+p.shape[0]] = np.any(inside, axis=1)
+    n_inside += np.count_nonzero(inside)
+
+  if compact:
+    fiber = np.load(os.path.join(directory, 'single_cnt.fiber.npy'), mmap_mode='r')[:, 0].astype(np.int64)
+    fibers_kept = np.unique(fiber[keep])
+    orient = [np.load(os.path.join(directory, name + '.npy'), mmap_mode='r') for name in SingleCNTWriter.COMPACT_FILES[3:6]]
+    chiral = np.load(os.path.join(directory, 'single_cnt.chiral.npy'), mmap_mode='r')
+  else:
+    orient = open_single_cnt_arrays(directory, 'orient')
+    chiral = open_single_cnt_arrays(directory, 'chiral')
+
+  os.makedirs(output_directory, exist_ok=True)
+  with SingleCNTWriter(output_directory, int(np.count_nonzero(keep)), n_coor, binary=binary, fmt=fmt,
+                       compact=compact, n_fiber=len(fibers_kept) if compact else None) as writer:
+    if compact:
+      o = np.stack([c[fibers_kept] for c in orient], axis=-1)
+      new_fiber = np.searchsorted(fibers_kept, fiber)
+      # all the fiber orientations are written with the first chunk
+      first = True
+    for start, p, inside in chunks():
+      rows = np.flatnonzero(keep[start:start+p.shape[0]])
+      if compact:
+        writer.write(p[rows], o if first else o[:0], chiral[start+rows], fiber=new_fiber[start+rows])
+        first = False
+      else:
+        writer.write(p[rows], np.stack([c[start+rows] for c in orient], axis=-1), np.stack([c[start+rows] for c in chiral], axis=-1))
+
+  result = dict(report or {})
+  result.update({
+    'units': 'nm',
+    'xlim': [float(lower[0]), float(upper[0])],
+    'ylim': [float(lower[1]), float(upper[1])],
+    'zlim': [float(lower[2]), float(upper[2])],
+    'number of cnts': {'input': int(n_cnt), 'output': int(np.count_nonzero(keep))},
+    'number of points': {'input': int(n_cnt*n_coor), 'output': int(np.count_nonzero(keep)*n_coor), 'inside the box': int(n_inside)},
+  })
+  with open(os.path.join(output_directory, TRIM_REPORT), 'w') as file:
+    json.dump(result, file, indent=2)
+  return result
+
+def read_mc_trim_limits(filename: str, section='exciton monte carlo') -> Tuple[np.ndarray, np.ndarray, float]:
+  '''
+  Read the "trim limits" and the "max hopping radius [m]" of a monte carlo input file and convert them from meters to nanometers
+
+  Parameters:
+    filename (str): monte carlo input file in json format
+    section (str): section of the input file with the monte carlo properties
+
+  Returns:
+    tuple of (lower, upper, max_hopping_radius): np.ndarray of shape (3,) with the lower and upper corners of the box [nm]
+    and the maximum hopping radius [nm]
+  '''
+  with open(filename) as file:
+    properties = json.load(file)[section]
+  limits = properties['trim limits']
+  limits = np.array([limits['xlim'], limits['ylim'], limits['zlim']], dtype=float)*1e9
+  return limits[:, 0], limits[:, 1], float(properties['max hopping radius [m]'])*1e9
+
+# directory and files of the spatially tiled copy of a single CNT mesh
+TILE_DIRECTORY = 'tiles'
+TILE_INDEX = 'tiles.index.json'
+_TILE_FILES = {'pos': 'tiles.pos.npy', 'cnt': 'tiles.cnt.npy', 'point': 'tiles.point.npy'}
+
+def write_tiled_mesh(directory: str, tile_size=200., chunk_size=10000, output_directory=None) -> dict:
+  '''
+  Write the points of the single CNT mesh of a directory bucketed into cubic tiles, so that a sub-volume can be read without the rest.
+  The points of each tile are stored contiguously in tiles.pos.npy together with the CNT (row) and the point (column) they come from
+  in the single_cnt.* matrices, and tiles.index.json lists the bounds of every non-empty tile and the offset of its points.
+  The mesh is read from the .npy files in chunks of CNTs in two passes (count, then place), so the memory use does not depend on its size.
+
+  Parameters:
+    directory (str): directory of the single CNT mesh
+    tile_size (float): edge length of the tiles [nm]
+    chunk_size (int): number of CNTs read at a time
+    output_directory (str): output directory, by default the TILE_DIRECTORY subdirectory of the mesh directory
+
+  Returns:
+    dict: the index
+  '''
+  pos = open_single_cnt_arrays(directory, 'pos')
+  n_cnt, n_coor = pos[0].shape
+  output_directory = output_directory or os.path.join(directory, TILE_DIRECTORY)
+  os.makedirs(output_directory, exist_ok=True)
+
+  origin = np.array([c.min() for c in pos])
+  shape = np.maximum(1, np.ceil((np.array([c.max() for c in pos])-origin)/tile_size)).astype(np.int64)
+
+  def chunks():
+    for start in range(0, n_cnt, chunk_size):
+      p = np.stack([c[start:start+chunk_size] for c in pos], axis=-1).reshape((-1, 3))
+      index = np.clip(np.floor((p-origin)/tile_size).astype(np.int64), 0, shape-1)
+      yield start, p, np.ravel_multi_index(index.T, shape)
+
+  counts = np.zeros(np.prod(shape), dtype=np.int64)
+  for _, _, tile in chunks():
+    counts += np.bincount(tile, minlength=counts.size)
+  offsets = np.zeros(counts.size+1, dtype=np.int64)
+  np.cumsum(counts, out=offsets[1:])
+
+  n = int(offsets[-1])
+  out_pos = np.lib.format.open_memmap(os.path.join(output_directory, _TILE_FILES['pos']), mode='w+', dtype=np.float64, shape=(n, 3))
+  out_cnt = np.lib.format.open_memmap(os.path.join(output_directory, _TILE_FILES['cnt']), mode='w+', dtype=np.int64, shape=(n,))
+  out_point = np.lib.format.open_memmap(os.path.join(output_directory, _TILE_FILES['point']), mode='w+', dtype=np.int32, shape=(n,))
+
+  filled = offsets[:-1].copy()
+  for start, p, tile in chunks():
+    order = np.argsort(tile, kind='stable')
+    tile = tile[order]
+    first = np.searchsorted(tile, tile, side='left')
+    target = filled[tile] + np.arange(tile.size) - first
+    filled += np.bincount(tile, minlength=counts.size)
+    out_pos[target] = p[order]
+    out_cnt[target] = start + order // n_coor
+    out_point[target] = order % n_coor
+  for out in (out_pos, out_cnt, out_point):
+    out.flush()
+
+  nonempty = np.flatnonzero(counts)
+  lower = origin + np.stack(np.unravel_index(nonempty, shape), axis=1)*tile_size
+  index = {
+    'units': 'nm',
+    'tile size': float(tile_size),
+    'origin': origin.tolist(),
+    'shape': shape.tolist(),
+    'number of cnts': int(n_cnt),
+    'number of points per cnt': int(n_coor),
+    'tiles': {
+      'lower': lower.tolist(),
+      'upper': (lower+tile_size).tolist(),
+      'offset': offsets[nonempty].tolist(),
+      'count': counts[nonempty].tolist(),
+    },
+  }
+  with open(os.path.join(output_directory, TILE_INDEX), 'w') as file:
+    json.dump(index, file)
+  return index
+
+class TiledMesh:
+  '''
+  Reader of the tiled copy of a single CNT mesh written by `write_tiled_mesh`.
+  Only the index is read when the mesh is opened; the points are memory mapped and only the tiles that intersect a query are touched.
+  '''
+  def __init__(self, directory: str):
+    '''
+    Parameters:
+      directory (str): directory with the tiles, or the mesh directory that has the tiles in its TILE_DIRECTORY subdirectory
+    '''
+    if not os.path.exists(os.path.join(directory, TILE_INDEX)):
+      directory = os.path.join(directory, TILE_DIRECTORY)
+    with open(os.path.join(directory, TILE_INDEX)) as file:
+      self.index = json.load(file)
+    tiles = self.index['tiles']
+    self.lower = np.array(tiles['lower'], dtype=float).reshape((-1, 3))
+    self.upper = np.array(tiles['upper'], dtype=float).reshape((-1, 3))
+    self.offset = np.array(tiles['offset'], dtype=np.int64)
+    self.count = np.array(tiles['count'], dtype=np.int64)
+    self._pos = np.load(os.path.join(directory, _TILE_FILES['pos']), mmap_mode='r')
+    self._cnt = np.load(os.path.join(directory, _TILE_FILES['cnt']), mmap_mode='r')
+    self._point = np.load(os.path.join(directory, _TILE_FILES['point']), mmap_mode='r')
+
+  def __len__(self):
+    return self._pos.shape[0]
+
+  def tiles(self, lower, upper) -> np.ndarray:
+    '''
+    Get the indices of the tiles that intersect a box
+    '''
+    return np.flatnonzero(np.all((self.lower <= np.asarray(upper)) & (np.asarray(lower) <= self.upper), axis=1))
+
+  def query(self, lower, upper) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    Get the points of the mesh inside a box
+
+    Parameters:
+      lower (np.ndarray): lower corner of the box [nm]
+      upper (np.ndarray): upper corner of the box [nm]
+
+    Returns:
+      tuple of (pos, cnt, point): np.ndarray of shape (N,3) with the coordinates of the points, and np.ndarray of shape (N,)
+      with the CNT (row) and the point (column) of each point in the single_cnt.* matrices. Points of the same tile are consecutive.
+    '''
+    lower, upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+    tiles = self.tiles(lower, upper)
+    slices = [slice(o, o+c) for o, c in zip(self.offset[tiles], self.count[tiles])]
+    if len(slices) == 0:
+      return np.zeros((0, 3)), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+    pos = np.concatenate([self._pos[s] for s in slices])
+    inside = np.all((pos >= lower) & (pos <= upper), axis=1)
+    cnt = np.concatenate([self._cnt[s] for s in slices])[inside]
+    point = np.concatenate([self._point[s] for s in slices])[inside]
+    return pos[inside], cnt, point
+
+def single_cnt_distance_histogram(directory: str, r_max=50., bins=1000, workers=None, chunk_size=10000, max_pairs=1 << 22) -> np.ndarray:
+  '''
+  CNT-CNT distance histogram of the single CNT mesh of a directory (see spatial.cell_list_histogram), without loading the mesh into memory.
+  The points are sorted into cells of size r_max on disk by writing a temporary tiled copy of the mesh with `write_tiled_mesh`,
+  which reads the mesh in chunks of CNTs, and the workers memory map the points of their slab of cells from the tiled copy.
+  Pairs of points of the same CNT are not counted.
+
+  Parameters:
+    directory (str): directory of the single CNT mesh
+    r_max (float): upper limit of the histogram [nm]
+    bins (int): number of bins between 0 and r_max
+    workers (int): number of worker processes. None uses all the cores and 1 runs in this process.
+    chunk_size (int): number of CNTs read at a time
+    max_pairs (int): number of point pairs that are generated at a time in each worker
+
+  Returns:
+    np.ndarray of shape (bins,) with the number of pairs in each bin
+  '''
+  temp_directory = tempfile.mkdtemp(prefix='histogram.', dir=directory)
+  try:
+    index = write_tiled_mesh(directory, tile_size=r_max, chunk_size=chunk_size, output_directory=temp_directory)
+    shape = np.array(index['shape'], dtype=np.int64)
+    lower = np.array(index['tiles']['lower'], dtype=float).reshape((-1, 3))
+    tile = np.round((lower-index['origin'])/r_max).astype(np.int64)
+    counts = np.zeros(np.prod(shape), dtype=np.int64)
+    counts[np.ravel_multi_index(tile.T, shape)] = index['tiles']['count']
+    cell_offsets = np.zeros(counts.size+1, dtype=np.int64)
+    np.cumsum(counts, out=cell_offsets[1:])
+    return spatial.cell_list_histogram(os.path.join(temp_directory, _TILE_FILES['pos']), os.path.join(temp_directory, _TILE_FILES['cnt']),
+                                       cell_offsets, shape, r_max=r_max, bins=bins, workers=workers, max_pairs=max_pairs)
+  finally:
+    shutil.rmtree(temp_directory, ignore_errors=True)
+
+# files of the scatterer neighbor list of a single CNT mesh, in compressed sparse row (CSR) form
+NEIGHBOR_LIST = 'single_cnt.neighbors.json'
+_NEIGHBOR_FILES = {'offsets': 'single_cnt.neighbors.offsets.npy', 'indices': 'single_cnt.neighbors.indices.npy',
+                   'distances': 'single_cnt.neighbors.distances.npy'}
+_NEIGHBOR_LIST_VERSION = 1
+
+def write_neighbor_list(directory: str, radius=20., min_distance=0.4, chunk_size=50000, output_directory=None, tile_size=200., same_cnt=False) -> dict:
+  '''
+  Find the neighbors within the max hopping radius of every point of the single CNT mesh of a directory and save them next to the mesh,
+  so that the neighbor search is done once per mesh instead of once per monte carlo run. Points are numbered in row major order
+  of the single_cnt.* matrices (cnt*points per cnt + point), and points of the same CNT are not neighbors unless same_cnt is set,
+  as for the scatterers of the monte carlo code (scatterer::find_neighbors).
+  The points are sorted into tiles on disk by a temporary tiled copy of the mesh (see `write_tiled_mesh`), and the neighbors of the
+  points of each tile are searched in a KD-tree of the tile and a halo of one radius around it, so the memory use is bounded by the
+  points of one tile and the pairs of one chunk of points instead of growing with the mesh. The pairs of each chunk are appended
+  to temporary files and then sorted into the .npy files through memory maps.
+  NEIGHBOR_LIST records the parameters and the fingerprint of the mesh, which `read_neighbor_list` checks.
+
+  Parameters:
+    directory (str): directory of the single CNT mesh
+    radius (float): max hopping radius [nm]
+    min_distance (float): pairs closer than this are not neighbors, as in the monte carlo code [nm]
+    chunk_size (int): number of points whose neighbors are found at a time
+    output_directory (str): output directory, by default the mesh directory
+    tile_size (float): edge length of the tiles [nm]
+    same_cnt (bool): keep the pairs of points of the same CNT
+
+  Returns:
+    dict: the contents of NEIGHBOR_LIST
+  '''
+  pos = open_single_cnt_arrays(directory, 'pos')
+  n_cnt, n_coor = pos[0].shape
+  n = n_cnt*n_coor
+  output_directory = output_directory or directory
+  os.makedirs(output_directory, exist_ok=True)
+  index_dtype = np.int32 if n < np.iinfo(np.int32).max else np.int64
+  filenames = {k: os.path.join(output_directory, v) for k, v in _NEIGHBOR_FILES.items()}
+
+  temp_directory = tempfile.mkdtemp(prefix='neighbors.', dir=output_directory)
+  try:
+    write_tiled_mesh(directory, tile_size=tile_size, chunk_size=max(1, chunk_size//n_coor), output_directory=temp_directory)
+    mesh = TiledMesh(temp_directory)
+
+    # the number of neighbors of each point is stored in offsets[1:] and summed up afterwards; the pairs of each chunk of points
+    # are appended to raw files, as the number of pairs is only known at the end
+    offsets = np.lib.format.open_memmap(filenames['offsets'], mode='w+', dtype=np.int64, shape=(n+1,))
+    raw = {k: os.path.join(temp_directory, f'{k}.raw') for k in ('i', 'j', 'distances')}
+    chunk_pairs = []
+    with open(raw['i'], 'wb') as file_i, open(raw['j'], 'wb') as file_j, open(raw['distances'], 'wb') as file_d:
+      for t in range(mesh.offset.size):
+        tile = slice(mesh.offset[t], mesh.offset[t]+mesh.count[t])
+        tile_pos, tile_cnt = np.asarray(mesh._pos[tile]), np.asarray(mesh._cnt[tile])
+        tile_id = tile_cnt*n_coor + mesh._point[tile]
+        halo_pos, halo_cnt, halo_point = mesh.query(mesh.lower[t]-radius, mesh.upper[t]+radius)
+        halo_tree = cKDTree(halo_pos)
+        for start in range(0, tile_pos.shape[0], chunk_size):
+          stop = min(start+chunk_size, tile_pos.shape[0])
+          labels = (None, None) if same_cnt else (tile_cnt[start:stop], halo_cnt)
+          i, j, dist = spatial.neighbor_pairs(tile_pos[start:stop], halo_pos, *labels, radius, min_distance, tree_2=halo_tree)
+          offsets[1+tile_id[start:stop]] = np.bincount(i, minlength=stop-start)
+          file_i.write(tile_id[start+i].astype(index_dtype).tobytes())
+          file_j.write((halo_cnt[j]*n_coor + halo_point[j]).astype(index_dtype).tobytes())
+          file_d.write(dist.astype(np.float64).tobytes())
+          chunk_pairs.append(i.size)
+
+    total = 0
+    for start in range(1, n+1, _TEXT_BLOCK_SIZE):
+      block = np.cumsum(offsets[start:start+_TEXT_BLOCK_SIZE]) + total
+      offsets[start:start+_TEXT_BLOCK_SIZE] = block
+      total = int(block[-1])
+    offsets.flush()
+
+    # every chunk holds all the neighbors of its points, so each chunk is sorted by (point, neighbor) and placed at the offsets of its points
+    n_pair = int(offsets[-1])
+    out_j = np.lib.format.open_memmap(filenames['indices'], mode='w+', dtype=index_dtype, shape=(n_pair,))
+    out_d = np.lib.format.open_memmap(filenames['distances'], mode='w+', dtype=np.float64, shape=(n_pair,))
+    if n_pair:
+      raw_i = np.memmap(raw['i'], dtype=index_dtype, mode='r', shape=(n_pair,))
+      raw_j = np.memmap(raw['j'], dtype=index_dtype, mode='r', shape=(n_pair,))
+      raw_d = np.memmap(raw['distances'], dtype=np.float64, mode='r', shape=(n_pair,))
+      position = 0
+      for count in chunk_pairs:
+        block = slice(position, position+count)
+        i, j = np.asarray(raw_i[block], dtype=np.int64), np.asarray(raw_j[block])
+        order = np.lexsort((j, i))
+        i = i[order]
+        target = offsets[i] + np.arange(count) - np.searchsorted(i, i, side='left')
+        out_j[target] = j[order]
+        out_d[target] = raw_d[block][order]
+        position += count
+      del raw_i, raw_j, raw_d
+    out_j.flush()
+    out_d.flush()
+    del offsets, out_j, out_d, mesh
+  finally:
+    shutil.rmtree(temp_directory, ignore_errors=True)
+
+  info = {
+    'version': _NEIGHBOR_LIST_VERSION,
+    'units': 'nm',
+    'max hopping radius': float(radius),
+    'min distance': float(min_distance),
+    'same cnt pairs': bool(same_cnt),
+    'number of cnts': int(n_cnt),
+    'number of points per cnt': int(n_coor),
+    'number of pairs': n_pair,
+    'mesh': [file_fingerprint(os.path.join(directory, name + '.npy'), hash=False) for name in SingleCNTWriter.FULL_FILES[:3]],
+  }
+  with open(os.path.join(output_directory, NEIGHBOR_LIST), 'w') as file:
+    json.dump(info, file, indent=2)
+  return info
+
+def read_neighbor_list(directory: str, radius=None, mesh_directory=None, mmap_mode='r', same_cnt=None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  '''
+  Read the neighbor list written by `write_neighbor_list`
+
+  Parameters:
+    directory (str): directory of the neighbor list
+    radius (float): if given, check that the neighbor list covers at least this max hopping radius [nm]
+    mesh_directory (str): directory of the single CNT mesh, by default the same directory; the neighbor list must be newer than the mesh
+    mmap_mode (str): mode passed to np.load; None loads the arrays into memory
+    same_cnt (bool): if given, check that the pairs of points of the same CNT are kept (True) or left out (False)
+
+  Returns:
+    tuple of (offsets, indices, distances): the neighbors of point i are indices[offsets[i]:offsets[i+1]] at distances[offsets[i]:offsets[i+1]] [nm]
+  '''
+  with open(os.path.join(directory, NEIGHBOR_LIST)) as file:
+    info = json.load(file)
+  if info.get('version') != _NEIGHBOR_LIST_VERSION:
+    raise ValueError(f'{os.path.join(directory, NEIGHBOR_LIST)} was written by an incompatible version')
+  if radius is not None and radius > info['max hopping radius']:
+    raise ValueError(f'the neighbor list only covers a max hopping radius of {info["max hopping radius"]} nm, {radius} nm was requested')
+  if same_cnt is not None and info.get('same cnt pairs', False) != same_cnt:
+    raise ValueError(f'the neighbor list {"leaves out" if same_cnt else "keeps"} the pairs of points of the same CNT')
+  mesh_directory = mesh_directory or directory
+  for stored in info['mesh']:
+    current = file_fingerprint(os.path.join(mesh_directory, stored['name']), hash=False)
+    if current['size'] != stored['size'] or current['mtime'] != stored['mtime']:
+      raise ValueError(f'the single CNT mesh in {mesh_directory} changed after the neighbor list was written')
+  return tuple(np.load(os.path.join(directory, _NEIGHBOR_FILES[k]), mmap_mode=mmap_mode) for k in ('offsets', 'indices', 'distances'))
+
+def read_mc_table_axes(filename: str, section='exciton monte carlo') -> dict:
+  '''
+  Read the axes of the scatter table from a monte carlo input file, as they are built by monte_carlo::create_davoody_scatt_table,
+  and convert them to nanometers and radians
+
+  Parameters:
+    filename (str): monte carlo input file in json format
+    section (str): section of the input file with the monte carlo properties
+
+  Returns:
+    dict of np.ndarray with the keys 'theta' [radians], 'z_shift', 'axis_shift_1' and 'axis_shift_2' [nm]
+  '''
+  with open(filename) as file:
+    properties = json.load(file)[section]
+  axis = lambda key, factor: np.linspace(properties[key][0], properties[key][1], int(properties[key][2]))*factor
+  return {'theta': axis('theta [degrees]', np.pi/180), 'z_shift': axis('zshift [m]', 1e9),
+          'axis_shift_1': axis('axis shift 1 [m]', 1e9), 'axis_shift_2': axis('axis shift 2 [m]', 1e9)}
+
+# files of the hopping geometry of the pairs of the neighbor list
+HOPPING_GEOMETRY = 'single_cnt.hopping.json'
+_HOPPING_FILE = 'single_cnt.hopping.npy'
+TABLE_AXES = ('theta', 'z_shift', 'axis_shift_1', 'axis_shift_2')
+HOPPING_DTYPE = np.dtype([('theta', np.float64), ('z_shift', np.float64), ('axis_shift_1', np.float64), ('axis_shift_2', np.float64),
+                          ('index', np.int16, (4,)), ('weight', np.float32, (4,))])
+
+def write_hopping_geometry(directory: str, axes: dict, chunk_size=50000) -> dict:
+  '''
+  Calculate the geometry of every pair of the neighbor list of a single CNT mesh (see `write_neighbor_list` and `spatial.hopping_geometry`)
+  and locate it on the axes of the scatter table, so that the monte carlo runs on the mesh do not repeat this calculation.
+  The result is saved next to the neighbor list. The positions and orientations of the pairs of each chunk are read from the memory maps
+  of the mesh (see `gather_single_cnt_points`), so the mesh is not loaded into memory.
+  The result is a structured array of HOPPING_DTYPE in the order of the pairs of the neighbor list: the four parameters in TABLE_AXES order
+  [radians, nm] and the index and weight of each parameter on the corresponding table axis (see `spatial.table_weights`).
+
+  Parameters:
+    directory (str): directory of the single CNT mesh and its neighbor list
+    axes (dict): axes of the scatter table, see `read_mc_table_axes`
+    chunk_size (int): number of points whose pairs are processed at a time
+
+  Returns:
+    dict: the contents of HOPPING_GEOMETRY
+  '''
+  offsets, indices, _ = read_neighbor_list(directory)
+  n = offsets.shape[0]-1
+
+  out = np.lib.format.open_memmap(os.path.join(directory, _HOPPING_FILE), mode='w+', dtype=HOPPING_DTYPE, shape=(int(offsets[-1]),))
+  for start in range(0, n, chunk_size):
+    stop = min(start+chunk_size, n)
+    pairs = slice(offsets[start], offsets[stop])
+    count = np.diff(offsets[start:stop+1])
+    j = np.asarray(indices[pairs])
+    # the points of the chunk and their neighbors are read from the memory maps of the mesh, not the whole mesh
+    pos_1 = np.repeat(gather_single_cnt_points(directory, 'pos', np.arange(start, stop)), count, axis=0)
+    orient_1 = np.repeat(gather_single_cnt_points(directory, 'orient', np.arange(start, stop)), count, axis=0)
+    geometry = spatial.hopping_geometry(pos_1, orient_1, gather_single_cnt_points(directory, 'pos', j), gather_single_cnt_points(directory, 'orient', j))
+    block = np.zeros(geometry.shape[0], dtype=HOPPING_DTYPE)
+    for k, name in enumerate(TABLE_AXES):
+      block[name] = geometry[:, k]
+      block['index'][:, k], block['weight'][:, k] = spatial.table_weights(geometry[:, k], axes[name])
+    out[pairs] = block
+  out.flush()
+
+  info = {
+    'units': 'nm, radians',
+    'number of pairs': int(offsets[-1]),
+    'axes': {name: np.asarray(axes[name], dtype=float).tolist() for name in TABLE_AXES},
+    'neighbor list': file_fingerprint(os.path.join(directory, _NEIGHBOR_FILES['indices']), hash=False),
+  }
+  with open(os.path.join(directory, HOPPING_GEOMETRY), 'w') as file:
+    json.dump(info, file, indent=2)
+  return info
+
+def read_hopping_geometry(directory: str, axes=None, mmap_mode='r') -> np.ndarray:
+  '''
+  Read the hopping geometry written by `write_hopping_geometry`
+
+  Parameters:
+    directory (str): directory of the hopping geometry
+    axes (dict): if given, check that the geometry was located on the same scatter table axes
+    mmap_mode (str): mode passed to np.load; None loads the array into memory
+
+  Returns:
+    np.ndarray of HOPPING_DTYPE with one entry per pair of the neighbor list
+  '''
+  with open(os.path.join(directory, HOPPING_GEOMETRY)) as file:
+    info = json.load(file)
+  if axes is not None:
+    for name in TABLE_AXES:
+      if not np.allclose(info['axes'][name], axes[name], rtol=1e-9, atol=0):
+        raise ValueError(f'the hopping geometry in {directory} was calculated for a different {name} axis of the scatter table')
+  stored = info['neighbor list']
+  current = file_fingerprint(os.path.join(directory, stored['name']), hash=False)
+  if current['size'] != stored['size'] or current['mtime'] != stored['mtime']:
+    raise ValueError(f'the neighbor list in {directory} changed after the hopping geometry was calculated')
+  return np.load(os.path.join(directory, _HOPPING_FILE), mmap_mode=mmap_mode)
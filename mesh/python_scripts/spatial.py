@@ -0,0 +1,521 @@
+import numpy as np
+import os
+from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple
+
+"""
+# Spatial-index based distance calculations between fibers and CNTs
+"""
+
+def fiber_pair_distances(points: np.ndarray, offsets: np.ndarray, cutoff=50., chunk_size=50) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  '''
+  Find all pairs of fibers that come closer than a cutoff distance, and the minimum point-to-point distance of each pair.
+  All points are stored in a KD-tree and the fibers are processed in chunks, so the memory use is bounded by
+  the number of point pairs within the cutoff for one chunk of fibers instead of growing with the square of the number of fibers.
+
+  Parameters:
+    points (np.ndarray): array of shape (N,3) with the concatenated points of all fibers
+    offsets (np.ndarray): CSR-style offsets of shape (n_fibers+1,) so that points[offsets[i]:offsets[i+1]] belong to fiber i
+    cutoff (float): largest distance between two fibers that is recorded
+    chunk_size (int): number of fibers whose neighbors are searched at a time
+
+  Returns:
+    tuple of (min_dist, pairs, pair_dist):
+      min_dist: np.ndarray of shape (n_fibers,) with the distance of each fiber to its nearest neighbor (np.inf if there is none within the cutoff)
+      pairs: np.ndarray of shape (M,2) with the indices (i, j), i < j, of all pairs of fibers closer than the cutoff
+      pair_dist: np.ndarray of shape (M,) with the minimum distance between the fibers of each pair
+  '''
+  n_fibers = len(offsets)-1
+  labels = np.repeat(np.arange(n_fibers), np.diff(offsets))
+  tree = cKDTree(points)
+
+  pairs, pair_dist = [], []
+  for start in range(0, n_fibers, chunk_size):
+    stop = min(start+chunk_size, n_fibers)
+    chunk_tree = cKDTree(points[offsets[start]:offsets[stop]])
+    close = chunk_tree.sparse_distance_matrix(tree, cutoff, output_type='ndarray')
+
+    # only keep each pair of fibers once, from the chunk of the fiber with the lower index
+    first, second = labels[close['i']+offsets[start]], labels[close['j']]
+    keep = second > first
+    p, d = _min_per_pair(first[keep], second[keep], close['v'][keep], n_fibers)
+    pairs.append(p)
+    pair_dist.append(d)
+
+  pairs = np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+  pair_dist = np.concatenate(pair_dist) if pair_dist else np.zeros(0)
+
+  return _min_per_fiber(pairs, pair_dist, n_fibers), pairs, pair_dist
+
+def _min_per_pair(first: np.ndarray, second: np.ndarray, dist: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+  '''
+  Reduce a list of (first, second, dist) records to the minimum distance of each unique (first, second) pair
+
+  Returns:
+    tuple of (pairs, dist) with pairs of shape (M,2) sorted by (first, second)
+  '''
+  key = first.astype(np.int64)*n + second
+  order = np.argsort(key, kind='stable')
+  key, dist = key[order], dist[order]
+  if key.size == 0:
+    return np.zeros((0, 2), dtype=np.int64), np.zeros(0)
+  start = np.flatnonzero(np.concatenate(([True], key[1:] != key[:-1])))
+  key = key[start]
+  return np.stack((key // n, key % n), axis=1), np.minimum.reduceat(dist, start)
+
+def _min_per_fiber(pairs: np.ndarray, pair_dist: np.ndarray, n: int) -> np.ndarray:
+  '''
+  Get the distance of each fiber to its nearest neighbor from a list of pairs
+
+  Returns:
+    np.ndarray of shape (n,) with np.inf for fibers that do not appear in any pair
+  '''
+  min_dist = np.full(n, np.inf)
+  np.minimum.at(min_dist, pairs[:, 0], pair_dist)
+  np.minimum.at(min_dist, pairs[:, 1], pair_dist)
+  return min_dist
+
+def segment_distances(p0: np.ndarray, p1: np.ndarray, q0: np.ndarray, q1: np.ndarray) -> np.ndarray:
+  '''
+  Exact closest distance between pairs of line segments [p0, p1] and [q0, q1], vectorized over the rows.
+  The closest points are found by clamping the parameters of the infinite lines to the segments
+  (Ericson, Real-Time Collision Detection, section 5.1.9); zero length segments are handled as points.
+
+  Parameters:
+    p0, p1 (np.ndarray): arrays of shape (N,3) with the end points of the first segments
+    q0, q1 (np.ndarray): arrays of shape (N,3) with the end points of the second segments
+
+  Returns:
+    np.ndarray of shape (N,) with the distance between each pair of segments
+  '''
+  eps = 1.e-12
+  d1, d2, r = p1-p0, q1-q0, p0-q0
+  a = np.einsum('ij,ij->i', d1, d1)
+  e = np.einsum('ij,ij->i', d2, d2)
+  b = np.einsum('ij,ij->i', d1, d2)
+  c = np.einsum('ij,ij->i', d1, r)
+  f = np.einsum('ij,ij->i', d2, r)
+
+  p_point, q_point = a <= eps, e <= eps
+  safe_a = np.where(p_point, 1., a)
+  safe_e = np.where(q_point, 1., e)
+
+  # parameter on the first segment for the closest points of the two lines (0 for parallel lines)
+  denom = a*e - b*b
+  s = np.where(denom > eps*a*e, np.clip((b*f - c*e)/np.where(denom > eps*a*e, denom, 1.), 0, 1), 0.)
+  s = np.where(q_point, np.clip(-c/safe_a, 0, 1), s)
+  s = np.where(p_point, 0., s)
+
+  # parameter on the second segment, then clamp it and recompute the first parameter if needed
+  t = np.where(q_point, 0., (b*s + f)/safe_e)
+  t = np.where(p_point & ~q_point, np.clip(f/safe_e, 0, 1), t)
+  s = np.where(t < 0, np.clip(-c/safe_a, 0, 1), s)
+  s = np.where(t > 1, np.clip((b-c)/safe_a, 0, 1), s)
+  s = np.where(p_point, 0., s)
+  t = np.clip(t, 0, 1)
+
+  return np.linalg.norm(p0 + s[:, np.newaxis]*d1 - q0 - t[:, np.newaxis]*d2, axis=1)
+
+def fiber_segment_distances(points: np.ndarray, offsets: np.ndarray, cutoff=50., radius=0., chunk_size=100000) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  '''
+  Find all pairs of fibers that come closer than a cutoff distance, treating each fiber as a chain of capsules
+  around the segments between its consecutive points (e.g. the rough BulletPhysics sections).
+  Candidate pairs of segments are found with a KD-tree of the segment mid points, and the exact
+  segment-to-segment distance is calculated only for these candidates.
+
+  Parameters:
+    points (np.ndarray): array of shape (N,3) with the concatenated points of all fibers
+    offsets (np.ndarray): CSR-style offsets of shape (n_fibers+1,) so that points[offsets[i]:offsets[i+1]] belong to fiber i
+    cutoff (float): largest distance between two fibers that is recorded
+    radius (float): radius of the capsules. The returned distances are between the capsule surfaces (0 if they overlap).
+    chunk_size (int): number of segments whose neighbors are searched at a time
+
+  Returns:
+    tuple of (min_dist, pairs, pair_dist) with the same layout as `fiber_pair_distances`
+  '''
+  n_fibers = len(offsets)-1
+  counts = np.diff(offsets)
+  labels = np.repeat(np.arange(n_fibers), counts)
+
+  # segments between consecutive points of the same fiber; fibers with a single point become a zero length segment
+  start = np.flatnonzero(np.concatenate((labels[1:] == labels[:-1], [False])))
+  single = offsets[:-1][counts == 1]
+  p0 = np.concatenate((start, single))
+  p1 = np.concatenate((start+1, single))
+  order = np.argsort(p0, kind='stable')
+  p0, p1 = points[p0[order]], points[p1[order]]
+  segment_labels = labels[np.concatenate((start, single))[order]]
+
+  mid = (p0+p1)/2
+  half_length = np.linalg.norm(p1-p0, axis=1)/2
+  search_radius = cutoff + 2*radius + 2*(half_length.max() if half_length.size else 0)
+  tree = cKDTree(mid)
+
+  pairs, pair_dist = [], []
+  for begin in range(0, mid.shape[0], chunk_size):
+    end = min(begin+chunk_size, mid.shape[0])
+    close = cKDTree(mid[begin:end]).sparse_distance_matrix(tree, search_radius, output_type='ndarray')
+    i, j = close['i']+begin, close['j']
+
+    # only keep each pair of fibers once, and drop the pairs whose mid points are too far for the segments to be within the cutoff
+    first, second = segment_labels[i], segment_labels[j]
+    keep = (second > first) & (close['v'] <= cutoff + 2*radius + half_length[i] + half_length[j])
+    i, j, first, second = i[keep], j[keep], first[keep], second[keep]
+
+    dist = np.maximum(segment_distances(p0[i], p1[i], p0[j], p1[j]) - 2*radius, 0)
+    keep = dist <= cutoff
+    p, d = _min_per_pair(first[keep], second[keep], dist[keep], n_fibers)
+    pairs.append(p)
+    pair_dist.append(d)
+
+  pairs = np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+  pair_dist = np.concatenate(pair_dist) if pair_dist else np.zeros(0)
+
+  if len(pairs) > 1:
+    # the same pair of fibers can be found from segments in different chunks
+    pairs, pair_dist = _min_per_pair(pairs[:, 0], pairs[:, 1], pair_dist, n_fibers)
+
+  return _min_per_fiber(pairs, pair_dist, n_fibers), pairs, pair_dist
+
+# neighbor cells of a cell in a cell list, such that each pair of cells is visited once
+_HALF_SHELL = np.array([[0, 0, 1], [0, 1, -1], [0, 1, 0], [0, 1, 1]] + [[1, j, k] for j in (-1, 0, 1) for k in (-1, 0, 1)])
+
+def distance_histogram(points: np.ndarray, labels=None, r_max=50., bins=1000, workers=None, max_pairs=1 << 22) -> np.ndarray:
+  '''
+  Histogram of the distances between all pairs of points closer than r_max, e.g. the CNT-CNT distance histogram of the single CNT mesh.
+  The points are sorted into a cell list with cells of size r_max, so only pairs in the same or neighboring cells are checked,
+  and the histogram is calculated by `cell_list_histogram`. The sorted copy of the points is held in memory; for a mesh that is
+  larger than the memory use mesh_io.single_cnt_distance_histogram, which sorts the points on disk.
+
+  Parameters:
+    points (np.ndarray): array of shape (N,3) with the coordinates of the points
+    labels (np.ndarray): optional array of shape (N,) with the CNT of each point. Pairs of points with the same label are not counted.
+    r_max (float): upper limit of the histogram
+    bins (int): number of bins between 0 and r_max
+    workers (int): number of worker processes. None uses all the cores and 1 runs in this process.
+    max_pairs (int): number of point pairs that are generated at a time in each worker
+
+  Returns:
+    np.ndarray of shape (bins,) with the number of pairs in each bin
+  '''
+  points = np.asarray(points, dtype=float).reshape((-1, 3))
+  if labels is None:
+    labels = np.arange(points.shape[0])
+  if points.shape[0] == 0:
+    return np.zeros(bins, dtype=np.int64)
+
+  cells = np.floor((points - points.min(axis=0))/r_max).astype(np.int64)
+  shape = cells.max(axis=0)+1
+  key = np.ravel_multi_index(cells.T, shape)
+  order = np.argsort(key, kind='stable')
+  cell_offsets = np.searchsorted(key[order], np.arange(np.prod(shape)+1))
+  return cell_list_histogram(points[order], np.asarray(labels)[order], cell_offsets, shape, r_max, bins, workers, max_pairs)
+
+def cell_list_histogram(points, labels, cell_offsets: np.ndarray, shape, r_max=50., bins=1000, workers=None, max_pairs=1 << 22,
+                        max_slab_points=1 << 22) -> np.ndarray:
+  '''
+  Histogram of the distances between all pairs of points closer than r_max, from points that are sorted into a cell list with cells
+  of size r_max in C order of the cell grid (x slowest), such as the tiles of mesh_io.write_tiled_mesh with a tile size of r_max.
+  The cells are split into slabs of consecutive layers along x, which hold at most about max_slab_points points and are processed
+  in parallel. Each worker reads only the points of its slab and the next layer of cells, and generates the pairs of points in chunks
+  of about max_pairs, splitting the pairs of large cells into blocks of rows, so the memory use does not depend on the number of points.
+
+  Parameters:
+    points (np.ndarray or str): array of shape (N,3) with the sorted coordinates of the points, or the name of a .npy file with the array,
+      which every worker memory maps instead of receiving a copy
+    labels (np.ndarray or str): array of shape (N,) with the CNT of each point, or the name of a .npy file with the array.
+      Pairs of points with the same label are not counted.
+    cell_offsets (np.ndarray): array of shape (number of cells+1,) so that the points of cell c are points[cell_offsets[c]:cell_offsets[c+1]]
+    shape (tuple(int)): number of cells along x, y and z
+    r_max (float): upper limit of the histogram, which must not be larger than the cell size
+    bins (int): number of bins between 0 and r_max
+    workers (int): number of worker processes. None uses all the cores and 1 runs in this process.
+    max_pairs (int): number of point pairs that are generated at a time in each worker
+    max_slab_points (int): largest number of points of a slab, unless a single layer of cells has more points
+
+  Returns:
+    np.ndarray of shape (bins,) with the number of pairs in each bin
+  '''
+  shape = np.asarray(shape, dtype=np.int64)
+  cell_offsets = np.asarray(cell_offsets, dtype=np.int64)
+  n_yz = int(shape[1]*shape[2])
+  layer_offsets = cell_offsets[::n_yz]
+  n_point = int(cell_offsets[-1])
+  if n_point == 0:
+    return np.zeros(bins, dtype=np.int64)
+
+  # slabs of layers with about the same number of points, at least four per worker for the load balance
+  target = max(1, min(max_slab_points, -(-n_point//(4*(workers or os.cpu_count() or 1)))))
+  group = layer_offsets[:-1] // target
+  bounds = np.append(np.flatnonzero(np.diff(group, prepend=-1)), shape[0])
+
+  def tasks():
+    for first, last in zip(bounds[:-1], bounds[1:]):
+      # the slab and the next layer of cells, for the half shell neighbors
+      cells = cell_offsets[first*n_yz:min(last+1, shape[0])*n_yz+1]
+      cells = np.concatenate((cells, np.full((last+1-first)*n_yz+1-cells.size, cells[-1])))
+      yield (points, labels, cells[0], cells-cells[0], last-first, shape[1:], r_max, bins, max_pairs)
+
+  counts = np.zeros(bins, dtype=np.int64)
+  if workers == 1 or bounds.size < 3:
+    for task in tasks():
+      counts += _slab_histogram(task)
+  else:
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+      # keep a bounded number of slabs in flight
+      in_flight = 2*(workers or os.cpu_count() or 1)
+      pending = []
+      for task in tasks():
+        pending.append(executor.submit(_slab_histogram, task))
+        if len(pending) >= in_flight:
+          counts += pending.pop(0).result()
+      for future in pending:
+        counts += future.result()
+  return counts
+
+def _slab_histogram(task) -> np.ndarray:
+  '''
+  Distance histogram of the pairs of points whose first point is in a slab of home cells; this runs inside the workers of cell_list_histogram
+  '''
+  points, labels, start, cell_start, n_home, n_yz, r_max, bins, max_pairs = task
+  if isinstance(points, str):
+    points, labels = np.load(points, mmap_mode='r'), np.load(labels, mmap_mode='r')
+  stop = start + cell_start[-1]
+  points = np.asarray(points[start:stop], dtype=float)
+  labels = np.asarray(labels[start:stop])
+  dims = np.array([n_home+1, n_yz[0], n_yz[1]])
+  cell_count = np.diff(cell_start)
+
+  # pairs of (home cell, neighbor cell) that contain points
+  home = np.flatnonzero(cell_count[:n_home*dims[1]*dims[2]])
+  home_coor = np.stack(np.unravel_index(home, dims), axis=1)
+  cell_pairs = [np.stack((home, home), axis=1)]
+  for shift in _HALF_SHELL:
+    neighbor = home_coor + shift
+    inside = np.all((neighbor >= 0) & (neighbor < dims), axis=1)
+    neighbor = np.ravel_multi_index(neighbor[inside].T, dims)
+    cell_pairs.append(np.stack((home[inside], neighbor), axis=1))
+  cell_pairs = np.concatenate(cell_pairs)
+  cell_pairs = cell_pairs[cell_count[cell_pairs[:, 1]] > 0]
+
+  # blocks of (first points, second points) with at most max_pairs pairs: the points of the second cell are split into blocks of
+  # at most max_pairs points, and the points of the first cell into blocks of max_pairs // (points of the second block) points
+  first_start, first_count = cell_start[cell_pairs[:, 0]], cell_count[cell_pairs[:, 0]]
+  second_start, second_count = cell_start[cell_pairs[:, 1]], cell_count[cell_pairs[:, 1]]
+  same = cell_pairs[:, 0] == cell_pairs[:, 1]
+  second_start, second_count, same, first_start, first_count = _split_blocks(
+    second_start, second_count, same, first_start, first_count, max_pairs)
+  first_start, first_count, same, second_start, second_count = _split_blocks(
+    first_start, first_count, same, second_start, second_count, np.maximum(1, max_pairs // second_count))
+
+  n_pairs = first_count*second_count
+  group = np.cumsum(n_pairs) // max_pairs
+
+  counts = np.zeros(bins, dtype=np.int64)
+  for g in np.unique(group):
+    select = group == g
+    s1, s2, n2, n, sm = first_start[select], second_start[select], second_count[select], n_pairs[select], same[select]
+    pair_start = np.cumsum(n) - n
+    local = np.arange(n.sum()) - np.repeat(pair_start, n)
+    i = np.repeat(s1, n) + local // np.repeat(n2, n)
+    j = np.repeat(s2, n) + local % np.repeat(n2, n)
+
+    # within the same cell only count i < j
+    keep = (~np.repeat(sm, n) | (i < j)) & (labels[i] != labels[j])
+    i, j = i[keep], j[keep]
+    dist = np.linalg.norm(points[i]-points[j], axis=1)
+    dist = dist[dist < r_max]
+    counts += np.bincount((dist*(bins/r_max)).astype(np.int64), minlength=bins)[:bins]
+
+  return counts
+
+def _split_blocks(start, count, same, other_start, other_count, block_size):
+  '''
+  Split ranges of points (start, count) into consecutive blocks of at most block_size points, repeating the attributes of each range
+
+  Returns:
+    tuple of (start, count, same, other_start, other_count) of the blocks
+  '''
+  block_size = np.broadcast_to(block_size, count.shape)
+  n_block = np.maximum(1, -(-count // block_size))
+  rank = np.arange(n_block.sum()) - np.repeat(np.cumsum(n_block) - n_block, n_block)
+  offset = rank*np.repeat(block_size, n_block)
+  count = np.minimum(np.repeat(block_size, n_block), np.repeat(count, n_block) - offset)
+  return (np.repeat(start, n_block) + offset, count, np.repeat(same, n_block),
+          np.repeat(other_start, n_block), np.repeat(other_count, n_block))
+
+def voxel_counts(chunks, lower, voxel_size, shape) -> np.ndarray:
+  '''
+  Count the points in each voxel of a regular grid, accumulating np.bincount over the linearized voxel indices of chunks of points
+
+  Parameters:
+    chunks (iterable): chunks of points, each an np.ndarray of shape (N,3)
+    lower (np.ndarray): coordinates of the lower corner of the grid
+    voxel_size (float): edge length of the voxels
+    shape (tuple(int)): number of voxels along x, y and z. Points outside the grid are counted in the nearest voxel.
+
+  Returns:
+    np.ndarray of the given shape with the number of points in each voxel
+  '''
+  shape = tuple(int(n) for n in shape)
+  counts = np.zeros(np.prod(shape), dtype=np.int64)
+  for points in chunks:
+    index = np.floor((np.reshape(points, (-1, 3))-lower)/voxel_size).astype(np.int64)
+    index = np.clip(index, 0, np.array(shape)-1)
+    counts += np.bincount(np.ravel_multi_index(index.T, shape), minlength=counts.size)
+  return counts.reshape(shape)
+
+def dense_box(counts: np.ndarray, threshold=0.5, max_iterations=10) -> Tuple[np.ndarray, np.ndarray]:
+  '''
+  Find the box of voxels that excludes the low density regions at the boundary of a mesh, such as the sparse top layer and the edges of the container.
+  Along each axis the density of every slab of voxels is compared to the median density of the non-empty slabs, and the box
+  is limited to the longest run of slabs with at least threshold times that density. As the density profile along one axis depends
+  on the range of the other two axes, the profiles are recalculated inside the current box until the box does not change.
+
+  Parameters:
+    counts (np.ndarray): array of shape (nx, ny, nz) with the number of points per voxel, see `voxel_counts`
+    threshold (float): minimum density of a usable slab relative to the median density. Along an axis without any slab this dense
+      (which needs a threshold above 1) the range of the box is not changed.
+    max_iterations (int): maximum number of times the profiles are recalculated
+
+  Returns:
+    tuple of (start, stop): np.ndarray of shape (3,) so that counts[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]] is the usable box
+  '''
+  start, stop = np.zeros(3, dtype=np.int64), np.array(counts.shape, dtype=np.int64)
+  for _ in range(max_iterations):
+    new_start, new_stop = start.copy(), stop.copy()
+    for axis in range(3):
+      box = tuple(slice(None) if a == axis else slice(start[a], stop[a]) for a in range(3))
+      others = tuple(a for a in range(3) if a != axis)
+      profile = counts[box].sum(axis=others) / max(1, np.prod([stop[a]-start[a] for a in others]))
+      if not np.any(profile > 0):
+        continue
+      dense = np.concatenate(([False], profile >= threshold*np.median(profile[profile > 0]), [False]))
+      edges = np.flatnonzero(np.diff(dense.astype(np.int8)))
+      runs = edges.reshape((-1, 2))
+      if runs.shape[0] == 0:
+        # no slab is dense enough, keep the current range of this axis
+        continue
+      longest = runs[np.argmax(runs[:, 1]-runs[:, 0])]
+      new_start[axis], new_stop[axis] = longest
+    if np.array_equal(new_start, start) and np.array_equal(new_stop, stop):
+      break
+    start, stop = new_start, new_stop
+  return start, stop
+
+def neighbor_pairs(points_1: np.ndarray, points_2: np.ndarray, labels_1=None, labels_2=None, radius=20., min_distance=0., tree_2=None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  '''
+  Find the pairs of a point of points_1 and a point of points_2 within a radius, e.g. the scatterers an exciton can hop to
+
+  Parameters:
+    points_1, points_2 (np.ndarray): arrays of shape (N1,3) and (N2,3) with the coordinates of the points
+    labels_1, labels_2 (np.ndarray): optional arrays of shape (N1,) and (N2,) with the CNT of each point. Points with the same label are not neighbors.
+    radius (float): largest distance between two neighbors (exclusive)
+    min_distance (float): smallest distance between two neighbors (exclusive)
+    tree_2 (cKDTree): KD-tree of points_2, to reuse it for several sets of points_1
+
+  Returns:
+    tuple of (i, j, distances): the indices of the pairs in points_1 and points_2 and their distances, sorted by i and then by j
+  '''
+  tree_2 = tree_2 if tree_2 is not None else cKDTree(points_2)
+  pairs = cKDTree(points_1).sparse_distance_matrix(tree_2, radius, output_type='ndarray')
+  i, j, dist = pairs['i'], pairs['j'], pairs['v']
+  keep = (dist > min_distance) & (dist < radius)
+  if labels_1 is not None:
+    keep &= np.asarray(labels_1)[i] != np.asarray(labels_2)[j]
+  i, j, dist = i[keep], j[keep], dist[keep]
+  order = np.lexsort((j, i))
+  return i[order], j[order], dist[order]
+
+def neighbor_list_chunks(points: np.ndarray, labels=None, radius=20., min_distance=0., chunk_size=50000):
+  '''
+  Find the neighbors of every point within a radius, chunk by chunk of consecutive points (see `neighbor_pairs`).
+  The points and a KD-tree of all of them are held in memory, and only the pairs are generated a chunk at a time;
+  mesh_io.write_neighbor_list finds the neighbors of a mesh that does not fit in memory tile by tile instead.
+
+  Parameters:
+    points (np.ndarray): array of shape (N,3) with the coordinates of the points
+    labels (np.ndarray): optional array of shape (N,) with the CNT of each point. Points with the same label are not neighbors.
+    radius (float): largest distance between two neighbors (exclusive)
+    min_distance (float): smallest distance between two neighbors (exclusive)
+    chunk_size (int): number of points whose neighbors are found at a time
+
+  Yields:
+    tuple of (count, indices, distances) for each chunk: np.ndarray with the number of neighbors of each point of the chunk,
+    and the indices of the neighbors and their distances in the order of the points, with the neighbors of each point sorted by index
+  '''
+  points = np.asarray(points, dtype=float).reshape((-1, 3))
+  tree = cKDTree(points)
+  for start in range(0, points.shape[0], chunk_size):
+    stop = min(start+chunk_size, points.shape[0])
+    chunk_labels = labels[start:stop] if labels is not None else None
+    i, j, dist = neighbor_pairs(points[start:stop], points, chunk_labels, labels, radius, min_distance, tree_2=tree)
+    yield np.bincount(i, minlength=stop-start), j, dist
+
+def neighbor_list(points: np.ndarray, labels=None, radius=20., min_distance=0., chunk_size=50000) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  '''
+  Find the neighbors of every point within a radius in compressed sparse row (CSR) form, see `neighbor_list_chunks`
+
+  Returns:
+    tuple of (offsets, indices, distances): the neighbors of point i are indices[offsets[i]:offsets[i+1]]
+    at the distances distances[offsets[i]:offsets[i+1]]
+  '''
+  count, indices, distances = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+  for c, j, dist in neighbor_list_chunks(points, labels, radius, min_distance, chunk_size):
+    count.append(c)
+    indices.append(j)
+    distances.append(dist)
+  count = np.concatenate(count)
+  offsets = np.zeros(count.size+1, dtype=np.int64)
+  np.cumsum(count, out=offsets[1:])
+  return offsets, np.concatenate(indices), np.concatenate(distances)
+
+def hopping_geometry(pos_1: np.ndarray, orient_1: np.ndarray, pos_2: np.ndarray, orient_2: np.ndarray, parallel_tolerance=1e-12) -> np.ndarray:
+  '''
+  Relative geometry of pairs of CNT segments that parameterizes the scatter table of the monte carlo code, vectorized over the pairs.
+  This follows scatterer::find_neighbors: theta is the angle between the orientations, axis_shift_1 and axis_shift_2 are the positions
+  of the closest points of the two axes relative to each segment, and z_shift is the distance between these closest points.
+  Pairs with 1-cos(theta)^2 below parallel_tolerance use the parallel form of the C++ code (axis_shift_1=0), which is also applied
+  to antiparallel pairs, where the C++ code divides by zero.
+
+  Parameters:
+    pos_1, pos_2 (np.ndarray): arrays of shape (N,3) with the positions of the first (donor) and second (acceptor) segments
+    orient_1, orient_2 (np.ndarray): arrays of shape (N,3) with the unit orientation vectors of the segments
+
+  Returns:
+    np.ndarray of shape (N,4) with the columns (theta [radians], z_shift, axis_shift_1, axis_shift_2) in the length unit of the positions
+  '''
+  dR = pos_1 - pos_2
+  cos_theta = np.clip(np.einsum('ij,ij->i', orient_1, orient_2), -1., 1.)
+  y1 = np.einsum('ij,ij->i', orient_1, dR)
+  y2 = np.einsum('ij,ij->i', orient_2, dR)
+  sin2_theta = 1 - cos_theta**2
+  parallel = sin2_theta < parallel_tolerance
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    axis_shift_1 = np.where(parallel, 0., (y1 + y2*cos_theta)/sin2_theta)
+    axis_shift_2 = np.where(parallel, y1, (y2 + y1*cos_theta)/sin2_theta)
+  closest = np.where(parallel[:, np.newaxis], dR - y1[:, np.newaxis]*orient_1,
+                     axis_shift_1[:, np.newaxis]*orient_1 + dR - axis_shift_2[:, np.newaxis]*orient_2)
+  theta = np.where(parallel & (cos_theta > 0), 0., np.arccos(cos_theta))
+  return np.stack((theta, np.linalg.norm(closest, axis=1), axis_shift_1, axis_shift_2), axis=1)
+
+def table_weights(values: np.ndarray, axis: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+  '''
+  Locate values on an increasing table axis for linear interpolation; values outside the axis are clamped to its ends.
+  The nearest grid point, which the C++ scattering_struct::get_rate uses, is index + (weight > 0.5).
+
+  Parameters:
+    values (np.ndarray): values to locate
+    axis (np.ndarray): increasing grid points of the table axis
+
+  Returns:
+    tuple of (index, weight): the values are interpolated as (1-weight)*table[index] + weight*table[index+1]
+  '''
+  axis = np.asarray(axis, dtype=float)
+  if axis.size < 2:
+    return np.zeros(np.shape(values), dtype=np.int64), np.zeros(np.shape(values))
+  index = np.clip(np.searchsorted(axis, values, side='right')-1, 0, axis.size-2)
+  weight = np.clip((values-axis[index])/(axis[index+1]-axis[index]), 0., 1.)
+  return index, weight
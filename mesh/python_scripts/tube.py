@@ -1,7 +1,8 @@
 import numpy as np
 from scipy import interpolate
 import matplotlib.pyplot as plt
-from typing import List
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Tuple
 
 """
 # Definition of tube class
@@ -21,6 +22,18 @@ class fiber:
     self.scale(scaleFactor)
     self.chiral = chiral
 
+  @classmethod
+  def view(cls, r, chiral):
+    '''
+    Create a fiber that shares the coordinate array `r` instead of copying and scaling it.
+    This is used by FiberCollection to expose each fiber as a view into its concatenated arrays.
+    '''
+    f = cls.__new__(cls)
+    f._r = r
+    f._scaleFactor = 1
+    f.chiral = chiral
+    return f
+
   def get_chiral(self):
     return self.chiral
 
@@ -61,11 +74,10 @@ class fiber:
     Return:
       np.ndarray of shape (n,3) where n is the new number of points
     """
-    tck, u = interpolate.splprep([self._r[:,0], self._r[:,1], self._r[:,2]], s=s, k=3)
-    u_fine = np.linspace(0,1,n)
-    x_fine, y_fine, z_fine = interpolate.splev(u_fine, tck)
-    r_fine = np.stack((x_fine, y_fine, z_fine), axis=-1)
+    r_fine, tck, u = _interpolate(self._r, n=n, s=s, k=k)
     self._tck, self._u = tck, u
+    if hasattr(self, '_t_fine'):
+      del self._t_fine
     return r_fine
 
   def r_fine(self, n=100, s=500, k=3):
@@ -89,16 +101,11 @@ class fiber:
     Returns:
       np.ndarray of shape (N,3): normalized tangent vectors at the interpolated points
     """
-    if not hasattr(self, '_tck'):
-      self.calculate_r_fine()
-    tck = self._tck
-    u_fine = np.linspace(0, 1, self.r(mode='fine').shape[0])
-    deriv_x, deriv_y, deriv_z = interpolate.splev(u_fine, tck, der=1)
-    t_vec = np.stack((deriv_x, deriv_y, deriv_z), axis=1)
-    
-    normalize = lambda v: v/np.linalg.norm(v)
-    t_vec = np.apply_along_axis(normalize, axis=1, arr=t_vec)
-    return t_vec
+    if not hasattr(self, '_t_fine'):
+      if not hasattr(self, '_tck'):
+        self.calculate_r_fine()
+      self._t_fine = _tangents(self._tck, self.r(mode='fine').shape[0])
+    return self._t_fine
 
   def scale(self, factor=10):
     '''
@@ -109,6 +116,8 @@ class fiber:
     '''
     if hasattr(self,'_r_fine'):
       del self._r_fine
+    if hasattr(self,'_t_fine'):
+      del self._t_fine
     self._r = factor*self._r
 
   def avg_y(self):
@@ -146,3 +155,367 @@ class fiber:
       mode (str): determines if 'rough' mesh is returned or 'fine' mesh is returned
     '''
     return self.r(mode)[:, 2]
+
+
+class FiberCollection:
+  """
+  struct-of-arrays container for all the fibers of a mesh.
+  The rough (and, once calculated, fine) coordinates of all fibers are stored in concatenated arrays of shape (N,3)
+  with CSR-style offsets, so that the points of fiber i are r[offsets[i]:offsets[i+1]].
+  Iterating or indexing the collection returns `fiber` objects that are views into these arrays.
+  """
+
+  __slots__ = ('_r', '_offsets', '_chiral', '_r_fine', '_t_fine', '_fine_offsets', '_fibers')
+
+  def __init__(self, r, offsets, chiral):
+    '''
+    Class constructor
+
+    Parameters:
+      r (np.ndarray): array of shape (N,3) with the rough coordinates of all fibers
+      offsets (np.ndarray): array of shape (n_fibers+1,) with the start of each fiber in r
+      chiral (np.ndarray): array of shape (n_fibers,2) with the chirality of each fiber
+    '''
+    self._r = np.asarray(r, dtype=float).reshape((-1, 3))
+    self._offsets = np.asarray(offsets, dtype=np.int64)
+    self._chiral = np.asarray(chiral, dtype=float).reshape((-1, 2))
+    assert (self._offsets[0] == 0 and self._offsets[-1] == self._r.shape[0]), "offsets do not match the coordinates"
+    assert (self._chiral.shape[0] == len(self)), "there should be one chirality per fiber"
+    self._r_fine = None
+    self._t_fine = None
+    self._fine_offsets = None
+    self._fibers = None
+
+  @classmethod
+  def from_fibers(cls, fibers: List[fiber]):
+    '''
+    Create a collection from a list of fiber objects
+    '''
+    offsets = np.zeros(len(fibers)+1, dtype=np.int64)
+    np.cumsum([f.num_nodes('rough') for f in fibers], out=offsets[1:])
+    r = np.concatenate([f.r('rough') for f in fibers]) if fibers else np.zeros((0, 3))
+    chiral = np.array([np.ravel(f.get_chiral()) for f in fibers]).reshape((-1, 2))
+    return cls(r, offsets, chiral)
+
+  def __len__(self):
+    return self._offsets.shape[0]-1
+
+  def __iter__(self):
+    return iter(self.fibers())
+
+  def __getitem__(self, key):
+    '''
+    Returns:
+      fiber for an integer key, FiberCollection for a slice or an array of indices
+    '''
+    if isinstance(key, slice):
+      start, stop, step = key.indices(len(self))
+      if step == 1:
+        return self._subset(start, max(start, stop))
+      return self.take(np.arange(start, stop, step))
+    if np.ndim(key) > 0:
+      return self.take(key)
+    return self.fibers()[key]
+
+  def fibers(self) -> List[fiber]:
+    '''
+    Get the list of fiber objects that are views into the concatenated coordinate arrays
+    '''
+    if self._fibers is None:
+      chiral = self._chiral.tolist()
+      self._fibers = [fiber.view(self._r[self._offsets[i]:self._offsets[i+1]], [chiral[i]]) for i in range(len(self))]
+      self._attach_fine()
+    return self._fibers
+
+  def _attach_fine(self):
+    '''
+    Point the fine mesh of each fiber view to its part of the concatenated fine mesh
+    '''
+    if self._fibers is None or self._r_fine is None:
+      return
+    for i, f in enumerate(self._fibers):
+      f._r_fine = self._r_fine[self._fine_offsets[i]:self._fine_offsets[i+1]]
+      if self._t_fine is not None:
+        f._t_fine = self._t_fine[self._fine_offsets[i]:self._fine_offsets[i+1]]
+
+  def _subset(self, start, stop):
+    '''
+    Get a collection of fibers start to stop that shares its arrays with this collection
+    '''
+    sub = FiberCollection(self._r[self._offsets[start]:self._offsets[stop]], self._offsets[start:stop+1]-self._offsets[start], self._chiral[start:stop])
+    if self._r_fine is not None:
+      sub._r_fine = self._r_fine[self._fine_offsets[start]:self._fine_offsets[stop]]
+      if self._t_fine is not None:
+        sub._t_fine = self._t_fine[self._fine_offsets[start]:self._fine_offsets[stop]]
+      sub._fine_offsets = self._fine_offsets[start:stop+1]-self._fine_offsets[start]
+    if self._fibers is not None:
+      sub._fibers = self._fibers[start:stop]
+    return sub
+
+  def chunks(self, chunk_size=1000):
+    '''
+    Iterate over consecutive collections of at most chunk_size fibers that share their arrays with this collection
+    '''
+    for start in range(0, len(self), chunk_size):
+      yield self._subset(start, min(start+chunk_size, len(self)))
+
+  def is_interpolated(self) -> bool:
+    '''
+    Check if the fine mesh of the fibers has been calculated
+    '''
+    return self._r_fine is not None
+
+  def take(self, indices):
+    '''
+    Get a new collection made of copies of the fibers with the given indices
+
+    Parameters:
+      indices (array like): indices of the fibers in this collection
+    '''
+    indices = np.arange(len(self))[indices]
+    r, offsets = _gather(self._r, self._offsets, indices)
+    sub = FiberCollection(r, offsets, self._chiral[indices])
+    if self._r_fine is not None:
+      sub._r_fine, sub._fine_offsets = _gather(self._r_fine, self._fine_offsets, indices)
+      if self._t_fine is not None:
+        sub._t_fine, _ = _gather(self._t_fine, self._fine_offsets, indices)
+    return sub
+
+  def r(self, mode='rough', n=100, s=500, k=3) -> np.ndarray:
+    '''
+    get concatenated coordinates of all fibers in 'rough' or 'fine' mode
+
+    Parameters:
+      mode (str): determines if 'rough' mesh is returned or 'fine' mesh is returned
+      n (int): integer indicating the number of points in the fine mesh of each fiber
+      s (int): A smoothing condition. Larger s means more smoothing while smaller values of s indicate less smoothing.
+      k (int): Degree of spline
+
+    Returns:
+      np.ndarray of shape (N,3) where N is the total number of points; use `offsets(mode)` to find each fiber
+    '''
+    if mode == 'rough':
+      return self._r
+    if mode == 'fine':
+      if self._r_fine is None:
+        r_fine = [f.r(mode='fine', n=n, s=s, k=k) for f in self.fibers()]
+        self._set_fine(r_fine)
+      return self._r_fine
+    raise ValueError(f'Unknown mode: {mode}')
+
+  def calculate_r_fine(self, n=100, s=500, k=3, workers=None, chunk_size=1000, pool='process'):
+    '''
+    Interpolate the rough curves of all fibers to get finer mesh points and their tangent vectors,
+    in chunks of fibers spread over a pool of workers.
+    The spline of each fiber is calculated exactly as in `fiber.calculate_r_fine`, and the results are stored back
+    into the collection and its fiber views in the order of the fibers, so the output does not depend on the pool.
+
+    Parameters:
+      n (int): integer indicating the number of points in the fine mesh of each fiber
+      s (int): A smoothing condition. Larger s means more smoothing while smaller values of s indicate less smoothing.
+      k (int): Degree of spline
+      workers (int): number of workers in the pool. None uses all the cores and 1 interpolates serially in this process.
+      chunk_size (int): number of fibers sent to a worker at a time
+      pool (str): 'process' or 'thread' pool
+
+    Returns:
+      np.ndarray of shape (N,3) with the concatenated fine mesh of all fibers
+    '''
+    chunks = [(self._r[self._offsets[i]:self._offsets[j]], self._offsets[i:j+1]-self._offsets[i], n, s, k)
+              for i, j in _chunk_bounds(len(self), chunk_size)]
+
+    if workers == 1 or len(chunks) < 2:
+      results = [_interpolate_chunk(c) for c in chunks]
+    else:
+      if pool == 'process':
+        executor = ProcessPoolExecutor(max_workers=workers)
+      elif pool == 'thread':
+        executor = ThreadPoolExecutor(max_workers=workers)
+      else:
+        raise ValueError(f'Unknown pool: {pool}')
+      with executor:
+        results = list(executor.map(_interpolate_chunk, chunks))
+
+    r_fine, t_fine, tck, u = [], [], [], []
+    for result in results:
+      r_fine.extend(result[0])
+      t_fine.extend(result[1])
+      tck.extend(result[2])
+      u.extend(result[3])
+
+    self._set_fine(r_fine, t_fine)
+    for f, f_tck, f_u in zip(self.fibers(), tck, u):
+      f._tck, f._u = f_tck, f_u
+    return self._r_fine
+
+  def _set_fine(self, r_fine: List[np.ndarray], t_fine=None):
+    '''
+    Store the fine mesh (and optionally the tangent vectors) of each fiber in the concatenated fine mesh arrays
+    '''
+    self._fine_offsets = np.zeros(len(self)+1, dtype=np.int64)
+    np.cumsum([r.shape[0] for r in r_fine], out=self._fine_offsets[1:])
+    self._r_fine = np.concatenate(r_fine) if r_fine else np.zeros((0, 3))
+    self._t_fine = None
+    if t_fine is not None:
+      self._t_fine = np.concatenate(t_fine) if t_fine else np.zeros((0, 3))
+    self._attach_fine()
+
+  def tangent_vecs(self) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Get the normalized tangent vectors at the fine mesh points of all fibers
+
+    Returns:
+      tuple of (t, offsets) where t is np.ndarray of shape (N,3) in the same order as `r('fine')`
+      and offsets are the CSR-style offsets of the fine mesh
+    '''
+    if self._t_fine is None:
+      self._t_fine = np.concatenate([f.tangent_vec() for f in self.fibers()]) if len(self) else np.zeros((0, 3))
+      self._attach_fine()
+    return self._t_fine, self.offsets('fine')
+
+  def offsets(self, mode='rough') -> np.ndarray:
+    '''
+    get CSR-style offsets of the fibers in the concatenated coordinates of 'rough' or 'fine' mode
+
+    Returns:
+      np.ndarray of shape (n_fibers+1,)
+    '''
+    if mode == 'rough':
+      return self._offsets
+    if mode == 'fine':
+      self.r(mode)
+      return self._fine_offsets
+    raise ValueError(f'Unknown mode: {mode}')
+
+  def num_nodes(self, mode='rough') -> np.ndarray:
+    '''
+    Get the number of nodes in each fiber
+
+    Returns:
+      np.ndarray of shape (n_fibers,)
+    '''
+    return np.diff(self.offsets(mode))
+
+  def get_chiral(self) -> np.ndarray:
+    '''
+    Returns:
+      np.ndarray of shape (n_fibers,2) with the chirality of each fiber
+    '''
+    return self._chiral
+
+  def scale(self, factor=10):
+    '''
+    Scale the rough coordinates of all fibers by a multiplication factor and discard the fine mesh
+    '''
+    self._r = factor*self._r
+    self._r_fine = None
+    self._t_fine = None
+    self._fine_offsets = None
+    self._fibers = None
+
+  def min(self, mode='rough') -> np.ndarray:
+    '''
+    Returns:
+      np.ndarray of shape (3,) with the minimum x, y and z coordinates over all fibers
+    '''
+    return self.r(mode).min(axis=0)
+
+  def max(self, mode='rough') -> np.ndarray:
+    '''
+    Returns:
+      np.ndarray of shape (3,) with the maximum x, y and z coordinates over all fibers
+    '''
+    return self.r(mode).max(axis=0)
+
+  def mean(self, mode='rough') -> np.ndarray:
+    '''
+    Returns:
+      np.ndarray of shape (3,) with the mean x, y and z coordinates over all points of all fibers
+    '''
+    return self.r(mode).mean(axis=0)
+
+  def fiber_min(self, mode='rough') -> np.ndarray:
+    '''
+    Returns:
+      np.ndarray of shape (n_fibers,3) with the minimum coordinates of each fiber
+    '''
+    return np.minimum.reduceat(self.r(mode), self.offsets(mode)[:-1], axis=0)
+
+  def fiber_max(self, mode='rough') -> np.ndarray:
+    '''
+    Returns:
+      np.ndarray of shape (n_fibers,3) with the maximum coordinates of each fiber
+    '''
+    return np.maximum.reduceat(self.r(mode), self.offsets(mode)[:-1], axis=0)
+
+  def fiber_mean(self, mode='rough') -> np.ndarray:
+    '''
+    Returns:
+      np.ndarray of shape (n_fibers,3) with the mean coordinates of each fiber
+    '''
+    return np.add.reduceat(self.r(mode), self.offsets(mode)[:-1], axis=0)/self.num_nodes(mode)[:, np.newaxis]
+
+  def avg_y(self) -> np.ndarray:
+    '''
+    Get the average of fiber coordinates along y axis for each fiber
+
+    Returns:
+      np.ndarray of shape (n_fibers,)
+    '''
+    return self.fiber_mean()[:, 1]
+
+def _interpolate(r: np.ndarray, n=100, s=500, k=3):
+  '''
+  Interpolate the points r of one fiber with a B-spline curve
+
+  Returns:
+    tuple of (r_fine, tck, u) where r_fine is np.ndarray of shape (n,3) and (tck, u) are the outputs of splprep
+  '''
+  tck, u = interpolate.splprep([r[:,0], r[:,1], r[:,2]], s=s, k=k)
+  u_fine = np.linspace(0,1,n)
+  x_fine, y_fine, z_fine = interpolate.splev(u_fine, tck)
+  r_fine = np.stack((x_fine, y_fine, z_fine), axis=-1)
+  return r_fine, tck, u
+
+def _tangents(tck, n=100):
+  '''
+  Evaluate the normalized tangent vectors of a B-spline curve at n equally spaced parameter values
+
+  Returns:
+    np.ndarray of shape (n,3)
+  '''
+  u_fine = np.linspace(0, 1, n)
+  deriv_x, deriv_y, deriv_z = interpolate.splev(u_fine, tck, der=1)
+  t_vec = np.stack((deriv_x, deriv_y, deriv_z), axis=1)
+  return t_vec/np.linalg.norm(t_vec, axis=1, keepdims=True)
+
+def _interpolate_chunk(chunk):
+  '''
+  Interpolate a chunk of fibers given as (r, offsets, n, s, k); this runs inside the workers of FiberCollection.calculate_r_fine
+
+  Returns:
+    tuple of lists (r_fine, t_fine, tck, u) with one entry per fiber
+  '''
+  r, offsets, n, s, k = chunk
+  results = [_interpolate(r[offsets[i]:offsets[i+1]], n=n, s=s, k=k) for i in range(len(offsets)-1)]
+  t_fine = [_tangents(res[1], res[0].shape[0]) for res in results]
+  return [res[0] for res in results], t_fine, [res[1] for res in results], [res[2] for res in results]
+
+def _chunk_bounds(length, chunk_size):
+  '''
+  Split range(length) into consecutive (start, stop) chunks of at most chunk_size elements
+  '''
+  return [(i, min(i+chunk_size, length)) for i in range(0, length, chunk_size)]
+
+def _gather(r: np.ndarray, offsets: np.ndarray, indices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+  '''
+  Gather the rows of a CSR-style array for a set of fiber indices
+
+  Returns:
+    tuple of (r, offsets) for the gathered fibers
+  '''
+  counts = np.diff(offsets)[indices]
+  new_offsets = np.zeros(len(indices)+1, dtype=np.int64)
+  np.cumsum(counts, out=new_offsets[1:])
+  rows = np.repeat(offsets[indices]-new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+  return r[rows], new_offsets
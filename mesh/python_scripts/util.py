@@ -1,4 +1,5 @@
 import numpy as np
+import functools
 
 def cartesian_basis_vector(z_axis):
   """
@@ -30,6 +31,43 @@ def cartesian_basis_vector(z_axis):
   
   return a1, a2, a3
 
+def cartesian_basis_vectors(z_axes):
+  """
+  batched version of cartesian_basis_vector for a set of z axes
+
+  Parameters
+  ----------
+  z_axes : numpy.ndarray of shape (N,3)
+
+  Returns
+  -------
+  a1 : numpy.ndarray of shape (N,3) along x-axis. a1 is normalized
+  a2 : numpy.ndarray of shape (N,3) along y-axis. a2 is normalized
+  a3 : numpy.ndarray of shape (N,3) along z-axis. a3 is normalized
+
+  Notes
+  -----
+  The random x axes are drawn from the global numpy random state in the same order as N calls to cartesian_basis_vector
+  """
+  z_axes = np.reshape(z_axes, (-1, 3))
+  norm = np.linalg.norm(z_axes, axis=1, keepdims=True)
+  assert np.all(norm > 0), "a3 vectors should not have magnitude of zero."
+
+  a3 = z_axes/norm
+
+  a1 = np.zeros(a3.shape)
+  redo = np.ones(a3.shape[0], dtype=bool)
+  while np.any(redo):
+    a1[redo] = np.random.uniform(-1, 1, (np.count_nonzero(redo), 3))
+    a1[redo] -= np.sum(a1[redo]*a3[redo], axis=1, keepdims=True)*a3[redo]
+    redo = np.linalg.norm(a1, axis=1) == 0
+  a1 /= np.linalg.norm(a1, axis=1, keepdims=True)
+
+  a2 = np.cross(a3, a1)
+  a2 /= np.linalg.norm(a2, axis=1, keepdims=True)
+
+  return a1, a2, a3
+
 def direction_cosine(axis):
   """
   get direction cosine for an input vector
@@ -78,6 +116,7 @@ def rotation_from_quaternion(q):
   look here for more:
   https://en.wikipedia.org/wiki/Conversion_between_quaternions_and_Euler_angles
   """
+  q = np.ravel(q)
   R = np.zeros((3, 3))
   R[0, 0] = q[0]**2+q[1]**2-q[2]**2-q[3]**2
   R[0, 1] = 2*(q[1]*q[2]-q[0]*q[3])
@@ -90,58 +129,196 @@ def rotation_from_quaternion(q):
   R[2, 2] = q[0]**2-q[1]**2-q[2]**2+q[3]**2
   return R
 
-def HCP_coordinates(diameter=5, lattice_constant=1) -> np.ndarray:
+def rotation_from_axis_angle(axis, alpha):
   """
-  Get coordinates of a hexagonal close-packed (HCP) lattice in a circular area.
-  We do this by using a BFS algorithm to check all the neighbors.
-  
+  batched version of rotation_from_quaternion(get_quaternion(axis, alpha)), i.e. the Rodrigues rotation in quaternion form
+
   Parameters
   ----------
-    diameter : diameter of the circular area
-    lattice_constant : lattice constant for the HCP lattice
+  axis : numpy.ndarray of shape (...,3), rotation axes (do not need to be normalized)
+  alpha : numpy.ndarray of shape (...), rotation angles
 
   Returns
   -------
-    coordinates : numpy.ndarray with shape (N,2) where N is the number of points in the lattice
+  R : numpy.ndarray of shape (...,3,3) with the rotation matrices. Zero angles or zero axes give the identity matrix.
   """
-  coordinates = np.zeros((0, 2))
-  a = [np.array([1, 0]), np.array([np.cos(np.pi/3), np.sin(np.pi/3)])]
-  a = [base*lattice_constant for base in a]
+  axis = np.asarray(axis, dtype=float)
+  n = np.linalg.norm(axis, axis=-1, keepdims=True)
+  beta = np.divide(axis, n, out=np.zeros(axis.shape), where=n > 0)
 
-  s = [[0, 0]]
-  visited = []
-  while(len(s) > 0):
-    node = s.pop()
-    if (node in visited):
-      continue
+  q0 = np.cos(alpha/2)
+  q1, q2, q3 = np.moveaxis(np.sin(alpha/2)[..., np.newaxis]*beta, -1, 0)
 
-    c = node[0]*a[0]+node[1]*a[1]
-    if (np.linalg.norm(c) < diameter):
-      coordinates = np.vstack((coordinates, c))
-      visited.append(node)
+  R = np.empty(axis.shape[:-1]+(3, 3))
+  R[..., 0, 0] = q0**2+q1**2-q2**2-q3**2
+  R[..., 0, 1] = 2*(q1*q2-q0*q3)
+  R[..., 0, 2] = 2*(q0*q2+q1*q3)
+  R[..., 1, 0] = 2*(q1*q2+q0*q3)
+  R[..., 1, 1] = q0**2-q1**2+q2**2-q3**2
+  R[..., 1, 2] = 2*(q2*q3-q0*q1)
+  R[..., 2, 0] = 2*(q1*q3-q0*q2)
+  R[..., 2, 1] = 2*(q0*q1+q2*q3)
+  R[..., 2, 2] = q0**2-q1**2-q2**2+q3**2
+  return R
 
-      nextNode = [node[0]+1, node[1]+0]
-      if (not nextNode in visited):
-        s.append(nextNode)
+def cumulative_matmul(M):
+  """
+  cumulative product of a sequence of matrices: out[..., i, :, :] = M[..., i, :, :] @ M[..., i-1, :, :] @ ... @ M[..., 0, :, :]
+  The product is calculated as a parallel prefix scan with log2(n) batched matrix multiplications.
 
-      nextNode = [node[0]+0, node[1]+1]
-      if (not nextNode in visited):
-        s.append(nextNode)
+  Parameters
+  ----------
+  M : numpy.ndarray of shape (..., n, 3, 3)
 
-      nextNode = [node[0]-1, node[1]+1]
-      if (not nextNode in visited):
-        s.append(nextNode)
+  Returns
+  -------
+  numpy.ndarray of the same shape as M
+  """
+  out = np.array(M, dtype=float)
+  n = out.shape[-3]
+  d = 1
+  while d < n:
+    out[..., d:, :, :] = np.matmul(out[..., d:, :, :], out[..., :-d, :, :])
+    d *= 2
+  return out
+
+def parallel_transport_frames(tangents, a1, a2):
+  """
+  rotate an initial pair of cross-section axes along a set of curves so that they stay perpendicular to the tangent vectors.
+  At each point the frame is rotated around the cross product of the previous and the current tangent vector
+  by the arcsin of its magnitude, as in the per-point loop that used get_quaternion and rotation_from_quaternion.
+
+  Parameters
+  ----------
+  tangents : numpy.ndarray of shape (N,n,3), normalized tangent vectors at the n points of N curves
+  a1 : numpy.ndarray of shape (N,3), first cross-section axis of each curve
+  a2 : numpy.ndarray of shape (N,3), second cross-section axis of each curve
+
+  Returns
+  -------
+  a1 : numpy.ndarray of shape (N,n,3) with the first cross-section axis at each point
+  a2 : numpy.ndarray of shape (N,n,3) with the second cross-section axis at each point
+  """
+  tangents = np.asarray(tangents, dtype=float)
+  a1 = np.reshape(a1, (-1, 3))
+  a2 = np.reshape(a2, (-1, 3))
 
-      nextNode = [node[0]-1, node[1]+0]
-      if (not nextNode in visited):
-        s.append(nextNode)
+  first = tangents[:, :1, :]/np.linalg.norm(tangents[:, :1, :], axis=-1, keepdims=True)
+  previous = np.concatenate((first, tangents[:, :-1, :]), axis=1)
+
+  axis = np.cross(previous, tangents)
+  alpha = np.arcsin(np.minimum(np.linalg.norm(axis, axis=-1), 1))
+  frames = cumulative_matmul(rotation_from_axis_angle(axis, alpha))
+
+  a1 = np.einsum('fnij,fj->fni', frames, a1)
+  a2 = np.einsum('fnij,fj->fni', frames, a2)
+  return a1, a2
+
+def random_molecules(rng, num_point, box):
+  """
+  positions uniformly distributed in a box and isotropically distributed orientations of a set of molecules
+
+  Parameters
+  ----------
+  rng : numpy.random.Generator used to draw the random numbers
+  num_point : number of molecules
+  box : size of the box along x, y and z, the box starts at the origin
+
+  Returns
+  -------
+  pos : numpy.ndarray of shape (num_point,3) with the positions
+  orient : numpy.ndarray of shape (num_point,3) with the normalized orientations
+  """
+  pos = rng.random((num_point, 3))
+  pos *= np.asarray(box, dtype=float)
+
+  polar = rng.random((num_point, 2))
+  theta = np.arccos(1-2*polar[:, 0])
+  phi = 2*np.pi*polar[:, 1]
+
+  orient = np.empty((num_point, 3))
+  orient[:, 0] = np.sin(theta) * np.cos(phi)
+  orient[:, 1] = np.sin(theta) * np.sin(phi)
+  orient[:, 2] = np.cos(theta)
+  return pos, orient
+
+def random_walk_fibers(rng, num_fiber, num_section, box, section_length=10., bending=0.2):
+  """
+  random walk fibers in a box, as a stand-in for the fiber mesh of BulletPhysics: the sections of each fiber are a fixed
+  length apart and the direction of each section is the direction of the previous section plus a random kick. The fibers
+  start at uniformly distributed points with isotropically distributed directions and are folded back into the box at
+  its faces like reflected light, so the walks stay continuous.
+
+  Parameters
+  ----------
+  rng : numpy.random.Generator used to draw the random numbers
+  num_fiber : number of fibers
+  num_section : number of sections per fiber, or (min, max) to draw the number of each fiber uniformly from [min, max]
+  box : size of the box along x, y and z, the box starts at the origin
+  section_length : distance between neighboring sections, or (min, max) to draw the distance of each fiber uniformly
+  bending : standard deviation of each component of the random kick of the unit direction between two sections
+
+  Returns
+  -------
+  r : numpy.ndarray of shape (N,3) with the positions of the sections of all fibers
+  offsets : numpy.ndarray of shape (num_fiber+1,) so that r[offsets[i]:offsets[i+1]] are the sections of fiber i
+  """
+  low, high = np.broadcast_to(num_section, 2)
+  counts = rng.integers(low, high, size=num_fiber, endpoint=True)
+  offsets = np.zeros(num_fiber+1, dtype=np.int64)
+  np.cumsum(counts, out=offsets[1:])
+
+  box = np.asarray(box, dtype=float)
+  start, direction = random_molecules(rng, num_fiber, box)
+  length = rng.uniform(*np.broadcast_to(section_length, 2), size=num_fiber)
+
+  # the walk advances all the fibers one section at a time, the sections beyond the end of a fiber are dropped below
+  steps = np.empty((num_fiber, counts.max(initial=1), 3))
+  steps[:, 0] = 0
+  for i in range(1, steps.shape[1]):
+    direction = direction + bending*rng.standard_normal((num_fiber, 3))
+    direction /= np.linalg.norm(direction, axis=1, keepdims=True)
+    steps[:, i] = direction*length[:, np.newaxis]
+  r = start[:, np.newaxis, :] + np.cumsum(steps, axis=1)
+
+  r = r[np.arange(steps.shape[1]) < counts[:, np.newaxis]]
+  r = np.mod(r, 2*box)
+  r = np.where(r > box, 2*box-r, r)
+  return r, offsets
+
+def HCP_coordinates(diameter=5, lattice_constant=1) -> np.ndarray:
+  """
+  Get coordinates of a hexagonal close-packed (HCP) lattice in a circular area.
+  The points are i*a1+j*a2 for the lattice vectors a1 = (1, 0) and a2 = (cos(60), sin(60)) (times the lattice constant),
+  enumerated over the range of (i, j) that bounds the circle and kept if they are closer than diameter to the origin.
+  The lattice is calculated once per (diameter, lattice_constant) and repeated calls return a copy of the stored result;
+  HCP_coordinates.cache_clear() forgets the stored results.
+
+  Parameters
+  ----------
+    diameter : diameter of the circular area
+    lattice_constant : lattice constant for the HCP lattice
+
+  Returns
+  -------
+    coordinates : numpy.ndarray with shape (N,2) where N is the number of points in the lattice.
+                  The points are sorted by j and then by i, i.e. row by row along a1 starting from the bottom row.
+  """
+  return _HCP_coordinates(diameter, lattice_constant).copy()
+
+@functools.lru_cache(maxsize=None)
+def _HCP_coordinates(diameter, lattice_constant) -> np.ndarray:
+  a = [np.array([1, 0]), np.array([np.cos(np.pi/3), np.sin(np.pi/3)])]
+  a = [base*lattice_constant for base in a]
 
-      nextNode = [node[0]+0, node[1]-1]
-      if (not nextNode in visited):
-        s.append(nextNode)
+  # |y| = |j|*sin(60)*lattice_constant and |x| >= |i|*lattice_constant-|y|/tan(60) inside the circle
+  n_j = int(np.ceil(diameter/(np.sin(np.pi/3)*abs(lattice_constant)))) if lattice_constant else 0
+  n_i = int(np.ceil(diameter/abs(lattice_constant)+n_j/2)) if lattice_constant else 0
+  j, i = np.meshgrid(np.arange(-n_j, n_j+1), np.arange(-n_i, n_i+1), indexing='ij')
+  i, j = i.ravel(), j.ravel()
 
-      nextNode = [node[0]+1, node[1]-1]
-      if (not nextNode in visited):
-        s.append(nextNode)
+  coordinates = i[:, np.newaxis]*a[0]+j[:, np.newaxis]*a[1]
+  return coordinates[np.linalg.norm(coordinates, axis=1) < diameter]
 
-  return coordinates
+# forget the stored lattices, e.g. to time the calculation
+HCP_coordinates.cache_clear = _HCP_coordinates.cache_clear
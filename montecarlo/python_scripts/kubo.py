@@ -0,0 +1,409 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import numpy as np
+from scipy.spatial import cKDTree
+
+import scatter_table
+# the mesh files are read with the tools of the mesh post-processing scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'mesh', 'python_scripts'))
+import mesh_io
+import spatial
+
+def calc_diam(m: int, n: int) -> float:
+  '''
+  Diameter of a CNT with chirality (m, n) [m], as monte_carlo::calc_diam
+  '''
+  a_l = np.sqrt(3.)*1.42e-10
+  return a_l*np.sqrt(n*n + m*m + n*m)/3.141592
+
+def sections(lower: np.ndarray, upper: np.ndarray, n: int) -> np.ndarray:
+  '''
+  Slice a domain into n sections in each direction
+
+  Returns:
+    np.ndarray of shape (n+1, 3) with the boundaries of the sections
+  '''
+  return np.arange(n+1)[:, np.newaxis]*((upper - lower)/n) + lower
+
+class KuboMonteCarlo:
+  '''
+  Batched numpy version of the Green-Kubo exciton monte carlo of monte_carlo::kubo_init, kubo_create_particles and kubo_step.
+  The scatterers are the points of the single CNT mesh, and the neighbors of every scatterer with their hopping rates are stored in
+  compressed sparse row (CSR) form, built from the neighbor list and hopping geometry of the mesh (create_fine_mesh.py --neighbor_list
+  --same_cnt_pairs and --hopping_geometry) and the scatter tables. The state of all the particles is kept in flat arrays, and each
+  time step advances the whole ensemble: only the particles whose free flight ends within the step are processed again, and their
+  hops are sampled together from the cumulative rates.
+  '''
+
+  def __init__(self, j: dict, rng: np.random.Generator, chunk_size=50000):
+    '''
+    Parameters:
+      j (dict): monte carlo input with the "cnts" and "exciton monte carlo" sections
+      rng (np.random.Generator): random number generator
+      chunk_size (int): number of scatterers whose neighbors are processed at a time
+    '''
+    self.rng = rng
+    self.properties = properties = j['exciton monte carlo']
+    self.time = 0.
+
+    self.max_hopping_radius = float(properties['max hopping radius [m]'])
+    print(f'maximum hopping radius: {self.max_hopping_radius*1e9} [nm]')
+    self.max_dissolving_radius = float(properties['max dissolving radius [m]'])
+    print(f'maximum dissolving radius: {self.max_dissolving_radius*1e9} [nm]')
+    self.velocity = float(properties['exciton velocity [m/s]'])
+    print(f'exciton velocity [m/s]: {self.velocity}')
+
+    self.chirality_map = [list(c['chirality']) for name, c in j['cnts'].items() if name not in ('directory', 'comment')]
+    self.mesh_directory = properties['mesh input directory']
+    self._create_scatterers()
+    tables = self._scatter_tables()
+    self._create_neighbors(tables, chunk_size)
+
+    density = float(properties['density of quenching sites'])
+    self._create_quenching_sites(int(density*self.n_scat))
+
+    n = int(properties['number of sections for injection region'])
+    x = sections(self.domain[0], self.domain[1], n)
+    self.inject = np.flatnonzero(np.all((x[n//2] <= self.scat_pos) & (self.scat_pos <= x[n//2+1]), axis=1))
+    self.removal_domain = (x[1], x[n-1])
+    print(f'remove domain lower limit:  x: {x[1, 0]} , y: {x[1, 1]} , z: {x[1, 2]}')
+    print(f'remove domain upper limit:  x: {x[n-1, 0]} , y: {x[n-1, 1]} , z: {x[n-1, 2]}')
+    self.max_time = float(properties['maximum time for kubo simulation [seconds]'])
+
+  def _create_scatterers(self):
+    '''
+    Read the single CNT mesh and keep the points inside the "trim limits" (and inside the box of the trimming stage of the mesh, if any).
+    As in monte_carlo::create_scatterers and trim_scats, the remaining points of a CNT are linked to their neighbors on the same CNT.
+    '''
+    pos = mesh_io.open_single_cnt_arrays(self.mesh_directory, 'pos')
+    if pos is None:
+      raise FileNotFoundError(f'{self.mesh_directory} does not contain the .npy files of a single CNT mesh')
+    n_cnt, n_coor = pos[0].shape
+    pos = np.stack(pos, axis=-1).reshape((-1, 3))*1e-9
+
+    limits = self.properties['trim limits']
+    lower = np.array([limits['xlim'][0], limits['ylim'][0], limits['zlim'][0]], dtype=float)
+    upper = np.array([limits['xlim'][1], limits['ylim'][1], limits['zlim'][1]], dtype=float)
+    report = os.path.join(self.mesh_directory, mesh_io.TRIM_REPORT)
+    if os.path.exists(report):
+      with open(report) as file:
+        report = json.load(file)
+      lower = np.maximum(lower, np.array([report[k][0] for k in ('xlim', 'ylim', 'zlim')])*1e-9)
+      upper = np.minimum(upper, np.array([report[k][1] for k in ('xlim', 'ylim', 'zlim')])*1e-9)
+
+    keep = np.all((lower <= pos) & (pos <= upper), axis=1)
+    self.point = np.flatnonzero(keep)
+    self.n_scat = self.point.size
+    if self.n_scat == 0:
+      raise ValueError('no scatterers inside the trim limits')
+    print(f'total number of scatterers: {self.n_scat}')
+
+    # index of the scatterer of every mesh point, or -1
+    self.scatterer_of_point = np.full(pos.shape[0], -1, dtype=np.int64)
+    self.scatterer_of_point[self.point] = np.arange(self.n_scat)
+    column = self.point % n_coor
+    self.left = np.where(column > 0, self.scatterer_of_point[np.maximum(self.point-1, 0)], -1)
+    self.right = np.where(column < n_coor-1, self.scatterer_of_point[np.minimum(self.point+1, pos.shape[0]-1)], -1)
+
+    self.scat_pos = pos[keep]
+    self.domain = (self.scat_pos.min(axis=0), self.scat_pos.max(axis=0))
+    for k, name in enumerate('xyz'):
+      print(f'    {name} ({self.domain[0][k]*1e9:+f} , {self.domain[1][k]*1e9:+f}) [nm]')
+
+    chiral = np.stack([c.reshape(-1)[self.point] for c in mesh_io.open_single_cnt_arrays(self.mesh_directory, 'chiral')], axis=1)
+    self.chiral_index = np.full(self.n_scat, -1, dtype=np.int64)
+    for i, c in enumerate(self.chirality_map):
+      self.chiral_index[np.all(chiral == c, axis=1)] = i
+    if np.any(self.chiral_index < 0):
+      missing = np.unique(chiral[self.chiral_index < 0], axis=0).astype(int).tolist()
+      raise ValueError(f'the chiralities {missing} of the mesh are not listed in the "cnts" section of the input')
+
+  def _scatter_tables(self) -> list:
+    '''
+    Get the scatter table of every pair of chiralities: the davoody tables saved by the monte carlo code in the scatter table directory,
+    or the dipole-dipole tables of scatter_table.py for the other rate types
+
+    Returns:
+      nested list of (axes, rate) with the axes in nanometers and radians, indexed by the chirality index of the donor and the acceptor
+    '''
+    properties = self.properties
+    directory = properties['scatter table directory']
+    rate_type = properties['rate type']
+    temperature, permittivity = properties['temperature [kelvin]'], properties['relative permittivity']
+
+    tables = []
+    for donor in self.chirality_map:
+      tables.append([])
+      for acceptor in self.chirality_map:
+        if rate_type == 'davoody':
+          path = os.path.join(directory, scatter_table.table_name(donor, acceptor, temperature, permittivity))
+          if not os.path.isdir(path):
+            raise FileNotFoundError(f'{path} does not exist; the davoody scatter tables are calculated by the monte carlo code')
+        else:
+          path = scatter_table.cached_table(os.path.join(directory, 'cache'), donor, acceptor, scatter_table.grid_spec(properties),
+                                            permittivity, rate_type=rate_type)
+        # a dipole-dipole table exported by scatter_table.py --export sits where the davoody table is looked for
+        if scatter_table.table_rate_type(path) != rate_type:
+          raise ValueError(f'{path} holds a {scatter_table.table_rate_type(path)} table, but the rate type of the input is {rate_type}')
+        axes, rate = scatter_table.load_table(path)
+        axes = {name: axes[name]*(1. if name == 'theta' else 1e9) for name in mesh_io.TABLE_AXES}
+        tables[-1].append((axes, rate))
+    return tables
+
+  def _create_neighbors(self, tables: list, chunk_size: int):
+    '''
+    Build the CSR list of the neighbors of every scatterer within the max hopping radius with their hopping rates.
+    As in scatterer::find_neighbors, the points of the same CNT are neighbors too, so the neighbor list of the mesh must keep them;
+    the neighbor list and the hopping geometry are read from the mesh directory and are not calculated here.
+    '''
+    radius = self.max_hopping_radius*1e9
+    try:
+      offsets, indices, distances = mesh_io.read_neighbor_list(self.mesh_directory, radius=radius, same_cnt=True)
+      hopping = mesh_io.read_hopping_geometry(self.mesh_directory)
+    except (OSError, ValueError) as error:
+      raise ValueError(f'{error}\nrun: create_fine_mesh.py --neighbor_list --same_cnt_pairs --hopping_radius {radius:g} --hopping_geometry <monte carlo input> '
+                       f'on the mesh in {self.mesh_directory} first') from error
+    with open(os.path.join(self.mesh_directory, mesh_io.HOPPING_GEOMETRY)) as file:
+      stored_axes = json.load(file)['axes']
+
+    neighbor, rate, count = [], [], np.zeros(self.n_scat, dtype=np.int64)
+    for start in range(0, self.n_scat, chunk_size):
+      points = self.point[start:start+chunk_size]
+      first, last = offsets[points], offsets[points+1]
+      n = last - first
+      # pairs of the chunk, in the order of the neighbor list
+      pairs = np.repeat(first - np.cumsum(n) + n, n) + np.arange(n.sum())
+      src = np.repeat(np.arange(start, start+points.size), n)
+      dst = self.scatterer_of_point[np.asarray(indices[pairs])]
+      select = (dst > -1) & (np.asarray(distances[pairs]) < radius)
+      pairs, src, dst = pairs[select], src[select], dst[select]
+      h = hopping[pairs]
+
+      r = np.zeros(pairs.size)
+      for a in range(len(self.chirality_map)):
+        for b in range(len(self.chirality_map)):
+          sel = (self.chiral_index[src] == a) & (self.chiral_index[dst] == b)
+          table_axes, table = tables[a][b]
+          index = np.empty((np.count_nonzero(sel), 4), dtype=np.int64)
+          for k, name in enumerate(mesh_io.TABLE_AXES):
+            if np.allclose(stored_axes[name], table_axes[name], rtol=1e-9, atol=0):
+              i, w = h['index'][sel, k], h['weight'][sel, k]
+            else:
+              i, w = spatial.table_weights(h[name][sel], table_axes[name])
+            # nearest grid point, as scattering_struct::get_rate
+            index[:, k] = i + (w > 0.5)
+          r[sel] = table[index[:, 0], index[:, 1], index[:, 2], index[:, 3]]
+
+      neighbor.append(dst)
+      rate.append(r)
+      count += np.bincount(src, minlength=self.n_scat)
+
+    self.neighbor = np.concatenate(neighbor)
+    rate = np.concatenate(rate)
+    self.offsets = np.zeros(self.n_scat+1, dtype=np.int64)
+    np.cumsum(count, out=self.offsets[1:])
+    src = np.repeat(np.arange(self.n_scat), count)
+
+    # total scattering rate of every scatterer, as scatterer::set_max_rate
+    self.max_rate = np.bincount(src, weights=rate, minlength=self.n_scat)
+    self.max_rate[count == 0] = 5
+    # the hops are sampled from the cumulative sum of the rates normalized per scatterer, so scatterer i covers the range (i, i+1]
+    # of the cumulative sum whatever the magnitude of its rates
+    with np.errstate(invalid='ignore'):
+      self.cumulative = np.cumsum(np.nan_to_num(rate/self.max_rate[src]))
+    print(f'number of neighbor pairs: {self.neighbor.size}')
+
+  def _create_quenching_sites(self, n: int):
+    '''
+    Place the quenching sites next to randomly chosen scatterers and flag the scatterers within the max dissolving radius of any of them
+    '''
+    self.quenching = np.zeros(self.n_scat, dtype=bool)
+    if n > 0:
+      s = self.rng.integers(self.n_scat, size=n)
+      diameter = np.array([calc_diam(*self.chirality_map[c]) for c in self.chiral_index[s]])
+      sites = self.scat_pos[s] + np.stack((diameter/2, np.zeros(n), np.zeros(n)), axis=1)
+      close = cKDTree(sites).query_ball_point(self.scat_pos, self.max_dissolving_radius, return_length=True)
+      self.quenching = close > 0
+    print(f'total number of quenching sites: {n}')
+
+  def create_particles(self, n: int):
+    '''
+    Create n particles on random scatterers of the injection region
+    '''
+    if self.inject.size == 0:
+      raise ValueError('there are no scatterers in the injection region')
+    self.n_particle = n
+    self.scat = self.inject[self.rng.integers(self.inject.size, size=n)]
+    self.pos = self.scat_pos[self.scat].copy()
+    self.delta_pos = np.zeros((n, 3))
+    self.diff_len = np.full((n, 3), np.nan)
+    self.heading_right = self.rng.integers(2, size=n).astype(bool)
+    self.ff_time = self._ff_time(self.scat)
+    self.dissolved = np.zeros(n, dtype=bool)
+    self.scatter_times = np.zeros(n, dtype=np.int64)
+
+  def _ff_time(self, scat: np.ndarray) -> np.ndarray:
+    '''
+    Random free flight times until the next scattering event of particles on the given scatterers
+    '''
+    return -np.log1p(-self.rng.random(scat.size))/self.max_rate[scat]
+
+  def _hop(self, scat: np.ndarray) -> np.ndarray:
+    '''
+    Sample the scatterer each particle hops to from the rates of the neighbors of its current scatterer, as scatterer::update_state
+    '''
+    first, last = self.offsets[scat], self.offsets[scat+1]
+    has_neighbors = last > first
+    base = np.where(first > 0, self.cumulative[np.maximum(first-1, 0)], 0.)
+    end = self.cumulative[np.maximum(last-1, 0)]
+    dice = base + (end - base)*self.rng.random(scat.size)
+    k = np.clip(np.searchsorted(self.cumulative, dice, side='right'), first, np.maximum(last-1, first))
+    return np.where(has_neighbors, self.neighbor[np.minimum(k, self.neighbor.size-1)], scat)
+
+  def _fly(self, p: np.ndarray, dt: np.ndarray):
+    '''
+    Free flight of particles p along their CNTs for the times dt, as particle::fly
+    '''
+    s = self.scat[p]
+    linked = (self.left[s] > -1) | (self.right[s] > -1)
+    p, dt = p[linked], dt[linked]
+    while p.size:
+      s = self.scat[p]
+      left, right = self.left[s], self.right[s]
+      heading = self.heading_right[p]
+      next = np.where(heading, np.where(right > -1, right, left), np.where(left > -1, left, right))
+      self.heading_right[p] = next == right
+
+      target = self.scat_pos[next]
+      d = target - self.pos[p]
+      dist = np.sqrt(np.einsum('ij,ij->i', d, d))
+      time = dist/self.velocity
+      arrive = time < dt
+      with np.errstate(divide='ignore', invalid='ignore'):
+        move = np.where(arrive | (dist == 0), 0., self.velocity*dt/dist)
+      self.pos[p] = np.where(arrive[:, np.newaxis], target, self.pos[p] + move[:, np.newaxis]*d)
+      self.scat[p] = np.where(arrive, next, s)
+      p, dt = p[arrive], (dt - time)[arrive]
+
+  def step(self, dt: float):
+    '''
+    Advance all the particles by dt, as monte_carlo::kubo_step
+    '''
+    old_pos = self.pos.copy()
+    remaining = np.full(self.n_particle, dt)
+    active = ~self.dissolved
+
+    p = np.flatnonzero(active & (self.ff_time <= remaining))
+    while p.size:
+      remaining[p] -= self.ff_time[p]
+      self._fly(p, self.ff_time[p])
+
+      quenched = self.quenching[self.scat[p]]
+      if np.any(quenched):
+        q = p[quenched]
+        self.dissolved[q] = True
+        self.diff_len[q] = self.delta_pos[q]
+        active[q] = False
+        p = p[~quenched]
+
+      new = self._hop(self.scat[p])
+      moved = new != self.scat[p]
+      self.scatter_times[p[moved]] += 1
+      self.scat[p[moved]] = new[moved]
+      self.pos[p[moved]] = self.scat_pos[new[moved]]
+      self.ff_time[p] = self._ff_time(self.scat[p])
+      p = p[self.ff_time[p] <= remaining[p]]
+
+    p = np.flatnonzero(active)
+    self._fly(p, remaining[p])
+    self.ff_time[p] -= remaining[p]
+    self.delta_pos += self.pos - old_pos
+
+    # particles that leave the removal domain are injected again on a scatterer with the same chirality
+    out = np.flatnonzero(np.any(self.pos < self.removal_domain[0], axis=1) | np.any(self.removal_domain[1] < self.pos, axis=1))
+    if out.size:
+      chirality = self.chiral_index[self.scat[out]]
+      for c in np.unique(chirality):
+        candidates = self.inject[self.chiral_index[self.inject] == c]
+        if candidates.size == 0:
+          raise ValueError(f'there are no scatterers with the chirality {self.chirality_map[c]} in the injection region')
+        q = out[chirality == c]
+        self.scat[q] = candidates[self.rng.integers(candidates.size, size=q.size)]
+        self.pos[q] = self.scat_pos[self.scat[q]]
+
+    self.time += dt
+
+def _header(description: str, n: int, columns: str) -> str:
+  return f'# this file contains {description}\n# number of particles: {n}\n\n{columns}\n'
+
+def main():
+  parser = argparse.ArgumentParser(description='Batched numpy Green-Kubo exciton monte carlo on the single CNT mesh, with the same outputs as the monte carlo code')
+  parser.add_argument('input', help='monte carlo input file in json format', type=str, nargs='?', default='input.json')
+  parser.add_argument('--particles', help='number of particles (default: "number of particles for kubo simulation" of the input)', type=int, default=None)
+  parser.add_argument('--output', help='output directory (default: "output directory" of the input)', type=str, default=None)
+  parser.add_argument('--seed', help='seed of the random numbers', type=int, default=100)
+  parser.add_argument('--save_individual', help='also save the displacement and position of every particle at every time step', action='store_true')
+  args = parser.parse_args()
+
+  with open(args.input) as file:
+    j = json.load(file)
+  if 'exciton monte carlo' not in j:
+    raise ValueError('json input file does not contain "exciton monte carlo"')
+  properties = j['exciton monte carlo']
+
+  output = args.output or properties['output directory']
+  os.makedirs(output, exist_ok=True)
+  with open(os.path.join(output, 'input.json'), 'w') as file:
+    json.dump(properties, file, indent=4)
+  mesh_input = os.path.join(properties['mesh input directory'], 'input.json')
+  if os.path.exists(mesh_input):
+    shutil.copyfile(mesh_input, os.path.join(output, 'mesh_input.json'))
+  else:
+    print(f'warning: {mesh_input} does not exist, mesh_input.json is not written')
+
+  sim = KuboMonteCarlo(j, np.random.default_rng(args.seed))
+  sim.create_particles(args.particles or int(properties['number of particles for kubo simulation']))
+  n = sim.n_particle
+  dt = float(properties['monte carlo time step'])
+
+  files = {
+    'squared': open(os.path.join(output, 'particle_displacement.avg.squared.dat'), 'w'),
+    'tensor': open(os.path.join(output, 'particle_diffusion_tensor.dat'), 'w'),
+  }
+  files['squared'].write(_header('the average of dx^2, dy^2, and dz^2 of the particle ensemble over time', n, 'time,x,y,z'))
+  files['tensor'].write(_header('the diffusion tensor Dij of the particle ensemble over time', n, 'time,Dxx,Dxy,Dxz,Dyy,Dyz,Dzz'))
+  if args.save_individual:
+    for quantity in ('displacement', 'position'):
+      for k in 'xyz':
+        files[quantity+k] = open(os.path.join(output, f'particle_{quantity}.{k}.dat'), 'w')
+        files[quantity+k].write('time' + ''.join(f',{i}' for i in range(n)) + '\n')
+
+  upper = np.triu_indices(3)
+  while sim.time < sim.max_time:
+    sim.step(dt)
+    d = sim.delta_pos
+    files['squared'].write(','.join(f'{v:+e}' for v in (sim.time, *np.mean(d**2, axis=0))) + '\n')
+    mean = d.mean(axis=0)
+    tensor = ((d.T @ d)/n - np.outer(mean, mean))/(2*sim.time)
+    files['tensor'].write(','.join(f'{v:+e}' for v in (sim.time, *tensor[upper])) + '\n')
+    if args.save_individual:
+      for k, name in enumerate('xyz'):
+        for quantity, values in (('displacement', d), ('position', sim.pos)):
+          files[quantity+name].write(f'{sim.time:+e}' + ''.join(f',{v:+e}' for v in values[:, k]) + '\n')
+    print(f'kubo simulation: current time [seconds]: {sim.time:e} .... max time [seconds]: {sim.max_time:e}', end='\r', flush=True)
+
+  for file in files.values():
+    file.close()
+  with open(os.path.join(output, 'particle_diffusion_length.dat'), 'w') as file:
+    file.write(_header('the diffusion length in x,y,z of each particle in the ensemble', n, 'x,y,z'))
+    for row in sim.diff_len:
+      file.write(','.join(f'{v:+e}' for v in row) + '\n')
+
+  print(f'\n\naverage scatter times of exciton is {sim.scatter_times.mean()}')
+  print('\nGreen-Kubo simulation finished!')
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,252 @@
+import os
+import json
+import shutil
+import hashlib
+import argparse
+import numpy as np
+from typing import Tuple
+
+# version of the cached tables; change it when the rate or the file layout changes so that old tables are not reused
+CACHE_VERSION = 1
+
+# prefactor of the dipole-dipole rate [1/s] of the rate types of the commented out monte_carlo::create_forster_scatt_table
+GAMMA_0 = {'forster': 1.e15, 'wong': 1.e13}
+
+# axes of the scatter table: (name of the table files, key in the monte carlo input, conversion to meters or radians)
+AXES = [('theta', 'theta [degrees]', np.pi/180),
+        ('z_shift', 'zshift [m]', 1.),
+        ('axis_shift_1', 'axis shift 1 [m]', 1.),
+        ('axis_shift_2', 'axis shift 2 [m]', 1.)]
+
+def grid_spec(properties: dict) -> dict:
+  '''
+  Get the [start, stop, number of points] of each axis of the scatter table from the monte carlo properties
+
+  Parameters:
+    properties (dict): "exciton monte carlo" section of the monte carlo input
+
+  Returns:
+    dict with the table file name of each axis as key
+  '''
+  return {name: [float(properties[key][0]), float(properties[key][1]), int(properties[key][2])] for name, key, _ in AXES}
+
+def grid_axes(spec: dict) -> dict:
+  '''
+  Build the axes of the scatter table as monte_carlo::create_davoody_scatt_table does
+
+  Parameters:
+    spec (dict): see `grid_spec`
+
+  Returns:
+    dict of np.ndarray: theta [radians] and the shifts [m]
+  '''
+  return {name: np.linspace(*spec[name])*factor for name, _, factor in AXES}
+
+def dipole_rates(theta: np.ndarray, z_shift: np.ndarray, axis_shift_1: np.ndarray, axis_shift_2: np.ndarray,
+                 gamma_0=GAMMA_0['forster'], permittivity=1.) -> np.ndarray:
+  '''
+  Calculate the dipole-dipole (Forster) hopping rate on the whole 4-D grid of the scatter table with numpy broadcasting.
+  As in the commented out monte_carlo::create_forster_scatt_table the donor segment is at axis_shift_1 along the x axis and the
+  acceptor segment is at axis_shift_2 along an axis rotated by theta in the xy plane and shifted by z_shift along z. The dipoles
+  are along the tube axes, so the orientation factor is defined also when an axis shift is zero, and the coupling is screened
+  by the relative permittivity like the coupling of exciton_transfer.
+
+  Parameters:
+    theta (np.ndarray): angles between the tubes [radians]
+    z_shift, axis_shift_1, axis_shift_2 (np.ndarray): shifts [m]
+    gamma_0 (float): rate of parallel dipoles at a distance of 1 nm [1/s]
+    permittivity (float): relative permittivity
+
+  Returns:
+    np.ndarray of shape (theta, z_shift, axis_shift_1, axis_shift_2) with the rates [1/s]
+  '''
+  th = np.asarray(theta, dtype=float)[:, np.newaxis, np.newaxis, np.newaxis]
+  zsh = np.asarray(z_shift, dtype=float)[np.newaxis, :, np.newaxis, np.newaxis]
+  ash1 = np.asarray(axis_shift_1, dtype=float)[np.newaxis, np.newaxis, :, np.newaxis]
+  ash2 = np.asarray(axis_shift_2, dtype=float)[np.newaxis, np.newaxis, np.newaxis, :]
+
+  # dR = r1 - r2 with r1 = ash1*(1, 0, 0) and r2 = ash2*(cos(th), sin(th), 0) + (0, 0, zsh)
+  dx = ash1 - ash2*np.cos(th)
+  dy = -ash2*np.sin(th)
+  distance = np.sqrt(dx**2 + dy**2 + zsh**2)
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    # projections of the dipoles (1, 0, 0) and (cos(th), sin(th), 0) on the unit vector of dR
+    p1 = dx/distance
+    p2 = (dx*np.cos(th) + dy*np.sin(th))/distance
+    angle_factor = np.cos(th) - 3*p1*p2
+    rate = gamma_0*angle_factor**2*(1.e-9/distance)**6/permittivity**2
+
+  return np.where(distance > 0, rate, 0.)
+
+def table_key(donor, acceptor, spec: dict, permittivity: float, rate_type='forster') -> Tuple[str, dict]:
+  '''
+  Get the content address of a scatter table: the sha1 hash of everything the table depends on.
+  The dipole-dipole rate does not depend on the temperature, so a temperature sweep reuses the same table.
+
+  Returns:
+    tuple of (hash, key) where key is the dict that was hashed
+  '''
+  key = {'version': CACHE_VERSION, 'rate type': rate_type, 'gamma_0 [1/s]': GAMMA_0[rate_type],
+         'donor chirality': [int(c) for c in donor], 'acceptor chirality': [int(c) for c in acceptor],
+         'grid': spec, 'relative permittivity': float(permittivity)}
+  return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest(), key
+
+def save_arma(filename: str, array: np.ndarray):
+  '''
+  Save a vector, matrix or cube in the Armadillo binary format (the default format of arma::Mat::save and arma::Cube::save)
+  '''
+  array = np.asarray(array, dtype=np.float64)
+  if array.ndim == 1:
+    array = array[:, np.newaxis]
+  if array.ndim == 2:
+    header = f'ARMA_MAT_BIN_FN008\n{array.shape[0]} {array.shape[1]}\n'
+  else:
+    header = f'ARMA_CUB_BIN_FN008\n{array.shape[0]} {array.shape[1]} {array.shape[2]}\n'
+  with open(filename, 'wb') as file:
+    file.write(header.encode())
+    file.write(np.asfortranarray(array).tobytes(order='F'))
+
+def load_arma(filename: str) -> np.ndarray:
+  '''
+  Load a matrix or cube saved in the Armadillo binary format; vectors are returned as 1-D arrays
+  '''
+  with open(filename, 'rb') as file:
+    kind = file.readline().decode().strip()
+    shape = tuple(int(n) for n in file.readline().split())
+    data = np.frombuffer(file.read(), dtype=np.float64)
+  if kind not in ('ARMA_MAT_BIN_FN008', 'ARMA_CUB_BIN_FN008'):
+    raise ValueError(f'{filename} is not an Armadillo binary matrix or cube of doubles')
+  array = data.reshape(shape, order='F')
+  return array[:, 0] if kind == 'ARMA_MAT_BIN_FN008' and shape[1] == 1 else array
+
+def save_table(directory: str, axes: dict, rate: np.ndarray):
+  '''
+  Save a scatter table with the file layout of scattering_struct::save, which monte_carlo::recovery_scatt_table reads
+  '''
+  path = os.path.join(directory, 'scat_table')
+  for name, _, _ in AXES:
+    save_arma(path + f'.{name}.dat', axes[name])
+  for i_th in range(rate.shape[0]):
+    save_arma(path + f'{i_th}.rates.dat', rate[i_th])
+
+def load_table(directory: str) -> Tuple[dict, np.ndarray]:
+  '''
+  Load a scatter table saved by `save_table` or by scattering_struct::save
+
+  Returns:
+    tuple of (axes, rate): dict of np.ndarray with the axes and np.ndarray of shape (theta, z_shift, axis_shift_1, axis_shift_2)
+  '''
+  path = os.path.join(directory, 'scat_table')
+  axes = {name: load_arma(path + f'.{name}.dat') for name, _, _ in AXES}
+  rate = np.stack([load_arma(path + f'{i_th}.rates.dat') for i_th in range(axes['theta'].size)])
+  return axes, rate
+
+def cached_table(cache_directory: str, donor, acceptor, spec: dict, permittivity: float, rate_type='forster') -> str:
+  '''
+  Get the directory of a dipole-dipole scatter table in a content addressed cache, calculating the table if it is not cached yet.
+  Each table is stored in a subdirectory named by the hash of `table_key` together with the key in key.json, so tables
+  are reused by every run with the same parameters and a change of any parameter leads to a new table.
+
+  Parameters:
+    cache_directory (str): directory of the cache
+    donor, acceptor (list(int)): chirality of the donor and acceptor tubes
+    spec (dict): grid of the table, see `grid_spec`
+    permittivity (float): relative permittivity
+    rate_type (str): 'forster' or 'wong'
+
+  Returns:
+    str: directory of the table
+  '''
+  digest, key = table_key(donor, acceptor, spec, permittivity, rate_type)
+  directory = os.path.join(cache_directory, digest)
+  if os.path.exists(os.path.join(directory, 'key.json')):
+    print(f'reading cached table: {directory}')
+    return directory
+
+  print(f'calculating table: {directory}')
+  axes = grid_axes(spec)
+  rate = dipole_rates(axes['theta'], axes['z_shift'], axes['axis_shift_1'], axes['axis_shift_2'],
+                      gamma_0=GAMMA_0[rate_type], permittivity=permittivity)
+
+  # the table is written to a temporary directory and renamed, so an interrupted run does not leave an incomplete table behind
+  temp_directory = directory + f'.tmp{os.getpid()}'
+  os.makedirs(temp_directory, exist_ok=True)
+  save_table(temp_directory, axes, rate)
+  with open(os.path.join(temp_directory, 'key.json'), 'w') as file:
+    json.dump(key, file, indent=2)
+  try:
+    os.rename(temp_directory, directory)
+  except OSError:
+    # another process has cached the same table in the meantime
+    shutil.rmtree(temp_directory)
+  return directory
+
+def table_name(donor, acceptor, temperature: float, permittivity: float) -> str:
+  '''
+  Name of the directory in which the monte carlo code looks for the scatter table of a pair of chiralities
+  '''
+  # std::to_string of a float prints six decimals
+  return f'{donor[0]}{donor[1]}{acceptor[0]}{acceptor[1]}_{np.float32(temperature):f}_{np.float32(permittivity):f}scat_table'
+
+def table_rate_type(directory: str) -> str:
+  '''
+  Rate type of a scatter table: the rate type in the key.json of the tables of `cached_table` (also after `export_table`),
+  or 'davoody' for the tables saved by the monte carlo code, which have no key.json
+  '''
+  key = os.path.join(directory, 'key.json')
+  if not os.path.exists(key):
+    return 'davoody'
+  with open(key) as file:
+    return json.load(file)['rate type']
+
+def export_table(directory: str, scatter_table_directory: str, donor, acceptor, temperature: float, permittivity: float) -> str:
+  '''
+  Copy a cached table to the scatter table directory of the monte carlo code, under the name of the davoody table it looks for.
+  The monte carlo code only checks that the directory exists, so a table that is already there is never replaced unless it is
+  the same table: a davoody table of the monte carlo code has no key.json, and an exported table with another key.json was
+  calculated with other parameters.
+
+  Returns:
+    str: directory of the exported table
+  '''
+  destination = os.path.join(scatter_table_directory, table_name(donor, acceptor, temperature, permittivity))
+  if os.path.exists(destination):
+    with open(os.path.join(directory, 'key.json')) as file:
+      key = json.load(file)
+    existing = os.path.join(destination, 'key.json')
+    if not os.path.exists(existing):
+      raise FileExistsError(f'{destination} holds a davoody table of the monte carlo code; remove it to export the {key["rate type"]} table')
+    with open(existing) as file:
+      if json.load(file) != key:
+        raise FileExistsError(f'{destination} holds a table exported with other parameters; remove it to export this table')
+    return destination
+  shutil.copytree(directory, destination)
+  return destination
+
+def main():
+  parser = argparse.ArgumentParser(description='Calculate dipole-dipole scatter tables for the chiralities of a monte carlo input and keep them in a content addressed cache')
+  parser.add_argument('input', help='monte carlo input file in json format', type=str)
+  parser.add_argument('--section', help='section of the input file with the monte carlo properties', type=str, default='exciton monte carlo')
+  parser.add_argument('--rate_type', help='prefactor of the dipole-dipole rate', choices=sorted(GAMMA_0), default='forster')
+  parser.add_argument('--cache', help='cache directory (default: the cache subdirectory of the "scatter table directory" of the input)', type=str, default=None)
+  parser.add_argument('--export', help='copy the tables to the "scatter table directory" of the input under the names the monte carlo code looks for; the davoody runs of the monte carlo code then read these tables, and tables that are already there are not replaced', action='store_true')
+  args = parser.parse_args()
+
+  with open(args.input) as file:
+    j = json.load(file)
+  properties = j[args.section]
+  chiralities = [c['chirality'] for name, c in j['cnts'].items() if name not in ('directory', 'comment')]
+  spec = grid_spec(properties)
+  temperature, permittivity = properties['temperature [kelvin]'], properties['relative permittivity']
+  cache_directory = args.cache or os.path.join(properties['scatter table directory'], 'cache')
+  os.makedirs(cache_directory, exist_ok=True)
+
+  for donor in chiralities:
+    for acceptor in chiralities:
+      directory = cached_table(cache_directory, donor, acceptor, spec, permittivity, rate_type=args.rate_type)
+      if args.export:
+        print(f'exported table: {export_table(directory, properties["scatter table directory"], donor, acceptor, temperature, permittivity)}')
+
+if __name__ == '__main__':
+  main()
@@ -237,83 +237,89 @@ private:
   std::vector<scatterer> create_scatterers(const path_t& input_path){
     std::cout << std::endl << "create scatterers in fiber structure ... " << std::flush;
 
-    std::ifstream pos_file;
-    std::ifstream orient_file;
-    std::ifstream chiral1_file;
-    std::ifstream chiral2_file;
-
-    // x axis
-    pos_file.open(input_path / "single_cnt.pos.x.dat");
-    orient_file.open(input_path / "single_cnt.orient.x.dat");
-
-    arma::mat xcoor;
-    xcoor.load(pos_file);
-    xcoor *= 1.e-9;
-
-    arma::mat xorient;
-    xorient.load(orient_file);
-
-    pos_file.close();
-    orient_file.close();
-
-    // y axis
-    pos_file.open(input_path / "single_cnt.pos.y.dat");
-    orient_file.open(input_path / "single_cnt.orient.y.dat");
-
-    arma::mat ycoor;
-    ycoor.load(pos_file);
-    ycoor *= 1.e-9;
-
-    arma::mat yorient;
-    yorient.load(orient_file);
-
-    pos_file.close();
-    orient_file.close();
-
-    // z axis
-    pos_file.open(input_path / "single_cnt.pos.z.dat");
-    orient_file.open(input_path / "single_cnt.orient.z.dat");
-
-    arma::mat zcoor;
-    zcoor.load(pos_file);
-    zcoor *= 1.e-9;
-
-    arma::mat zorient;
-    zorient.load(orient_file);
-
-    pos_file.close();
-    orient_file.close();
-
-    // chiral 1
-    chiral1_file.open(input_path / "single_cnt.chiral.1.dat");
-    chiral2_file.open(input_path / "single_cnt.chiral.2.dat");
-
-    arma::mat chiral1;
-    chiral1.load(chiral1_file);
-
-    arma::mat chiral2;
-    chiral2.load(chiral2_file);
-
-    chiral1_file.close();
-    chiral2_file.close();
+    std::ifstream file;
+
+    auto load = [&](const std::string& name) {
+      arma::mat m;
+      file.open(input_path / name, std::ios::binary);
+      m.load(file);
+      file.close();
+      return m;
+    };
 
+    arma::mat xcoor = load("single_cnt.pos.x.dat") * 1.e-9;
+    arma::mat ycoor = load("single_cnt.pos.y.dat") * 1.e-9;
+    arma::mat zcoor = load("single_cnt.pos.z.dat") * 1.e-9;
+
+    // the compact mesh format stores the orientation once per fiber point together with the fiber of each cnt,
+    // and the chirality once per cnt. In the full format every quantity has one entry per cnt point.
+    const bool compact = std::experimental::filesystem::exists(input_path / "single_cnt.fiber.dat");
+
+    arma::mat xorient, yorient, zorient, chiral1, chiral2;
+    arma::uvec fiber;
+
+    if (compact) {
+      xorient = load("single_cnt.fiber_orient.x.dat");
+      yorient = load("single_cnt.fiber_orient.y.dat");
+      zorient = load("single_cnt.fiber_orient.z.dat");
+      fiber = arma::conv_to<arma::uvec>::from(load("single_cnt.fiber.dat").col(0));
+
+      arma::mat chiral = load("single_cnt.chiral.dat");
+      chiral1 = chiral.col(0);
+      chiral2 = chiral.col(1);
+    } else {
+      xorient = load("single_cnt.orient.x.dat");
+      yorient = load("single_cnt.orient.y.dat");
+      zorient = load("single_cnt.orient.z.dat");
+      fiber = arma::regspace<arma::uvec>(0, xcoor.n_rows - 1);
+
+      chiral1 = load("single_cnt.chiral.1.dat");
+      chiral2 = load("single_cnt.chiral.2.dat");
+    }
 
+    // the trimming stage of the mesh (create_fine_mesh.py --trim) reports the usable part of the mesh in nanometers.
+    // points outside of it are not turned into scatterers, and the remaining points of each cnt are linked in order.
+    arma::vec lower(3), upper(3);
+    lower.fill(-arma::datum::inf);
+    upper.fill(arma::datum::inf);
+
+    if (std::experimental::filesystem::exists(input_path / "single_cnt.trim.json")) {
+      std::ifstream report_file(input_path / "single_cnt.trim.json");
+      nlohmann::json report;
+      report_file >> report;
+      std::array<std::string, 3> lims = {"xlim", "ylim", "zlim"};
+      for (unsigned k = 0; k < 3; ++k) {
+        lower(k) = double(report[lims[k]][0]) * 1.e-9;
+        upper(k) = double(report[lims[k]][1]) * 1.e-9;
+      }
+      std::cout << "trimmed mesh: skipping the points outside of the box in single_cnt.trim.json ... " << std::flush;
+    }
 
-    std::vector<scatterer> scat_list(xcoor.n_elem);
+    std::vector<scatterer> scat_list;
+    scat_list.reserve(xcoor.n_elem);
 
     for (unsigned i = 0; i < xcoor.n_rows; ++i) {
+      int previous = -1;
       for (unsigned j = 0; j < xcoor.n_cols; ++j) {
-        unsigned n = i * xcoor.n_cols + j;
-
-        scat_list[n].set_pos({xcoor(i, j), ycoor(i, j), zcoor(i, j)});
-        scat_list[n].set_orientation({xorient(i, j), yorient(i, j), zorient(i, j)});
-        scat_list[n].set_chirality({chiral1(i,j), chiral2(i,j)}); 
-        if (j > 0) {
-          scat_list[n].left = n - 1;
+        arma::vec pos = {xcoor(i, j), ycoor(i, j), zcoor(i, j)};
+        if (arma::any(pos < lower) || arma::any(upper < pos)) {
+          previous = -1;
+          continue;
         }
-        if (j + 1 < xcoor.n_cols) {
-          scat_list[n].right = n + 1;
+
+        unsigned f = fiber(i);
+        unsigned c = compact ? 0 : j;
+        int n = scat_list.size();
+
+        scat_list.emplace_back();
+        scat_list[n].set_pos(pos);
+        scat_list[n].set_orientation({xorient(f, j), yorient(f, j), zorient(f, j)});
+        scat_list[n].set_chirality({chiral1(i, c), chiral2(i, c)});
+        if (previous > -1) {
+          scat_list[n].left = previous;
+          scat_list[previous].right = n;
         }
+        previous = n;
       }
     }
 